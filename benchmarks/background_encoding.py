@@ -0,0 +1,92 @@
+"""Request latency with span encoding on vs off the request thread.
+
+Every request creates 50 child spans with a few binary annotations each, and
+is sampled. The transport simulates 1ms of network I/O per payload, and
+requests are issued with a short idle gap like a worker that isn't saturated.
+Keep in mind that the encoder thread competes for the GIL: on a saturated
+worker the encoding cost is moved around rather than removed. Run with:
+
+    python benchmarks/background_encoding.py [requests] [idle_ms]
+"""
+import sys
+import time
+
+from py_zipkin.transport import BaseTransportHandler
+from py_zipkin.zipkin import zipkin_span
+from pyramid.config import Configurator
+from pyramid.request import Request
+from pyramid.response import Response
+
+from pyramid_zipkin.transport import BackgroundEncodingTransport
+
+
+CHILD_SPANS = 50
+
+
+class SlowTransport(BaseTransportHandler):
+    def get_max_payload_bytes(self):
+        return None
+
+    def send(self, payload):
+        time.sleep(0.001)
+
+
+def fan_out(request):
+    for i in range(CHILD_SPANS):
+        with zipkin_span(
+            service_name='downstream',
+            span_name=f'call_{i}',
+            binary_annotations={
+                'db.statement': 'SELECT * FROM things WHERE id = %s',
+                'db.system': 'mysql',
+                'peer.service': 'things_db',
+                'index': str(i),
+            },
+        ):
+            pass
+    return Response('ok')
+
+
+def make_app(transport_handler):
+    config = Configurator(settings={
+        'service_name': 'benchmark',
+        'zipkin.tracing_percent': 100,
+        'zipkin.transport_handler': transport_handler,
+    })
+    config.include('pyramid_zipkin')
+    config.add_route('fan_out', '/fan_out')
+    config.add_view(fan_out, route_name='fan_out')
+    return config.make_wsgi_app()
+
+
+def run(app, requests, idle):
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        Request.blank('/fan_out').get_response(app)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(idle)
+    latencies.sort()
+    return (
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+    )
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    idle = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.002
+    background = BackgroundEncodingTransport(SlowTransport())
+    for name, transport_handler in (
+        ('request thread', SlowTransport()),
+        ('background', background),
+    ):
+        app = make_app(transport_handler)
+        run(app, 100, idle)  # warm up
+        p50, p99 = run(app, requests, idle)
+        print(f'{name:>15}: p50 {p50:.3f}ms  p99 {p99:.3f}ms')
+    background.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Cost of a push/get/pop of the Zipkin attributes, which zipkin_span does
+for every span, with each kind of context stack, and cost of resolving the
+`zipkin.request_context` attribute path. Run with:
+
+    python benchmarks/context_stack.py
+"""
+import logging
+import timeit
+
+from py_zipkin.storage import Stack
+from py_zipkin.storage import ThreadLocalStack
+from py_zipkin.util import ZipkinAttrs
+
+from pyramid_zipkin.context import ContextVarStack
+from pyramid_zipkin.tween import _compile_attr_path
+
+
+ATTRS = ZipkinAttrs('a' * 32, 'b' * 16, None, '0', True)
+
+
+class Request:
+    class rctxstorage:
+        zipkin_context = Stack()
+
+
+def _split_getattr_path(obj, path):
+    for attr in path.split('.'):
+        obj = getattr(obj, attr, None)
+    return obj
+
+
+def _bench(name, func, number=200000):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f'{name:>30}: {seconds / number * 1e9:.0f}ns')
+
+
+def main():
+    # ThreadLocalStack logs a deprecation warning when created.
+    logging.disable(logging.WARNING)
+    for name, stack in (
+        ('Stack (py_zipkin default)', Stack()),
+        ('ThreadLocalStack', ThreadLocalStack()),
+        ('ContextVarStack', ContextVarStack()),
+    ):
+        stack.push(ATTRS)
+
+        def push_get_pop():
+            stack.push(ATTRS)
+            stack.get()
+            stack.pop()
+
+        _bench(name, push_get_pop)
+
+    request = Request()
+    path = 'rctxstorage.zipkin_context'
+    _bench('split request_context path', lambda: _split_getattr_path(
+        request,
+        path,
+    ))
+    _bench('compiled request_context path', lambda: _compile_attr_path(
+        path,
+    )(request))
+
+
+if __name__ == '__main__':
+    main()
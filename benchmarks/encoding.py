@@ -0,0 +1,65 @@
+"""Per-span encoding time of py_zipkin's V2 JSON encoder vs
+pyramid_zipkin's FastV2JSONEncoder, for a server span shaped like the ones
+zipkin_tween emits. Run with:
+
+    python benchmarks/encoding.py
+"""
+import timeit
+
+from py_zipkin import Encoding
+from py_zipkin import Kind
+from py_zipkin.encoding import get_encoder
+from py_zipkin.encoding._helpers import create_endpoint
+from py_zipkin.encoding._helpers import Span
+
+from pyramid_zipkin.encoding import FastV2JSONEncoder
+
+
+SPAN = Span(
+    trace_id='66ec982fcfba8bf3b32d71d76e4a16a3',
+    name='GET /pet/{petId}',
+    parent_id='37133d482ba4f605',
+    span_id='17133d482ba4f605',
+    kind=Kind.SERVER,
+    timestamp=1664500000.123456,
+    duration=0.0421,
+    local_endpoint=create_endpoint(8080, 'pet_service', '10.0.0.1'),
+    shared=True,
+    tags={
+        'http.uri': '/pet/42',
+        'http.uri.qs': '/pet/42?verbose=1',
+        'otel.library.name': 'pyramid_zipkin',
+        'otel.library.version': '3.0.1',
+        'client.address': '10.0.0.2',
+        'http.route': '/pet/{petId}',
+        'http.request.method': 'GET',
+        'network.protocol.version': 'HTTP/1.1',
+        'url.path': '/pet/42',
+        'server.address': 'pet-service',
+        'server.port': '8080',
+        'url.scheme': 'http',
+        'user_agent.original': 'python-requests/2.31.0',
+        'url.query': 'verbose=1',
+        'http.response.status_code': '200',
+        'response_status_code': '200',
+        'otel.status_code': 'Ok',
+    },
+)
+
+
+def main():
+    number = 20000
+    for name, encoder in (
+        ('py_zipkin', get_encoder(Encoding.V2_JSON)),
+        ('fast', FastV2JSONEncoder()),
+    ):
+        seconds = min(timeit.repeat(
+            lambda: encoder.encode_span(SPAN),
+            number=number,
+            repeat=5,
+        ))
+        print(f'{name:>10}: {seconds / number * 1e6:.2f}us per span')
+
+
+if __name__ == '__main__':
+    main()
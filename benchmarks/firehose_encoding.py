@@ -0,0 +1,129 @@
+"""Encoding CPU with a firehose, spans encoded once per handler vs shared.
+
+Every request is sampled and creates 50 child spans with a few binary
+annotations each, and the firehose gets 100% of the spans. The first part
+times the encoding of a request's spans the way py_zipkin does it for two
+handlers against a FanOutTransport. The second measures the CPU time per
+request of the whole app with and without a firehose, which should now be
+about the same. Run with:
+
+    python benchmarks/firehose_encoding.py [requests]
+"""
+import sys
+import time
+
+from py_zipkin import Encoding
+from py_zipkin import Kind
+from py_zipkin.encoding import get_encoder
+from py_zipkin.encoding._helpers import create_endpoint
+from py_zipkin.encoding._helpers import Span
+from py_zipkin.logging_helper import ZipkinBatchSender
+from py_zipkin.transport import BaseTransportHandler
+from py_zipkin.zipkin import zipkin_span
+from pyramid.config import Configurator
+from pyramid.request import Request
+from pyramid.response import Response
+
+from pyramid_zipkin.transport import FanOutTransport
+
+
+CHILD_SPANS = 50
+TAGS = {
+    'db.statement': 'SELECT * FROM things WHERE id = %s',
+    'db.system': 'mysql',
+    'peer.service': 'things_db',
+}
+
+
+class NullTransport(BaseTransportHandler):
+    def get_max_payload_bytes(self):
+        return None
+
+    def send(self, payload):
+        pass
+
+
+def make_spans():
+    endpoint = create_endpoint(8080, 'benchmark', '127.0.0.1')
+    return [
+        Span(
+            trace_id='66ec982fcfba8bf3b32d71d76e4a16a3',
+            name=f'call_{i}',
+            parent_id='17133d482ba4f605',
+            span_id=f'{i:016x}',
+            kind=Kind.CLIENT,
+            timestamp=1664500000.0 + i,
+            duration=0.001,
+            local_endpoint=endpoint,
+            tags=dict(TAGS, index=str(i)),
+        )
+        for i in range(CHILD_SPANS)
+    ]
+
+
+def encode(handlers, spans, requests):
+    encoder = get_encoder(Encoding.V2_JSON)
+    start = time.process_time()
+    for _ in range(requests):
+        for handler in handlers:
+            with ZipkinBatchSender(handler, None, encoder) as sender:
+                for span in spans:
+                    sender.add_span(span)
+    return (time.process_time() - start) / requests * 1000
+
+
+def fan_out(request):
+    for i in range(CHILD_SPANS):
+        with zipkin_span(
+            service_name='downstream',
+            span_name=f'call_{i}',
+            binary_annotations=dict(TAGS, index=str(i)),
+        ):
+            pass
+    return Response('ok')
+
+
+def make_app(firehose_handler):
+    settings = {
+        'service_name': 'benchmark',
+        'zipkin.tracing_percent': 100,
+        'zipkin.transport_handler': NullTransport(),
+    }
+    if firehose_handler is not None:
+        settings['zipkin.firehose_handler'] = firehose_handler
+    config = Configurator(settings=settings)
+    config.include('pyramid_zipkin')
+    config.add_route('fan_out', '/fan_out')
+    config.add_view(fan_out, route_name='fan_out')
+    return config.make_wsgi_app()
+
+
+def run(app, requests):
+    start = time.process_time()
+    for _ in range(requests):
+        Request.blank('/fan_out').get_response(app)
+    return (time.process_time() - start) / requests * 1000
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    spans = make_spans()
+    shared = FanOutTransport([NullTransport(), NullTransport()])
+    for name, handlers in (
+        ('per handler', [NullTransport(), NullTransport()]),
+        ('shared', [shared]),
+    ):
+        encode(handlers, spans, 100)  # warm up
+        print(f'{name:>15}: {encode(handlers, spans, requests):.3f}ms '
+              'encoding CPU per request')
+    for name, firehose_handler in (
+        ('no firehose', None),
+        ('firehose', NullTransport()),
+    ):
+        app = make_app(firehose_handler)
+        run(app, 100)  # warm up
+        print(f'{name:>15}: {run(app, requests):.3f}ms CPU per request')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Cost of building the propagation headers for 50 downstream calls, with
+py_zipkin's create_http_headers_for_new_span vs pyramid_zipkin's
+create_http_headers_for_request. Run with:
+
+    python benchmarks/http_headers.py
+"""
+import timeit
+
+from py_zipkin.storage import get_default_tracer
+from py_zipkin.util import ZipkinAttrs
+from py_zipkin.zipkin import create_http_headers_for_new_span
+from pyramid.request import Request
+
+from pyramid_zipkin.request_helper import create_http_headers_for_request
+
+
+CALLS = 50
+
+
+def main():
+    number = 2000
+    tracer = get_default_tracer()
+    for is_sampled in (False, True):
+        zipkin_attrs = ZipkinAttrs('a' * 32, 'b' * 16, None, '0', is_sampled)
+        tracer.push_zipkin_attrs(zipkin_attrs)
+
+        def py_zipkin():
+            for _ in range(CALLS):
+                create_http_headers_for_new_span()
+
+        request = Request.blank('/')
+
+        def pyramid_zipkin():
+            # New request, the headers haven't been built yet.
+            request.__dict__.pop('_zipkin_http_headers', None)
+            for _ in range(CALLS):
+                create_http_headers_for_request(request)
+
+        for name, func in (
+            ('py_zipkin', py_zipkin),
+            ('pyramid_zipkin', pyramid_zipkin),
+        ):
+            seconds = min(timeit.repeat(func, number=number, repeat=5))
+            print(
+                f'sampled={is_sampled!s:>5} {name:>14}: '
+                f'{seconds / number * 1e6:.1f}us per {CALLS} calls'
+            )
+        tracer.pop_zipkin_attrs()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Per-request overhead of zipkin.trace_request_phases, on the acceptance
+app's /phases/pets/42 route which goes through route matching, traversal,
+a view and a renderer. Run from the root of the repo with:
+
+    python -m benchmarks.request_phases [requests]
+"""
+import sys
+import timeit
+
+from pyramid.request import Request
+
+from tests.acceptance.test_helper import generate_app_main
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for tracing_percent in (0, 100):
+        for mode in (None, 'annotations', 'spans'):
+            settings = {'zipkin.tracing_percent': tracing_percent}
+            if mode:
+                settings['zipkin.trace_request_phases'] = mode
+            app_main, transport, _ = generate_app_main(settings)
+
+            def request():
+                Request.blank('/phases/pets/42').get_response(app_main)
+                transport.output.clear()
+
+            seconds = min(timeit.repeat(request, number=number, repeat=5))
+            print(
+                f'sampled={tracing_percent == 100!s:>5} '
+                f'phases={mode or "off":>11}: '
+                f'{seconds / number * 1e6:.1f}us per request'
+            )
+
+
+if __name__ == '__main__':
+    main()
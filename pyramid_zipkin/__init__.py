@@ -1,9 +1,29 @@
-from pyramid.config import Configurator
-from pyramid.tweens import INGRESS
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:  # pragma: no cover
+    from pyramid.config import Configurator
 
-def includeme(config: Configurator) -> None:  # pragma: no cover
+
+def includeme(config: 'Configurator') -> None:
     """
     :type config: :class:`pyramid.config.Configurator`
     """
+    # Imported here so that importing the package doesn't import Pyramid's
+    # configuration machinery, which the configurator has loaded by now.
+    from pyramid.tweens import INGRESS
+
+    from pyramid_zipkin.tween import _register_compiled_settings
+
     config.add_tween('pyramid_zipkin.tween.zipkin_tween', under=INGRESS)
+    # Compiled once all the settings are known, so that they're validated
+    # when the app starts rather than on its first request.
+    config.action(
+        'pyramid_zipkin.settings',
+        _register_compiled_settings,
+        args=(config.registry,),
+    )
+    settings = config.get_settings()
+    if settings.get('zipkin.trace_request_phases'):
+        config.include('pyramid_zipkin.phases')
+    if settings.get('zipkin.trace_renderers'):
+        config.include('pyramid_zipkin.renderers')
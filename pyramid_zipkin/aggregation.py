@@ -0,0 +1,113 @@
+"""Aggregation of repeated child spans.
+
+A view making hundreds of similar calls, e.g. to a cache, records as many
+child spans, which then make most of the payload sent to the collector and
+of what it stores. With `zipkin.aggregate_spans_min_count`, every run of
+that many consecutive sibling spans or more with the same name and service
+is replaced with a single span, right before the spans are emitted.
+
+The aggregated span keeps the ids, annotations and tags of the first span of
+the run, so that the children of the latter keep their parent, and lasts
+from the start of the first span to the end of the last one. It's tagged
+with the number of spans it replaces and their total, min and max durations.
+"""
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from py_zipkin.encoding._helpers import Span
+
+
+COUNT_TAG = 'zipkin.aggregate.count'
+TOTAL_DURATION_TAG = 'zipkin.aggregate.total_duration_ms'
+MIN_DURATION_TAG = 'zipkin.aggregate.min_duration_ms'
+MAX_DURATION_TAG = 'zipkin.aggregate.max_duration_ms'
+
+_AggregationKey = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+def aggregate_spans(
+    spans: Iterable[Span],
+    min_count: int,
+    max_duration: Optional[float] = None,
+) -> List[Span]:
+    """Replaces the runs of similar spans with aggregated spans.
+
+    Spans are stored when they end, so the spans of a run are consecutive
+    siblings: a child of one of them, but the first, would end between two
+    of them.
+
+    :param spans: the spans, in the order they ended.
+    :param min_count: min number of spans in a run for it to be aggregated.
+    :param max_duration: spans that took longer than this many seconds are
+        kept as they are, and end the run they would be part of.
+    :returns: the spans, in the same order.
+    """
+    aggregated: List[Span] = []
+    run: List[Span] = []
+    run_key: Optional[_AggregationKey] = None
+    for span in spans:
+        key = _aggregation_key(span, max_duration)
+        if key is not None and key == run_key:
+            run.append(span)
+            continue
+        _add_run(run, min_count, aggregated)
+        run = [span]
+        run_key = key
+    _add_run(run, min_count, aggregated)
+    return aggregated
+
+
+def _aggregation_key(
+    span: Span,
+    max_duration: Optional[float],
+) -> Optional[_AggregationKey]:
+    if max_duration is not None and (span.duration or 0.0) > max_duration:
+        return None
+    service_name = span.local_endpoint.service_name \
+        if span.local_endpoint else None
+    return span.parent_id, span.name, service_name
+
+
+def _add_run(run: List[Span], min_count: int, spans: List[Span]) -> None:
+    if len(run) < min_count:
+        spans.extend(run)
+    else:
+        spans.append(_merge(run))
+
+
+def _merge(run: List[Span]) -> Span:
+    first = run[0]
+    start = first.timestamp or 0.0
+    durations = [span.duration or 0.0 for span in run]
+    end = max(
+        (span.timestamp or start) + duration
+        for span, duration in zip(run, durations)
+    )
+    tags = dict(first.tags)
+    tags.update({
+        COUNT_TAG: str(len(run)),
+        TOTAL_DURATION_TAG: _format_ms(sum(durations)),
+        MIN_DURATION_TAG: _format_ms(min(durations)),
+        MAX_DURATION_TAG: _format_ms(max(durations)),
+    })
+    return Span(
+        trace_id=first.trace_id,
+        name=first.name,
+        parent_id=first.parent_id,
+        span_id=first.span_id,
+        kind=first.kind,
+        timestamp=first.timestamp,
+        duration=end - start,
+        local_endpoint=first.local_endpoint,
+        remote_endpoint=first.remote_endpoint,
+        debug=first.debug,
+        shared=first.shared,
+        annotations=dict(first.annotations),
+        tags=tags,
+    )
+
+
+def _format_ms(duration: float) -> str:
+    return f'{duration * 1000:.3f}'
@@ -0,0 +1,181 @@
+"""Instrumented HTTP client, the client-side counterpart of the tween.
+
+:class:`ZipkinSession` is a :class:`requests.Session` that keeps a pool of
+connections per host and records a CLIENT span for every request it sends
+while a sampled Pyramid request is being traced. Requires the ``requests``
+package, e.g. ``pip install pyramid_zipkin[client]``.
+
+.. code-block:: python
+
+    session = session_from_settings(config.get_settings())
+
+    def view(request):
+        return session.get('http://inventory/items', timeout=1).json()
+"""
+import time
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from urllib.parse import SplitResult
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
+
+import requests
+from py_zipkin import Kind
+from py_zipkin.encoding._helpers import create_endpoint
+from py_zipkin.encoding._helpers import Endpoint
+from py_zipkin.encoding._helpers import Span
+from py_zipkin.exception import ZipkinError
+from py_zipkin.storage import get_default_tracer
+from py_zipkin.util import generate_random_64bit_string
+from requests.adapters import HTTPAdapter
+
+
+# Bounds the remote endpoints cache in case the session is used to call
+# an unbounded number of hosts.
+_MAX_CACHED_ENDPOINTS = 1024
+
+
+class ZipkinSession(requests.Session):
+    """Session that records a CLIENT span, child of the current span, for
+    every request it sends and adds the B3 propagation headers to it.
+
+    If there's no current trace the request is sent as is. If the trace isn't
+    recorded only the propagation headers are added, so that the downstream
+    service knows the request isn't sampled.
+
+    :param service_name: name of this service, as in the `service_name`
+        setting.
+    :param pool_connections: number of hosts to keep a connection pool for.
+    :param pool_maxsize: max number of connections kept per host.
+    :param max_retries: retries for failed connections, passed to
+        :class:`requests.adapters.HTTPAdapter`.
+    """
+
+    def __init__(
+        self,
+        service_name: str = 'unknown',
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        max_retries: int = 0,
+    ) -> None:
+        super().__init__()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=max_retries,
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        # The spans' local endpoint is replaced with the server span's one
+        # when they're emitted, only the service name matters.
+        self.local_endpoint = create_endpoint(0, service_name, '127.0.0.1')
+        self._remote_endpoints: Dict[Tuple[str, int], Endpoint] = {}
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        **kwargs: Any,
+    ) -> requests.Response:
+        tracer = get_default_tracer()
+        zipkin_attrs = tracer.get_zipkin_attrs()
+        if zipkin_attrs is None:
+            return super().send(request, **kwargs)
+
+        span_id = generate_random_64bit_string()
+        parent_span_id = zipkin_attrs.span_id or ''
+        request.headers.update({
+            'X-B3-TraceId': zipkin_attrs.trace_id,
+            'X-B3-SpanId': span_id,
+            'X-B3-ParentSpanId': parent_span_id,
+            'X-B3-Flags': zipkin_attrs.flags or '0',
+            'X-B3-Sampled': '1' if zipkin_attrs.is_sampled else '0',
+        })
+        if not tracer.is_transport_configured():
+            return super().send(request, **kwargs)
+
+        request_url = request.url or ''
+        url = urlsplit(request_url)
+        host = url.hostname or ''
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        tags: Dict[str, Optional[str]] = {
+            'http.request.method': request.method,
+            'url.full': _url_without_userinfo(request_url, url),
+            'server.address': host,
+            'server.port': str(port),
+        }
+        start = time.time()
+        try:
+            response = super().send(request, **kwargs)
+        except Exception as e:
+            tags['error.type'] = type(e).__name__
+            raise
+        else:
+            tags['http.response.status_code'] = str(response.status_code)
+            return response
+        finally:
+            tracer.add_span(Span(
+                trace_id=zipkin_attrs.trace_id,
+                name=f'{request.method} {host}',
+                parent_id=parent_span_id,
+                span_id=span_id,
+                kind=Kind.CLIENT,
+                timestamp=start,
+                duration=time.time() - start,
+                local_endpoint=self.local_endpoint,
+                remote_endpoint=self._remote_endpoint(host, port),
+                tags=tags,
+            ))
+
+    def _remote_endpoint(self, host: str, port: int) -> Endpoint:
+        endpoint = self._remote_endpoints.get((host, port))
+        if endpoint is None:
+            endpoint = create_endpoint(port, host, host, use_defaults=False)
+            if len(self._remote_endpoints) >= _MAX_CACHED_ENDPOINTS:
+                self._remote_endpoints.clear()
+            self._remote_endpoints[(host, port)] = endpoint
+        return endpoint
+
+
+def _url_without_userinfo(request_url: str, url: SplitResult) -> str:
+    # Credentials in the URL must not end up in the spans.
+    if '@' not in url.netloc:
+        return request_url
+    netloc = url.netloc.rpartition('@')[2]
+    return urlunsplit(url._replace(netloc=netloc))
+
+
+def _int_setting(settings: Dict[str, Any], name: str, default: int) -> int:
+    try:
+        return int(settings.get(name, default))
+    except (TypeError, ValueError):
+        raise ZipkinError(f'`{name}` must be an integer')
+
+
+def session_from_settings(settings: Dict[str, Any]) -> ZipkinSession:
+    """Creates a :class:`ZipkinSession` configured from the Pyramid registry
+    settings. Create one per process, or per thread if you'd rather not share
+    the connection pools between threads.
+
+    Here are the supported settings:
+
+    service_name: name of this service, same as for the tween.
+    zipkin.client.pool_connections: number of hosts to keep a connection pool
+        for. Defaults to 10.
+    zipkin.client.pool_maxsize: max number of connections kept per host.
+        Defaults to 10.
+    zipkin.client.max_retries: retries for failed connections. Defaults to 0.
+
+    :raises ZipkinError: if a setting is invalid.
+    """
+    return ZipkinSession(
+        service_name=settings.get('service_name', 'unknown'),
+        pool_connections=_int_setting(
+            settings,
+            'zipkin.client.pool_connections',
+            10,
+        ),
+        pool_maxsize=_int_setting(settings, 'zipkin.client.pool_maxsize', 10),
+        max_retries=_int_setting(settings, 'zipkin.client.max_retries', 0),
+    )
@@ -0,0 +1,55 @@
+"""A `contextvars` based context stack for the Zipkin attributes.
+
+py_zipkin's default tracer already lives in a context variable, but its
+context stack is a plain list. Code that copies the current context, like
+asyncio tasks, `loop.run_in_executor` with `contextvars.copy_context()` or
+gevent's greenlets, ends up sharing that list and pushing and popping each
+other's spans. :class:`ContextVarStack` keeps the stack itself in a context
+variable, as an immutable tuple, so that every copy of the context gets its
+own view of it.
+"""
+from contextvars import ContextVar
+from typing import Optional
+from typing import Tuple
+
+from py_zipkin.storage import Stack
+from py_zipkin.util import ZipkinAttrs
+
+
+_zipkin_attrs_stack: ContextVar[Tuple[ZipkinAttrs, ...]] = ContextVar(
+    'pyramid_zipkin.zipkin_attrs_stack',
+    default=(),
+)
+
+
+class ContextVarStack(Stack):
+    """Context stack stored in a context variable. All the instances share
+    the same context variable, so a single one is enough per process.
+    """
+
+    def push(self, item: ZipkinAttrs) -> None:
+        _zipkin_attrs_stack.set(_zipkin_attrs_stack.get() + (item,))
+
+    def pop(self) -> Optional[ZipkinAttrs]:
+        stack = _zipkin_attrs_stack.get()
+        if not stack:
+            return None
+        _zipkin_attrs_stack.set(stack[:-1])
+        return stack[-1]
+
+    def get(self) -> Optional[ZipkinAttrs]:
+        stack = _zipkin_attrs_stack.get()
+        return stack[-1] if stack else None
+
+    def copy(self) -> Stack:
+        """Returns a plain :class:`Stack` with the current content, which is
+        what py_zipkin's `Tracer.copy` expects when handing a tracer over to
+        a new thread, where the context variable would be empty.
+        """
+        the_copy = Stack()
+        for item in _zipkin_attrs_stack.get():
+            the_copy.push(item)
+        return the_copy
+
+
+context_var_stack = ContextVarStack()
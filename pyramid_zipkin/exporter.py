@@ -0,0 +1,309 @@
+"""Shared span exporter for pre-fork servers.
+
+Under gunicorn or uwsgi every worker process normally holds its own transport
+connection and its own buffers. Instead, workers can be configured with a
+:class:`UnixSocketTransport`, which writes each encoded payload as a single
+datagram to a local Unix-domain socket. One :class:`SpanExporter` process,
+usually started from the master with :func:`start_span_exporter` before the
+workers are forked, reads those datagrams, merges payloads coming from all the
+workers into larger batches and ships them with the real transport handler.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from types import FrameType
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+from typing import Union
+
+from py_zipkin import Encoding
+from py_zipkin.transport import BaseTransportHandler
+
+if TYPE_CHECKING:  # pragma: no cover
+    from multiprocessing.synchronize import Event
+
+
+log = logging.getLogger(__name__)
+
+# Unix datagrams are bounded by the socket send buffer, which defaults to
+# ~200KB on Linux. py_zipkin splits span batches so that each payload fits.
+DEFAULT_MAX_DATAGRAM_BYTES = 65536
+
+# Size of the exporter's receive buffer. A larger datagram would be truncated.
+MAX_DATAGRAM_BYTES = DEFAULT_MAX_DATAGRAM_BYTES * 4
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+DEFAULT_MAX_BATCH_BYTES = 1024 * 1024
+
+_STOP_POLL_INTERVAL = 0.1
+
+
+class UnixSocketTransport(BaseTransportHandler):
+    """Transport that hands encoded payloads to a local :class:`SpanExporter`.
+
+    Sending never blocks the request: if the exporter is not running or its
+    receive buffer is full the payload is dropped and counted in `dropped`.
+    The socket is created lazily and re-created after a fork, so the same
+    instance can be configured in the master and used by every worker.
+
+    :param socket_path: filesystem path the exporter is bound to.
+    :param max_payload_bytes: max size of a single datagram, at most
+        `MAX_DATAGRAM_BYTES`.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        max_payload_bytes: int = DEFAULT_MAX_DATAGRAM_BYTES,
+    ) -> None:
+        if max_payload_bytes > MAX_DATAGRAM_BYTES:
+            raise ValueError(
+                f'max_payload_bytes must be at most {MAX_DATAGRAM_BYTES}, the'
+                f' size of the exporter\'s receive buffer, not'
+                f' {max_payload_bytes}'
+            )
+        super().__init__()
+        self.socket_path = socket_path
+        self.max_payload_bytes = max_payload_bytes
+        self.dropped = 0
+        self._socket: Optional[socket.socket] = None
+        self._pid: Optional[int] = None
+
+    def get_max_payload_bytes(self) -> Optional[int]:
+        return self.max_payload_bytes
+
+    def _get_socket(self) -> socket.socket:
+        pid = os.getpid()
+        if self._socket is None or self._pid != pid:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._socket = sock
+            self._pid = pid
+        return self._socket
+
+    def send(self, payload: Union[bytes, str]) -> None:
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        try:
+            self._get_socket().sendto(payload, self.socket_path)
+        except OSError:
+            # Exporter down, receive buffer full or oversized payload. Tracing
+            # must never fail the request, so just account for the loss.
+            self.dropped += 1
+
+    def close(self) -> None:
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class SpanExporter:
+    """Receives payloads from :class:`UnixSocketTransport` and ships them in
+    batches through `transport_handler`.
+
+    Payloads from different workers are merged into a single encoded list, so
+    the exporter needs to know the `encoding` the workers use. A batch is
+    flushed when adding a payload would make it larger than `max_batch_bytes`
+    (or than the transport's max payload size), or when `flush_interval`
+    seconds have passed since the oldest buffered payload was received. The
+    errors of the transport are logged and the batches it failed to ship are
+    counted in `failed_batches`.
+
+    :param socket_path: filesystem path to bind to. A stale socket file left
+        behind by a previous exporter is removed.
+    :param transport_handler: the transport used to ship the merged batches.
+    :param encoding: encoding of the payloads sent by the workers.
+    :param flush_interval: max seconds a payload waits in the buffer.
+    :param max_batch_bytes: max size of a merged batch.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        transport_handler: BaseTransportHandler,
+        encoding: Encoding = Encoding.V2_JSON,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_batch_bytes: int = DEFAULT_MAX_BATCH_BYTES,
+    ) -> None:
+        if encoding == Encoding.V1_THRIFT:
+            raise ValueError(f'{encoding} payloads cannot be merged')
+        self.socket_path = socket_path
+        self.transport_handler = transport_handler
+        self.encoding = encoding
+        self.flush_interval = flush_interval
+
+        transport_max = None
+        if isinstance(transport_handler, BaseTransportHandler):
+            transport_max = transport_handler.get_max_payload_bytes()
+        if transport_max is not None:
+            max_batch_bytes = min(max_batch_bytes, transport_max)
+        self.max_batch_bytes = max_batch_bytes
+
+        self._buffer: List[bytes] = []
+        self._buffer_size = 0
+        self._oldest: Optional[float] = None
+        self._running = True
+        self.failed_batches = 0
+
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(socket_path)
+
+    def _merged_size(self, payload: bytes) -> int:
+        if self.encoding == Encoding.V2_PROTO3:
+            return self._buffer_size + len(payload)
+        # '[' + ','.join(parts) + ']' with one more comma for the new part
+        return self._buffer_size + len(payload) + len(self._buffer) + 2
+
+    def add_payload(self, payload: bytes) -> None:
+        """Buffers one payload received from a worker."""
+        if self.encoding != Encoding.V2_PROTO3:
+            # Strip the enclosing '[' and ']' of the JSON list.
+            payload = payload.strip()[1:-1]
+        if not payload:
+            return
+
+        if self._buffer and self._merged_size(payload) > self.max_batch_bytes:
+            self.flush()
+
+        self._buffer.append(payload)
+        self._buffer_size += len(payload)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def flush(self) -> None:
+        """Ships everything buffered so far as a single payload."""
+        if not self._buffer:
+            return
+        if self.encoding == Encoding.V2_PROTO3:
+            message = b''.join(self._buffer)
+        else:
+            message = b'[' + b','.join(self._buffer) + b']'
+        self._buffer = []
+        self._buffer_size = 0
+        self._oldest = None
+        try:
+            self.transport_handler(message)
+        except Exception:
+            # The exporter serves every worker, it must keep running.
+            self.failed_batches += 1
+            log.exception('Error shipping zipkin spans')
+
+    def _flush_if_due(self) -> None:
+        if (
+            self._oldest is not None and
+            time.monotonic() - self._oldest >= self.flush_interval
+        ):
+            self.flush()
+
+    def serve_forever(self) -> None:
+        """Receives and ships payloads until :meth:`stop` is called. Anything
+        still queued on the socket or buffered is flushed before returning.
+        """
+        # Wake up regularly so that stop() is honoured promptly.
+        self._socket.settimeout(min(self.flush_interval, _STOP_POLL_INTERVAL))
+        try:
+            while self._running:
+                try:
+                    payload = self._socket.recv(MAX_DATAGRAM_BYTES)
+                except socket.timeout:
+                    pass
+                else:
+                    self.add_payload(payload)
+                self._flush_if_due()
+        finally:
+            self._drain()
+            self.flush()
+
+    def _drain(self) -> None:
+        """Buffers whatever the workers sent that wasn't received yet."""
+        self._socket.setblocking(False)
+        while True:
+            try:
+                payload = self._socket.recv(MAX_DATAGRAM_BYTES)
+            except BlockingIOError:
+                return
+            self.add_payload(payload)
+
+    def stop(self) -> None:
+        self._running = False
+
+    def close(self) -> None:
+        self._socket.close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def _run_exporter(
+    socket_path: str,
+    transport_handler: BaseTransportHandler,
+    encoding: Encoding,
+    flush_interval: float,
+    max_batch_bytes: int,
+    ready: 'Event',
+) -> None:  # pragma: no cover (runs in a child process)
+    exporter = SpanExporter(
+        socket_path,
+        transport_handler,
+        encoding=encoding,
+        flush_interval=flush_interval,
+        max_batch_bytes=max_batch_bytes,
+    )
+
+    def _handle_sigterm(signum: int, frame: Optional[FrameType]) -> None:
+        exporter.stop()
+
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    ready.set()
+    try:
+        exporter.serve_forever()
+    finally:
+        exporter.close()
+
+
+def start_span_exporter(
+    socket_path: str,
+    transport_handler: BaseTransportHandler,
+    encoding: Encoding = Encoding.V2_JSON,
+    flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    max_batch_bytes: int = DEFAULT_MAX_BATCH_BYTES,
+    timeout: float = 5.0,
+) -> multiprocessing.Process:
+    """Starts a :class:`SpanExporter` in a daemon child process and waits
+    until its socket is bound.
+
+    Call it from the master process before the workers are forked, e.g. in
+    gunicorn's `on_starting` hook. Terminating the returned process flushes
+    the buffered spans before it exits.
+
+    :returns: the exporter process.
+    """
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=_run_exporter,
+        args=(
+            socket_path,
+            transport_handler,
+            encoding,
+            flush_interval,
+            max_batch_bytes,
+            ready,
+        ),
+        name='pyramid_zipkin-exporter',
+        daemon=True,
+    )
+    process.start()
+    if not ready.wait(timeout):
+        process.terminate()
+        raise RuntimeError(f'span exporter did not start within {timeout}s')
+    return process
@@ -0,0 +1,316 @@
+"""Per-route latency and status metrics, recorded for every request.
+
+Shipping every span with `zipkin.firehose_handler` just to get accurate
+latencies is expensive. A :class:`MetricsRecorder` set as
+`zipkin.metrics_recorder` (which ``config.include('pyramid_zipkin')`` creates
+if `zipkin.metrics_handler` is set) instead counts the requests of each
+route, sampled or not, by status class and in a log-bucketed latency
+histogram. The metrics recorded since the last export are handed over to the
+handler every `zipkin.metrics_interval` seconds:
+
+.. code-block:: python
+
+    def metrics_handler(snapshot):
+        for route, metrics in snapshot.items():
+            statsd.gauge(f'{route}.p99', metrics.latency.percentile(99))
+
+    settings['zipkin.metrics_handler'] = metrics_handler
+
+Histograms of different intervals or processes can be merged, e.g. after
+sending them as JSON with :meth:`RouteMetrics.to_dict`.
+"""
+import logging
+import math
+import os
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Mapping
+from typing import Optional
+
+from py_zipkin.exception import ZipkinError
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_METRICS_INTERVAL = 60.0
+
+# Name the requests that didn't match any route are recorded under.
+UNMATCHED_ROUTE = '__unmatched__'
+
+# Durations are rounded up to the next power of 2 ** (1 / 8), which keeps
+# the relative error under 9%, and anything faster than a microsecond is
+# recorded as a microsecond.
+_BUCKETS_PER_DOUBLING = 8
+_MIN_DURATION = 1e-6
+
+MetricsHandler = Callable[[Dict[str, 'RouteMetrics']], Any]
+
+
+class LatencyHistogram:
+    """Log-bucketed histogram of durations, in seconds."""
+
+    def __init__(self) -> None:
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration: float) -> None:
+        index = _bucket_index(duration)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        """Upper bound of the bucket holding the given percentile, or 0 if
+        nothing was recorded.
+        """
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= max(rank, 1):
+                return min(_bucket_upper_bound(index), self.max)
+        return 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'buckets': {str(index): n for index, n in self.buckets.items()},
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'LatencyHistogram':
+        histogram = cls()
+        histogram.buckets = {
+            int(index): count for index, count in data['buckets'].items()
+        }
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.max = data['max']
+        return histogram
+
+
+class RouteMetrics:
+    """Latency histogram and number of responses by status class, e.g.
+    `'2xx'`, of a route, plus the histograms of the time spent in the user's
+    hooks, e.g. `post_handler_hook`, and of the time requests spent queued
+    upstream, see `zipkin.request_start_header`.
+    """
+
+    def __init__(self) -> None:
+        self.latency = LatencyHistogram()
+        self.statuses: Dict[str, int] = {}
+        self.hooks: Dict[str, LatencyHistogram] = {}
+        self.queue_time = LatencyHistogram()
+
+    def record(
+        self,
+        duration: float,
+        status_code: int,
+        hook_durations: Optional[Mapping[str, float]] = None,
+        queue_duration: Optional[float] = None,
+    ) -> None:
+        self.latency.record(duration)
+        if queue_duration is not None:
+            self.queue_time.record(queue_duration)
+        status_class = f'{status_code // 100}xx'
+        self.statuses[status_class] = self.statuses.get(status_class, 0) + 1
+        if hook_durations:
+            for hook, hook_duration in hook_durations.items():
+                self._hook_histogram(hook).record(hook_duration)
+
+    def _hook_histogram(self, hook: str) -> LatencyHistogram:
+        histogram = self.hooks.get(hook)
+        if histogram is None:
+            histogram = self.hooks[hook] = LatencyHistogram()
+        return histogram
+
+    def merge(self, other: 'RouteMetrics') -> None:
+        self.latency.merge(other.latency)
+        for status_class, count in other.statuses.items():
+            self.statuses[status_class] = \
+                self.statuses.get(status_class, 0) + count
+        for hook, histogram in other.hooks.items():
+            self._hook_histogram(hook).merge(histogram)
+        self.queue_time.merge(other.queue_time)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'latency': self.latency.to_dict(),
+            'statuses': dict(self.statuses),
+            'hooks': {
+                hook: histogram.to_dict()
+                for hook, histogram in self.hooks.items()
+            },
+            'queue_time': self.queue_time.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'RouteMetrics':
+        metrics = cls()
+        metrics.latency = LatencyHistogram.from_dict(data['latency'])
+        metrics.statuses = dict(data['statuses'])
+        metrics.hooks = {
+            hook: LatencyHistogram.from_dict(histogram)
+            for hook, histogram in data.get('hooks', {}).items()
+        }
+        if 'queue_time' in data:
+            metrics.queue_time = LatencyHistogram.from_dict(data['queue_time'])
+        return metrics
+
+
+class MetricsRecorder:
+    """Records the metrics of every request by route, and periodically
+    exports the ones recorded since the previous export once started.
+
+    :param handler: called with the route names mapped to their
+        :class:`RouteMetrics`, unless no request was recorded.
+    :param interval: seconds between two exports.
+    """
+
+    def __init__(
+        self,
+        handler: MetricsHandler,
+        interval: float = DEFAULT_METRICS_INTERVAL,
+    ) -> None:
+        self.handler = handler
+        self.interval = interval
+        self._metrics: Dict[str, RouteMetrics] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._fork_hook_registered = False
+
+    def record(
+        self,
+        route_name: Optional[str],
+        duration: float,
+        status_code: int,
+        hook_durations: Optional[Mapping[str, float]] = None,
+        queue_duration: Optional[float] = None,
+    ) -> None:
+        route_name = route_name or UNMATCHED_ROUTE
+        with self._lock:
+            metrics = self._metrics.get(route_name)
+            if metrics is None:
+                metrics = self._metrics[route_name] = RouteMetrics()
+            metrics.record(
+                duration,
+                status_code,
+                hook_durations,
+                queue_duration,
+            )
+
+    def snapshot(self) -> Dict[str, RouteMetrics]:
+        """Returns the metrics recorded since the previous snapshot."""
+        with self._lock:
+            metrics, self._metrics = self._metrics, {}
+        return metrics
+
+    def export(self) -> None:
+        """Hands over a snapshot to the handler. Its errors are logged."""
+        metrics = self.snapshot()
+        if not metrics:
+            return
+        try:
+            self.handler(metrics)
+        except Exception:
+            log.exception('Error exporting zipkin metrics')
+
+    def start(self) -> None:
+        """Starts a daemon thread that exports the metrics every `interval`
+        seconds. The thread is restarted in forked children.
+        """
+        if self._thread is not None:
+            return
+        self._start_thread()
+        if not self._fork_hook_registered:
+            self._fork_hook_registered = True
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def stop(self) -> None:
+        """Stops the thread, and exports what was recorded since the last
+        export.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def _start_thread(self) -> None:
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(self._stop,),
+            name='pyramid_zipkin-metrics',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, stop: threading.Event) -> None:
+        while not stop.wait(self.interval):
+            self.export()
+
+    def _after_fork(self) -> None:
+        # The parent exports what it recorded before the fork, and the lock
+        # may have been held by one of its threads.
+        self._lock = threading.Lock()
+        self._metrics = {}
+        if self._thread is not None:
+            self._start_thread()
+
+
+def _bucket_index(duration: float) -> int:
+    if duration <= _MIN_DURATION:
+        return 0
+    return math.ceil(
+        math.log2(duration / _MIN_DURATION) * _BUCKETS_PER_DOUBLING,
+    )
+
+
+def _bucket_upper_bound(index: int) -> float:
+    return float(_MIN_DURATION * 2 ** (index / _BUCKETS_PER_DOUBLING))
+
+
+def metrics_recorder_from_settings(settings: Dict[str, Any]) -> MetricsRecorder:
+    """Creates and starts a :class:`MetricsRecorder` configured from the
+    Pyramid registry settings.
+
+    Here are the supported settings:
+
+    zipkin.metrics_handler: called with the metrics recorded since the
+        previous call.
+    zipkin.metrics_interval: seconds between two calls. Defaults to 60.
+
+    :raises ZipkinError: if a setting is invalid.
+    """
+    handler = settings.get('zipkin.metrics_handler')
+    if not callable(handler):
+        raise ZipkinError(
+            f'`zipkin.metrics_handler` must be callable, not {handler!r}'
+        )
+    try:
+        interval = float(settings.get(
+            'zipkin.metrics_interval',
+            DEFAULT_METRICS_INTERVAL,
+        ))
+    except (TypeError, ValueError):
+        raise ZipkinError('`zipkin.metrics_interval` must be a number')
+    recorder = MetricsRecorder(handler, interval)
+    recorder.start()
+    return recorder
@@ -0,0 +1,178 @@
+"""Records how long each phase of Pyramid's request processing took.
+
+Include this module with ``config.include('pyramid_zipkin.phases')`` and set
+``zipkin.trace_request_phases`` to ``'annotations'`` or ``'spans'``. The
+phases are delimited by Pyramid's events:
+
+- route_match: from NewRequest to BeforeTraversal.
+- traversal: from BeforeTraversal to ContextFound, including the root factory.
+- view: from ContextFound to BeforeRender, including the security checks.
+- render: from BeforeRender until the response is returned to the tween.
+
+The phases are only recorded for sampled requests. If the setting isn't set
+no subscriber is registered at all.
+"""
+import time
+from typing import Dict
+from typing import Optional
+
+from py_zipkin import Kind
+from py_zipkin.encoding._helpers import Span
+from py_zipkin.exception import ZipkinError
+from py_zipkin.storage import Tracer
+from py_zipkin.util import generate_random_64bit_string
+from py_zipkin.zipkin import zipkin_span
+from pyramid.config import Configurator
+from pyramid.events import BeforeRender
+from pyramid.events import BeforeTraversal
+from pyramid.events import ContextFound
+from pyramid.events import NewRequest
+from pyramid.request import Request
+
+from pyramid_zipkin.request_helper import is_sampled
+
+
+PHASES_AS_ANNOTATIONS = 'annotations'
+PHASES_AS_SPANS = 'spans'
+
+
+class RequestPhases:
+    """Records the phases of a single request on its server span, either as
+    annotations set when each phase starts or as child spans.
+
+    :param zipkin_context: the request's server span.
+    :param tracer: the tracer the server span belongs to.
+    :param as_spans: whether to record child spans rather than annotations.
+    """
+
+    def __init__(
+        self,
+        zipkin_context: zipkin_span,
+        tracer: Tracer,
+        as_spans: bool,
+    ) -> None:
+        self.zipkin_context = zipkin_context
+        self.tracer = tracer
+        self.as_spans = as_spans
+        self._phase: Optional[str] = None
+        self._phase_start = 0.0
+
+    def start(self, phase: str) -> None:
+        """Ends the current phase, if any, and starts a new one."""
+        if phase == self._phase:
+            # e.g. templates rendered by other templates.
+            return
+        now = time.time()
+        if not self.as_spans:
+            self.zipkin_context.add_annotation(f'pyramid.{phase}', now)
+        elif self._phase is not None:
+            self._add_span(now)
+        self._phase = phase
+        self._phase_start = now
+
+    def finish(self) -> None:
+        """Ends the last phase, once the response is back in the tween."""
+        now = time.time()
+        if not self.as_spans:
+            self.zipkin_context.add_annotation('pyramid.response', now)
+        elif self._phase is not None:
+            self._add_span(now)
+            self._phase = None
+
+    def _add_span(self, end_timestamp: float) -> None:
+        add_local_span(
+            self.zipkin_context,
+            self.tracer,
+            f'pyramid.{self._phase}',
+            self._phase_start,
+            end_timestamp,
+        )
+
+
+def add_local_span(
+    zipkin_context: zipkin_span,
+    tracer: Tracer,
+    name: str,
+    start_timestamp: float,
+    end_timestamp: float,
+    tags: Optional[Dict[str, Optional[str]]] = None,
+) -> None:
+    """Records a LOCAL child span of a sampled server span, for an operation
+    that has already been timed. Cheaper than a `zipkin_span` context.
+    Nothing is recorded if the server span isn't going to be emitted.
+    """
+    zipkin_attrs = zipkin_context.zipkin_attrs
+    logging_context = zipkin_context.logging_context
+    if zipkin_attrs is None or logging_context is None:
+        return
+    tracer.add_span(Span(
+        trace_id=zipkin_attrs.trace_id,
+        name=name,
+        parent_id=zipkin_attrs.span_id,
+        span_id=generate_random_64bit_string(),
+        kind=Kind.LOCAL,
+        timestamp=start_timestamp,
+        duration=end_timestamp - start_timestamp,
+        local_endpoint=logging_context.endpoint,
+        tags=tags,
+    ))
+
+
+def start_request_phases(
+    request: Request,
+    zipkin_context: zipkin_span,
+    tracer: Tracer,
+    mode: Optional[str],
+) -> Optional[RequestPhases]:
+    """Attaches a :class:`RequestPhases` to the request if its phases are to
+    be recorded.
+    """
+    if not mode or not is_sampled(zipkin_context):
+        return None
+    request_phases = RequestPhases(
+        zipkin_context,
+        tracer,
+        as_spans=mode == PHASES_AS_SPANS,
+    )
+    request.zipkin_request_phases = request_phases
+    return request_phases
+
+
+def _start_phase(request: Optional[Request], phase: str) -> None:
+    request_phases = getattr(request, 'zipkin_request_phases', None)
+    if request_phases is not None:
+        request_phases.start(phase)
+
+
+def _on_new_request(event: NewRequest) -> None:
+    _start_phase(event.request, 'route_match')
+
+
+def _on_before_traversal(event: BeforeTraversal) -> None:
+    _start_phase(event.request, 'traversal')
+
+
+def _on_context_found(event: ContextFound) -> None:
+    _start_phase(event.request, 'view')
+
+
+def _on_before_render(event: BeforeRender) -> None:
+    _start_phase(event.get('request'), 'render')
+
+
+def includeme(config: Configurator) -> None:
+    """Registers the event subscribers if `zipkin.trace_request_phases` is
+    set.
+    """
+    mode = config.get_settings().get('zipkin.trace_request_phases')
+    if not mode:
+        return
+    if mode not in (PHASES_AS_ANNOTATIONS, PHASES_AS_SPANS):
+        raise ZipkinError(
+            '`zipkin.trace_request_phases` must be '
+            f'{PHASES_AS_ANNOTATIONS!r} or {PHASES_AS_SPANS!r}, not {mode!r}'
+        )
+    config.add_subscriber(_on_new_request, NewRequest)
+    config.add_subscriber(_on_before_traversal, BeforeTraversal)
+    config.add_subscriber(_on_context_found, ContextFound)
+    config.add_subscriber(_on_before_render, BeforeRender)
@@ -0,0 +1,133 @@
+"""Times the renderers of sampled requests.
+
+Include this module with ``config.include('pyramid_zipkin.renderers')`` and
+set ``zipkin.trace_renderers`` to ``'annotations'`` or ``'spans'``. Every
+renderer factory registered with ``config.add_renderer``, including Pyramid's
+default ``json`` and ``string`` ones, is then wrapped so that rendering a
+sampled request records how long the renderer took and how big its output
+is.
+"""
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+
+from py_zipkin.exception import ZipkinError
+from py_zipkin.storage import get_default_tracer
+from pyramid.config import Configurator
+from pyramid.interfaces import IRendererFactory
+from pyramid.interfaces import PHASE2_CONFIG
+from pyramid.registry import Registry
+
+from pyramid_zipkin.phases import add_local_span
+from pyramid_zipkin.phases import PHASES_AS_ANNOTATIONS
+from pyramid_zipkin.phases import PHASES_AS_SPANS
+
+
+Renderer = Callable[[Any, Dict[str, Any]], Any]
+
+
+class TracedRendererFactory:
+    """Wraps a renderer factory so that the renderers it creates are timed.
+
+    With `as_spans`, each render is recorded as a LOCAL child span named
+    `render <name>`. Otherwise the `pyramid.renderer`,
+    `pyramid.render.duration_ms` and `pyramid.render.size` tags are set on the
+    server span. The size is the number of bytes of the renderer's output,
+    text being encoded with the response's charset like Pyramid does.
+
+    :param factory: the original renderer factory.
+    :param name: the name the factory is registered with.
+    :param as_spans: whether to record child spans rather than tags.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[Any], Renderer],
+        name: str,
+        as_spans: bool,
+    ) -> None:
+        self.factory = factory
+        self.name = name
+        self.as_spans = as_spans
+
+    def __call__(self, info: Any) -> Renderer:
+        renderer = self.factory(info)
+
+        def render(value: Any, system: Dict[str, Any]) -> Any:
+            zipkin_context = getattr(
+                system.get('request'),
+                'zipkin_server_span',
+                None,
+            )
+            if zipkin_context is None:
+                return renderer(value, system)
+
+            start = time.time()
+            result = renderer(value, system)
+            end = time.time()
+
+            size = _get_size(result, system['request'])
+            if self.as_spans:
+                add_local_span(
+                    zipkin_context,
+                    get_default_tracer(),
+                    f'render {self.name}',
+                    start,
+                    end,
+                    tags={'pyramid.render.size': size},
+                )
+            else:
+                zipkin_context.update_binary_annotations({
+                    'pyramid.renderer': self.name,
+                    'pyramid.render.duration_ms': f'{(end - start) * 1000:.3f}',
+                    'pyramid.render.size': size,
+                })
+            return result
+
+        return render
+
+
+def _get_size(result: Any, request: Any) -> str:
+    if result is None:
+        return '0'
+    if isinstance(result, str):
+        charset = request.response.charset or 'utf-8'
+        if result.isascii() and charset.lower() == 'utf-8':
+            # Saves encoding the default json renderer's output twice.
+            return str(len(result))
+        return str(len(result.encode(charset, 'replace')))
+    return str(len(result))
+
+
+def _wrap_renderer_factories(registry: Registry, as_spans: bool) -> None:
+    for name, factory in list(registry.getUtilitiesFor(IRendererFactory)):
+        if isinstance(factory, TracedRendererFactory):
+            continue
+        registry.registerUtility(
+            TracedRendererFactory(factory, name, as_spans),
+            IRendererFactory,
+            name=name,
+        )
+
+
+def includeme(config: Configurator) -> None:
+    """Wraps the registered renderer factories if `zipkin.trace_renderers` is
+    set.
+    """
+    mode = config.get_settings().get('zipkin.trace_renderers')
+    if not mode:
+        return
+    if mode not in (PHASES_AS_ANNOTATIONS, PHASES_AS_SPANS):
+        raise ZipkinError(
+            '`zipkin.trace_renderers` must be '
+            f'{PHASES_AS_ANNOTATIONS!r} or {PHASES_AS_SPANS!r}, not {mode!r}'
+        )
+    # Renderer factories are registered at PHASE1_CONFIG, and looked up by
+    # the views registered after this.
+    config.action(
+        None,
+        _wrap_renderer_factories,
+        args=(config.registry, mode == PHASES_AS_SPANS),
+        order=PHASE2_CONFIG,
+    )
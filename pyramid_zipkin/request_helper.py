@@ -1,10 +1,24 @@
+import math
 import random
 import re
+from types import MappingProxyType
+from typing import Callable
+from typing import Collection
 from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Mapping
 from typing import Optional
+from typing import Pattern
+from typing import Sequence
+from typing import Tuple
+from typing import TYPE_CHECKING
+from typing import Union
 
+from py_zipkin.storage import get_default_tracer
 from py_zipkin.util import generate_random_128bit_string
 from py_zipkin.util import generate_random_64bit_string
+from py_zipkin.zipkin import zipkin_span
 from py_zipkin.zipkin import ZipkinAttrs
 from pyramid.interfaces import IRoutesMapper
 from pyramid.request import Request
@@ -12,9 +26,22 @@ from pyramid.response import Response
 
 from pyramid_zipkin.version import __version__
 
+if TYPE_CHECKING:  # pragma: no cover
+    from pyramid_zipkin.sampling import SamplingSettings
+
 
 DEFAULT_REQUEST_TRACING_PERCENT = 0.5
 
+# Bit of the X-B3-Flags header asking for the trace to be recorded.
+B3_DEBUG_FLAG = 1
+
+_NO_HTTP_HEADERS: Mapping[str, Optional[str]] = MappingProxyType({})
+
+# Request start times are in seconds, milliseconds, microseconds or
+# nanoseconds since the epoch depending on the load balancer. Anything past
+# this many seconds (year 5138) is assumed to be in a smaller unit.
+_MAX_REQUEST_START_SECONDS = 1e11
+
 
 def get_trace_id(request: Request) -> str:
     """Gets the trace id based on a request. If not present with the request, a
@@ -23,41 +50,85 @@ def get_trace_id(request: Request) -> str:
     :param: current active pyramid request
     :returns: the value of the 'X-B3-TraceId' header or a 128-bit hex string
     """
-    return request.headers.get('X-B3-TraceId', generate_random_128bit_string())
+    trace_id = request.headers.get('X-B3-TraceId')
+    if trace_id is None:
+        trace_id = generate_random_128bit_string()
+    return trace_id
 
 
-def should_not_sample_path(request: Request) -> bool:
+def should_not_sample_path(
+    request: Request,
+    blacklisted_paths: Optional[Sequence[Pattern[str]]] = None,
+) -> bool:
     """Decided whether current request path should be sampled or not. This is
     checked previous to `should_not_sample_route` and takes precedence.
 
     :param: current active pyramid request
+    :param blacklisted_paths: the compiled `zipkin.blacklisted_paths`, read
+        from the registry's settings if not given.
     :returns: boolean whether current request path is blacklisted.
     """
-    blacklisted_paths = request.registry.settings.get(
-        'zipkin.blacklisted_paths', [])
+    if blacklisted_paths is None:
+        blacklisted_paths = compile_blacklisted_paths(
+            request.registry.settings.get('zipkin.blacklisted_paths', []),
+        )
+    path = request.path
+    return any(r.match(path) for r in blacklisted_paths)
+
+
+def compile_blacklisted_paths(
+    blacklisted_paths: Iterable[Union[str, Pattern[str]]],
+) -> Tuple[Pattern[str], ...]:
     # Only compile strings, since even recompiling existing
     # compiled regexes takes time.
-    regexes = [
+    return tuple(
         re.compile(r) if isinstance(r, str) else r
         for r in blacklisted_paths
-    ]
-    return any(r.match(request.path) for r in regexes)
+    )
+
+
+def _get_route_name(request: Request) -> Optional[str]:
+    """Matches the request's route, which Pyramid only does after the tweens.
+    """
+    route_mapper = request.registry.queryUtility(IRoutesMapper)
+    route_info = route_mapper(request).get('route')
+    return route_info.name if route_info else None
+
+
+def _route_name_getter() -> Callable[[Request], Optional[str]]:
+    """`_get_route_name`, only matching the route on its first call, so that
+    the settings needing the route of a request share a single match.
+    """
+    route_names: List[Optional[str]] = []
 
+    def get_route_name(request: Request) -> Optional[str]:
+        if not route_names:
+            route_names.append(_get_route_name(request))
+        return route_names[0]
 
-def should_not_sample_route(request: Request) -> bool:
+    return get_route_name
+
+
+def should_not_sample_route(
+    request: Request,
+    get_route_name: Callable[[Request], Optional[str]] = _get_route_name,
+    blacklisted_routes: Optional[Collection[str]] = None,
+) -> bool:
     """Decided whether current request route should be sampled or not.
 
     :param: current active pyramid request
+    :param get_route_name: matches the request's route.
+    :param blacklisted_routes: the `zipkin.blacklisted_routes`, read from the
+        registry's settings if not given.
     :returns: boolean whether current request route is blacklisted.
     """
-    blacklisted_routes = request.registry.settings.get(
-        'zipkin.blacklisted_routes', [])
+    if blacklisted_routes is None:
+        blacklisted_routes = request.registry.settings.get(
+            'zipkin.blacklisted_routes', [])
 
     if not blacklisted_routes:
         return False
-    route_mapper = request.registry.queryUtility(IRoutesMapper)
-    route_info = route_mapper(request).get('route')
-    return (route_info and route_info.name in blacklisted_routes)
+    return get_route_name(request) in blacklisted_routes
 
 
 def should_sample_as_per_zipkin_tracing_percent(tracing_percent: float) -> bool:
@@ -70,65 +141,187 @@ def should_sample_as_per_zipkin_tracing_percent(tracing_percent: float) -> bool:
     return (random.random() * 100) < tracing_percent
 
 
-def is_tracing(request: Request) -> bool:
+def parse_b3_flags(value: Optional[str]) -> int:
+    """Parses the X-B3-Flags header, 0 if it's missing or invalid."""
+    if not value:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def is_tracing(
+    request: Request,
+    b3_flags: Optional[int] = None,
+    sampling: Optional['SamplingSettings'] = None,
+    get_route_name: Optional[Callable[[Request], Optional[str]]] = None,
+) -> bool:
     """Determine if zipkin should be tracing
-    1) Check whether the current request path is blacklisted.
-    2) If not, check whether the current request route is blacklisted.
-    3) If not, check if specific sampled header is present in the request.
-    4) If not, Use a tracing percent (default: 0.5%) to decide.
+    1) Check whether tracing is disabled by the `zipkin.sampling_control`.
+    2) If not, check whether the request has the B3 debug flag, if it bypasses
+       the blacklists.
+    3) If not, check whether the current request path is blacklisted.
+    4) If not, check whether the current request route is blacklisted.
+    5) If not, check whether the request has the B3 debug flag.
+    6) If not, check if specific sampled header is present in the request.
+    7) If not, use the rate of the first of the `zipkin.sampling_rules`
+       matching the request.
+    8) If none, Use a tracing percent (default: 0.5%) to decide, the one of
+       the sampling control if there's one, unless the `zipkin.route_reservoir`
+       still has to trace requests of the route or the `zipkin.error_boost`
+       boosts it.
 
     :param request: pyramid request object
+    :param b3_flags: the parsed X-B3-Flags header, parsed from the request if
+        not given.
+    :param sampling: the sampling settings compiled by `includeme`, compiled
+        from the registry's settings if not given.
+    :param get_route_name: matches the request's route, only once.
 
     :returns: boolean True if zipkin should be tracing
     """
-    if should_not_sample_path(request):
+    if sampling is None:
+        # Imported here since it imports this module.
+        from pyramid_zipkin.sampling import sampling_settings_from_settings
+        sampling = sampling_settings_from_settings(request.registry.settings)
+    if get_route_name is None:
+        # Pyramid only matches the route after the tweens, it's matched here
+        # at most once, if a setting needs it.
+        get_route_name = _route_name_getter()
+    sampling_control = sampling.sampling_control
+    # Read once, a concurrent update replaces the whole state.
+    sampling_state = (
+        sampling_control.state if sampling_control is not None else None
+    )
+    if sampling_state is not None and not sampling_state.enabled:
         return False
-    elif should_not_sample_route(request):
+
+    if b3_flags is None:
+        b3_flags = parse_b3_flags(request.headers.get('X-B3-Flags'))
+    debug = bool(b3_flags & B3_DEBUG_FLAG) and \
+        sampling.debug_flag_forces_sampling
+    if debug and sampling.debug_flag_bypasses_blacklists:
+        return True
+
+    if should_not_sample_path(request, sampling.blacklisted_paths):
         return False
+    elif should_not_sample_route(
+        request,
+        get_route_name,
+        sampling.blacklisted_routes,
+    ):
+        return False
+    elif debug:
+        return True
     elif 'X-B3-Sampled' in request.headers:
         return request.headers.get('X-B3-Sampled') == '1'
+
+    # The rules only replace the tracing percent, so that they can't break
+    # a trace its caller already sampled.
+    if sampling.sampling_rules is not None:
+        rate = sampling.sampling_rules.match(request, get_route_name)
+        if rate is not None:
+            return should_sample_as_per_zipkin_tracing_percent(rate)
+
+    if sampling_state is not None:
+        zipkin_tracing_percent = sampling_state.tracing_percent
+        if sampling_state.route_tracing_percents:
+            zipkin_tracing_percent = sampling_state.route_tracing_percents.get(
+                get_route_name(request) or '',
+                zipkin_tracing_percent,
+            )
     else:
-        zipkin_tracing_percent = request.registry.settings.get(
-            'zipkin.tracing_percent', DEFAULT_REQUEST_TRACING_PERCENT)
-        return should_sample_as_per_zipkin_tracing_percent(
-            zipkin_tracing_percent)
+        zipkin_tracing_percent = sampling.tracing_percent
+    sampled = should_sample_as_per_zipkin_tracing_percent(zipkin_tracing_percent)
+
+    route_reservoir = sampling.route_reservoir
+    error_boost = sampling.error_boost
+    if route_reservoir is None and (
+        error_boost is None or not error_boost.boosting
+    ):
+        return sampled
+    route_name = get_route_name(request)
+    if route_reservoir is not None:
+        sampled = route_reservoir.sample(route_name, sampled)
+    if not sampled and error_boost is not None:
+        sampled = error_boost.sample(route_name)
+    return sampled
+
+
+def parse_request_start(value: Optional[str]) -> Optional[float]:
+    """Parses the time a load balancer received a request from the header it
+    added to it, e.g. `X-Request-Start`. Handles nginx's `t=1700000000.123`
+    in seconds, HAProxy's `t=1700000000123456` in microseconds and Heroku's
+    `1700000000123` in milliseconds: the unit is guessed from the magnitude.
+
+    :param value: the value of the header, if any.
+    :returns: the time the request started, in seconds since the epoch, or
+        None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        request_start = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(request_start) or request_start <= 0:
+        return None
+    while request_start >= _MAX_REQUEST_START_SECONDS:
+        request_start /= 1000
+    return request_start
+
+
+def is_sampled(zipkin_context: zipkin_span) -> bool:
+    """Whether the server span is sampled and is going to be emitted."""
+    return (
+        zipkin_context.logging_context is not None and
+        zipkin_context.zipkin_attrs is not None and
+        zipkin_context.zipkin_attrs.is_sampled
+    )
 
 
-def create_zipkin_attr(request: Request) -> ZipkinAttrs:
+def create_zipkin_attr(
+    request: Request,
+    sampling: Optional['SamplingSettings'] = None,
+    get_route_name: Optional[Callable[[Request], Optional[str]]] = None,
+) -> ZipkinAttrs:
     """Create ZipkinAttrs object from a request with sampled flag as True.
-    Attaches lazy attribute `zipkin_trace_id` with request which is then used
-    throughout the tween.
+    The tween stores the ids of the ZipkinAttrs it uses on the request.
 
     Consumes custom is_tracing function to determine if the request is traced
     if one is set in the pyramid registry.
 
     :param request: pyramid request object
+    :param sampling: the sampling settings compiled by `includeme`, compiled
+        from the registry's settings if not given.
+    :param get_route_name: matches the request's route, only once.
     :rtype: :class:`pyramid_zipkin.request_helper.ZipkinAttrs`
     """
-    settings = request.registry.settings
-
-    if 'zipkin.is_tracing' in settings:
-        is_sampled = settings['zipkin.is_tracing'](request)
+    if sampling is None:
+        # Imported here since it imports this module.
+        from pyramid_zipkin.sampling import sampling_settings_from_settings
+        sampling = sampling_settings_from_settings(request.registry.settings)
+
+    b3_flags = parse_b3_flags(request.headers.get('X-B3-Flags'))
+    if sampling.is_tracing is not None:
+        is_sampled = sampling.is_tracing(request)
     else:
-        is_sampled = is_tracing(request)
+        is_sampled = is_tracing(request, b3_flags, sampling, get_route_name)
 
-    span_id = request.headers.get(
-        'X-B3-SpanId', generate_random_64bit_string())
+    span_id = request.headers.get('X-B3-SpanId')
+    if span_id is None:
+        span_id = generate_random_64bit_string()
     parent_span_id = request.headers.get('X-B3-ParentSpanId', None)
-    flags = request.headers.get('X-B3-Flags', '0')
-
-    # Store zipkin_trace_id and zipkin_span_id in the request object so that
-    # they're still available once we leave the pyramid_zipkin tween. An example
-    # is being able to log them in the pyramid exc_logger, which runs after all
-    # tweens have been exited.
-    request.zipkin_trace_id = get_trace_id(request)
-    request.zipkin_span_id = span_id
 
     return ZipkinAttrs(
-        trace_id=request.zipkin_trace_id,
+        trace_id=get_trace_id(request),
         span_id=span_id,
         parent_span_id=parent_span_id,
-        flags=flags,
+        flags=str(b3_flags),
         is_sampled=is_sampled,
     )
 
@@ -136,11 +329,15 @@ def create_zipkin_attr(request: Request) -> ZipkinAttrs:
 def get_binary_annotations(
     request: Request,
     response: Response,
+    extra_binary_annotations: bool = True,
 ) -> Dict[str, Optional[str]]:
     """Helper method for getting all binary annotations from the request.
 
     :param request: the Pyramid request object
     :param response: the Pyramid response object
+    :param extra_binary_annotations: whether to add the ones returned by the
+        `zipkin.set_extra_binary_annotations` setting, which the tween calls
+        on its own.
     :returns: binary annotation dict of {str: str}
     """
     # use only @property of the request object
@@ -184,7 +381,8 @@ def get_binary_annotations(
             )
 
     settings = request.registry.settings
-    if 'zipkin.set_extra_binary_annotations' in settings:
+    if extra_binary_annotations and \
+            'zipkin.set_extra_binary_annotations' in settings:
         annotations.update(
             settings['zipkin.set_extra_binary_annotations'](request, response)
         )
@@ -227,3 +425,47 @@ def _update_annotations_from_request_environ(
     query_string = environ.get('QUERY_STRING')
     if query_string:
         annotations['url.query'] = query_string
+
+
+def create_http_headers_for_request(
+    request: Request,
+) -> Mapping[str, Optional[str]]:
+    """Generates the headers for a new zipkin span, like py_zipkin's
+    `create_http_headers_for_new_span`, for services that make many
+    downstream calls per request.
+
+    The headers are built once per request and current span, and cached on
+    the request. If the request isn't sampled that same mapping is returned
+    by every call, so all the downstream calls get the same span ID.
+    Otherwise every call gets a copy of it with a new span ID.
+
+    :param: current active pyramid request
+    :returns: read-only `types.MappingProxyType` with the X-B3-TraceId,
+        X-B3-SpanId, X-B3-ParentSpanId, X-B3-Flags and X-B3-Sampled headers,
+        empty if called outside of a zipkin trace context. Pass it to
+        `dict()` to add headers to it.
+    """
+    zipkin_attrs = get_default_tracer().get_zipkin_attrs()
+    if zipkin_attrs is None:
+        return _NO_HTTP_HEADERS
+    is_sampled = zipkin_attrs.is_sampled
+
+    cached = getattr(request, '_zipkin_http_headers', None)
+    if cached is None or cached[0] is not zipkin_attrs:
+        # The headers are cached per span, a call from within a child span
+        # needs that child as parent.
+        template = {
+            'X-B3-TraceId': zipkin_attrs.trace_id,
+            'X-B3-SpanId': generate_random_64bit_string(),
+            'X-B3-ParentSpanId': zipkin_attrs.span_id,
+            'X-B3-Flags': zipkin_attrs.flags or '0',
+            'X-B3-Sampled': '1' if is_sampled else '0',
+        }
+        cached = (zipkin_attrs, MappingProxyType(template), template)
+        request._zipkin_http_headers = cached
+
+    if not is_sampled:
+        return cached[1]
+    headers = cached[2].copy()
+    headers['X-B3-SpanId'] = generate_random_64bit_string()
+    return MappingProxyType(headers)
@@ -0,0 +1,90 @@
+"""CPU time and garbage collector pauses of a request.
+
+With `zipkin.record_cpu_time`, the server span of a sampled request gets the
+CPU time its thread spent in the view next to the wall time, which tells
+whether an endpoint is CPU bound or waiting on I/O. With
+`zipkin.record_gc_pauses`, it also gets the number and total duration of the
+garbage collections that ran on its thread meanwhile. Unsampled requests
+aren't measured.
+"""
+import gc
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+
+# The measurement running on the current thread, if any.
+_local = threading.local()
+_gc_callback_lock = threading.Lock()
+
+
+class ResourceUsage:
+    """Measures the resources the current thread used between :meth:`start`
+    and :meth:`stop`.
+
+    :param cpu_time: whether to measure the thread's CPU time.
+    :param gc_pauses: whether to count the garbage collections.
+    """
+
+    def __init__(self, cpu_time: bool = True, gc_pauses: bool = False) -> None:
+        self.cpu_time = cpu_time
+        self.gc_pauses = gc_pauses
+        self.gc_count = 0
+        self.gc_time_ns = 0
+        self._gc_start: Optional[int] = None
+        self._wall_start = 0
+        self._cpu_start = 0
+
+    def start(self) -> None:
+        if self.gc_pauses:
+            _install_gc_callback()
+            _local.usage = self
+        self._wall_start = time.perf_counter_ns()
+        if self.cpu_time:
+            self._cpu_start = time.thread_time_ns()
+
+    def stop(self) -> Dict[str, Optional[str]]:
+        """Stops measuring.
+
+        :returns: the measurements, as tags for the server span.
+        """
+        tags: Dict[str, Optional[str]] = {}
+        if self.cpu_time:
+            tags['zipkin.handler.cpu_time_ms'] = _format_ms(
+                time.thread_time_ns() - self._cpu_start,
+            )
+        tags['zipkin.handler.wall_time_ms'] = _format_ms(
+            time.perf_counter_ns() - self._wall_start,
+        )
+        if self.gc_pauses:
+            _local.usage = None
+            tags['zipkin.gc.pauses'] = str(self.gc_count)
+            tags['zipkin.gc.pause_time_ms'] = _format_ms(self.gc_time_ns)
+        return tags
+
+
+def _format_ms(duration_ns: int) -> str:
+    return f'{duration_ns / 1e6:.3f}'
+
+
+def _on_gc(phase: str, info: Dict[str, Any]) -> None:
+    usage = getattr(_local, 'usage', None)
+    if usage is None:
+        return
+    if phase == 'start':
+        usage._gc_start = time.perf_counter_ns()
+    elif usage._gc_start is not None:
+        usage.gc_count += 1
+        usage.gc_time_ns += time.perf_counter_ns() - usage._gc_start
+        usage._gc_start = None
+
+
+def _install_gc_callback() -> None:
+    """Adds the callback once, the first time a request needs it, so that
+    the garbage collector isn't slowed down otherwise.
+    """
+    with _gc_callback_lock:
+        if _on_gc not in gc.callbacks:
+            gc.callbacks.append(_on_gc)
@@ -0,0 +1,808 @@
+"""Sampling rate that can be changed while the app is running.
+
+A :class:`SamplingControl` set as `zipkin.sampling_control` (or created by
+``config.include('pyramid_zipkin')``) is consulted by `is_tracing` on every
+request. Tracing can be turned off entirely during an incident, or the
+sampling rate of a single route raised to debug it, without a redeploy:
+
+.. code-block:: python
+
+    from pyramid_zipkin.tween import IZipkinSettings
+
+    sampling = registry.getUtility(IZipkinSettings).sampling
+    control = sampling.sampling_control
+    control.update(enabled=False)
+    control.update(route_tracing_percents={'checkout': 100})
+
+It can also poll a JSON file or environment variable, e.g. with
+``zipkin.sampling_file = /etc/myapp/sampling.json`` containing
+``{"enabled": false}``. The content is applied on top of the configured
+state, so deleting the file restores it.
+
+:class:`SamplingRules`, set from `zipkin.sampling_rules`, skip or force the
+tracing of requests by method, host, header, path or route, instead of the
+tracing percent:
+
+.. code-block:: python
+
+    settings['zipkin.sampling_rules'] = [
+        {'headers': {'User-Agent': 'kube-probe/.*'}, 'rate': 0},
+        {'method': 'POST', 'route': 'checkout', 'rate': 100},
+    ]
+
+A :class:`RouteReservoir`, created from `zipkin.min_traces_per_route`,
+makes sure low traffic routes get traced even with a low tracing percent:
+the first requests of every route in each window are traced, the others
+only if the tracing percent picks them.
+
+An :class:`ErrorRateBoost`, created from `zipkin.error_boost_threshold`,
+raises the tracing percent of a route as soon as too many of its requests
+fail, and lowers it back over the following minute.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from types import MappingProxyType
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import FrozenSet
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Pattern
+from typing import Sequence
+from typing import Tuple
+
+from py_zipkin.exception import ZipkinError
+from pyramid.request import Request
+from pyramid.settings import asbool
+
+from pyramid_zipkin.request_helper import _route_name_getter
+from pyramid_zipkin.request_helper import compile_blacklisted_paths
+from pyramid_zipkin.request_helper import DEFAULT_REQUEST_TRACING_PERCENT
+from pyramid_zipkin.request_helper import \
+    should_sample_as_per_zipkin_tracing_percent
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 5.0
+
+
+class SamplingState(NamedTuple):
+    """Immutable snapshot of the sampling configuration.
+
+    :param enabled: whether any request gets traced at all.
+    :param tracing_percent: share of the requests that are sampled.
+    :param route_tracing_percents: overrides of `tracing_percent` by route
+        name.
+    """
+    enabled: bool
+    tracing_percent: float
+    route_tracing_percents: Mapping[str, float]
+
+
+class _PollSource(NamedTuple):
+    path: Optional[str]
+    env_var: Optional[str]
+    interval: float
+
+
+class SamplingControl:
+    """Holds the current :class:`SamplingState`. Updates build a new state
+    and swap it in with a single assignment, so readers only need to read
+    the `state` attribute once to get a consistent view of it, without any
+    lock.
+
+    :param tracing_percent: initial share of the requests that are sampled.
+    :param enabled: whether tracing is initially enabled.
+    :param route_tracing_percents: initial per-route overrides.
+    """
+
+    def __init__(
+        self,
+        tracing_percent: float = DEFAULT_REQUEST_TRACING_PERCENT,
+        enabled: bool = True,
+        route_tracing_percents: Optional[Mapping[str, float]] = None,
+    ) -> None:
+        self.state = _make_state(
+            enabled,
+            tracing_percent,
+            route_tracing_percents or {},
+        )
+        self._configured_state = self.state
+        # Serializes the updates, so that concurrent ones aren't lost.
+        self._lock = threading.Lock()
+        self._source: Optional[_PollSource] = None
+        self._last_read: Any = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._fork_hook_registered = False
+
+    def update(
+        self,
+        enabled: Optional[bool] = None,
+        tracing_percent: Optional[float] = None,
+        route_tracing_percents: Optional[Mapping[str, float]] = None,
+    ) -> SamplingState:
+        """Changes the given parts of the state and leaves the others as is.
+
+        :raises ZipkinError: if a value is invalid, the state isn't changed.
+        :returns: the new state.
+        """
+        with self._lock:
+            state = self.state
+            self.state = _make_state(
+                state.enabled if enabled is None else enabled,
+                state.tracing_percent
+                if tracing_percent is None else tracing_percent,
+                state.route_tracing_percents
+                if route_tracing_percents is None else route_tracing_percents,
+            )
+            return self.state
+
+    def start_polling(
+        self,
+        path: Optional[str] = None,
+        env_var: Optional[str] = None,
+        interval: float = DEFAULT_POLL_INTERVAL,
+    ) -> None:
+        """Starts a daemon thread that calls :meth:`poll` every `interval`
+        seconds. The thread is restarted in forked children.
+
+        :param path: JSON file to read the state from.
+        :param env_var: environment variable to read it from, if no `path`.
+        :param interval: seconds between two reads.
+        """
+        if (path is None) == (env_var is None):
+            raise ZipkinError('Exactly one of path and env_var is required')
+        if self._thread is not None:
+            self.stop_polling()
+        self._source = _PollSource(path, env_var, interval)
+        self.poll()
+        self._start_thread()
+        if not self._fork_hook_registered:
+            self._fork_hook_registered = True
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def stop_polling(self) -> None:
+        self._source = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def poll(self) -> bool:
+        """Reads the polled file or environment variable once and applies
+        its content if it changed since the last read. A missing file or
+        unset variable restores the configured state. Invalid content is
+        logged and ignored.
+
+        :returns: whether the state changed.
+        """
+        source = self._source
+        if source is None:
+            return False
+        try:
+            raw = _read(source.path, source.env_var)
+        except OSError:
+            log.exception('Error reading the zipkin sampling state')
+            return False
+        if raw == self._last_read:
+            return False
+        # Remembered even if invalid, so that it's only logged once.
+        self._last_read = raw
+        try:
+            state = self._parse(raw)
+        except (ValueError, TypeError, ZipkinError):
+            log.exception('Invalid zipkin sampling state: %r', raw)
+            return False
+        with self._lock:
+            self.state = state
+        return True
+
+    def _parse(self, raw: Optional[str]) -> SamplingState:
+        if not raw:
+            return self._configured_state
+        changes = json.loads(raw)
+        if not isinstance(changes, dict):
+            raise ValueError('Expected a JSON object')
+        state = self._configured_state._replace(**changes)
+        return _make_state(*state)
+
+    def _start_thread(self) -> None:
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(self._stop,),
+            name='pyramid_zipkin-sampling',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, stop: threading.Event) -> None:
+        while self._source is not None and \
+                not stop.wait(self._source.interval):
+            self.poll()
+
+    def _after_fork(self) -> None:
+        # Threads don't survive a fork, and the lock may have been held by
+        # one of the parent's threads.
+        self._lock = threading.Lock()
+        if self._source is not None:
+            self._start_thread()
+
+
+def _make_state(
+    enabled: bool,
+    tracing_percent: float,
+    route_tracing_percents: Mapping[str, float],
+) -> SamplingState:
+    if not isinstance(enabled, bool):
+        raise ZipkinError(f'enabled must be a bool, not {enabled!r}')
+    if not isinstance(route_tracing_percents, Mapping):
+        raise ZipkinError(
+            'route_tracing_percents must be a mapping, not '
+            f'{route_tracing_percents!r}'
+        )
+    return SamplingState(
+        enabled,
+        validate_tracing_percent(tracing_percent),
+        MappingProxyType({
+            route: validate_tracing_percent(percent, f'{route} tracing percent')
+            for route, percent in route_tracing_percents.items()
+        }),
+    )
+
+
+def validate_tracing_percent(value: Any, name: str = 'tracing_percent') -> float:
+    """Coerces a tracing percent to a float.
+
+    :raises ZipkinError: if it's not a number between 0 and 100.
+    """
+    try:
+        tracing_percent = float(value)
+    except (TypeError, ValueError):
+        tracing_percent = -1.0
+    if not 0 <= tracing_percent <= 100:
+        raise ZipkinError(
+            f'`{name}` must be a number between 0 and 100, not {value!r}'
+        )
+    return tracing_percent
+
+
+def _read(path: Optional[str], env_var: Optional[str]) -> Optional[str]:
+    if path is None:
+        return os.environ.get(env_var or '')
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def sampling_control_from_settings(settings: Dict[str, Any]) -> SamplingControl:
+    """Creates a :class:`SamplingControl` configured from the Pyramid registry
+    settings, and starts polling if a file or environment variable is set.
+
+    Here are the supported settings:
+
+    zipkin.tracing_percent: initial share of the requests that are sampled.
+    zipkin.sampling_file: JSON file to poll for the sampling state, e.g.
+        `{"enabled": false}` or `{"route_tracing_percents": {"home": 100}}`.
+    zipkin.sampling_env_var: environment variable to poll instead.
+    zipkin.sampling_poll_interval: seconds between two polls. Defaults to 5.
+    """
+    control = SamplingControl(
+        validate_tracing_percent(
+            settings.get(
+                'zipkin.tracing_percent',
+                DEFAULT_REQUEST_TRACING_PERCENT,
+            ),
+            'zipkin.tracing_percent',
+        ),
+    )
+    path = settings.get('zipkin.sampling_file')
+    env_var = settings.get('zipkin.sampling_env_var')
+    if path or env_var:
+        try:
+            interval = float(settings.get(
+                'zipkin.sampling_poll_interval',
+                DEFAULT_POLL_INTERVAL,
+            ))
+        except (TypeError, ValueError):
+            raise ZipkinError('`zipkin.sampling_poll_interval` must be a number')
+        control.start_polling(path or None, env_var or None, interval)
+    return control
+
+
+_Matcher = Callable[[str], bool]
+
+# Keys of the WSGI environ the rules' conditions look up.
+_ENVIRON_KEYS = {
+    'method': 'REQUEST_METHOD',
+    'host': 'HTTP_HOST',
+    'path': 'PATH_INFO',
+}
+_RULE_KEYS = {'headers', 'route', 'rate'} | set(_ENVIRON_KEYS)
+
+
+class _SamplingRule(NamedTuple):
+    environ_matchers: Tuple[Tuple[str, _Matcher], ...]
+    route_matcher: Optional[_Matcher]
+    rate: float
+
+
+class SamplingRules:
+    """Ordered list of sampling rules, compiled into checks of the WSGI
+    environ. The first rule whose conditions all match decides: the request
+    is sampled with the rule's `rate`, a percent like `tracing_percent`.
+
+    Here are the supported conditions, whose values are regular expressions
+    that must match the whole value:
+
+    method: the HTTP method.
+    host: the Host header, without its port.
+    path: the path of the request.
+    headers: a dict mapping header names to the expected values. A missing
+        header doesn't match.
+    route: the name of the matched route, '' if none.
+
+    :param rules: the rules, dicts of conditions plus a `rate`.
+    :raises ZipkinError: if a rule is invalid.
+    """
+
+    def __init__(self, rules: Sequence[Mapping[str, Any]]) -> None:
+        self.rules = tuple(
+            _compile_rule(rule, index) for index, rule in enumerate(rules)
+        )
+
+    def match(
+        self,
+        request: Request,
+        get_route_name: Optional[Callable[[Request], Optional[str]]] = None,
+    ) -> Optional[float]:
+        """Rate of the first rule matching the request, None if none does.
+
+        :param get_route_name: matches the request's route, only once.
+        """
+        if get_route_name is None:
+            get_route_name = _route_name_getter()
+        environ = request.environ
+        for rule in self.rules:
+            for key, matches in rule.environ_matchers:
+                value = environ.get(key)
+                if value is None or not matches(value):
+                    break
+            else:
+                # Only matched if a rule needs it.
+                if rule.route_matcher is not None and \
+                        not rule.route_matcher(get_route_name(request) or ''):
+                    continue
+                return rule.rate
+        return None
+
+
+def _compile_rule(rule: Mapping[str, Any], index: int) -> _SamplingRule:
+    name = f'sampling rule {index}'
+    if not isinstance(rule, Mapping):
+        raise ZipkinError(f'{name} must be a mapping, not {rule!r}')
+    unknown_keys = set(rule) - _RULE_KEYS
+    if unknown_keys:
+        raise ZipkinError(f'{name} has unknown keys {sorted(unknown_keys)}')
+    if 'rate' not in rule:
+        raise ZipkinError(f'{name} is missing a rate')
+
+    environ_matchers = []
+    for key, environ_key in _ENVIRON_KEYS.items():
+        if key in rule:
+            value = rule[key]
+            if key == 'method' and isinstance(value, str):
+                value = value.upper()
+            matcher = _compile_matcher(value, f'{name} {key}')
+            if key == 'host':
+                matcher = _ignoring_port(matcher)
+            environ_matchers.append((environ_key, matcher))
+    headers = rule.get('headers', {})
+    if not isinstance(headers, Mapping):
+        raise ZipkinError(f'{name} headers must be a mapping, not {headers!r}')
+    for header, value in headers.items():
+        environ_matchers.append((
+            _header_environ_key(header),
+            _compile_matcher(value, f'{name} {header} header'),
+        ))
+    route_matcher = None
+    if 'route' in rule:
+        route_matcher = _compile_matcher(rule['route'], f'{name} route')
+
+    return _SamplingRule(
+        tuple(environ_matchers),
+        route_matcher,
+        validate_tracing_percent(rule['rate'], f'{name} rate'),
+    )
+
+
+def _compile_matcher(pattern: Any, name: str) -> _Matcher:
+    if not isinstance(pattern, str):
+        raise ZipkinError(f'{name} must be a string, not {pattern!r}')
+    if re.escape(pattern) == pattern:
+        # No need for a regex.
+        return pattern.__eq__
+    try:
+        regex = re.compile(pattern)
+    except re.error as e:
+        raise ZipkinError(f'{name} is an invalid regex: {e}')
+    return lambda value: regex.fullmatch(value) is not None
+
+
+def _ignoring_port(matcher: _Matcher) -> _Matcher:
+    def matches(host: str) -> bool:
+        name, _, port = host.rpartition(':')
+        return matcher(name if name and port.isdigit() else host)
+    return matches
+
+
+def _header_environ_key(header: str) -> str:
+    key = header.upper().replace('-', '_')
+    if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        return key
+    return f'HTTP_{key}'
+
+
+def sampling_rules_from_setting(value: Any) -> SamplingRules:
+    """Compiles the `zipkin.sampling_rules` setting: a list of rules, the same
+    list as a JSON string, e.g. in a .ini file, or already compiled rules.
+
+    :raises ZipkinError: if the rules are invalid.
+    """
+    if isinstance(value, SamplingRules):
+        return value
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError as e:
+            raise ZipkinError(f'`zipkin.sampling_rules` is invalid JSON: {e}')
+    if not isinstance(value, (list, tuple)):
+        raise ZipkinError(
+            f'`zipkin.sampling_rules` must be a list of rules, not {value!r}'
+        )
+    return SamplingRules(value)
+
+
+DEFAULT_MIN_TRACES_WINDOW = 60.0
+DEFAULT_MIN_TRACES_MAX_ROUTES = 1000
+
+
+class RouteReservoir:
+    """Guarantees that at least `min_traces` requests of every route are
+    traced per window, by counting the traced requests of each route. The
+    counters are all reset at the end of the window.
+
+    :param min_traces: traced requests per route and window.
+    :param window: seconds the counters are kept.
+    :param max_routes: max number of routes counted per window. The requests
+        of the routes past that only get the tracing percent until the next
+        window, which bounds the memory used whatever the routes.
+    :param clock: returns the current time in seconds.
+    """
+
+    def __init__(
+        self,
+        min_traces: int,
+        window: float = DEFAULT_MIN_TRACES_WINDOW,
+        max_routes: int = DEFAULT_MIN_TRACES_MAX_ROUTES,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.min_traces = min_traces
+        self.window = window
+        self.max_routes = max_routes
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counts: Dict[Optional[str], int] = {}
+        self._window_end = clock() + window
+
+    def sample(self, route_name: Optional[str], sampled: bool) -> bool:
+        """Whether to trace a request.
+
+        :param route_name: the name of the request's route, None if it didn't
+            match any.
+        :param sampled: whether the tracing percent picked the request.
+        """
+        now = self._clock()
+        # Once a route got its traces, which is the common case for busy
+        # routes, they're only counted again in the next window.
+        if now < self._window_end and \
+                self._counts.get(route_name, 0) >= self.min_traces:
+            return sampled
+        with self._lock:
+            if now >= self._window_end:
+                self._counts = {}
+                self._window_end = now + self.window
+            count = self._counts.get(route_name, 0)
+            if count >= self.min_traces or (
+                not count and len(self._counts) >= self.max_routes
+            ):
+                return sampled
+            self._counts[route_name] = count + 1
+        return True
+
+
+def route_reservoir_from_settings(settings: Dict[str, Any]) -> RouteReservoir:
+    """Creates a :class:`RouteReservoir` configured from the Pyramid registry
+    settings.
+
+    Here are the supported settings:
+
+    zipkin.min_traces_per_route: traced requests per route and window.
+    zipkin.min_traces_window: seconds in a window. Defaults to 60.
+    zipkin.min_traces_max_routes: max number of routes getting the minimum
+        per window. Defaults to 1000.
+
+    :raises ZipkinError: if a setting is invalid.
+    """
+    try:
+        min_traces = int(settings['zipkin.min_traces_per_route'])
+        max_routes = int(settings.get(
+            'zipkin.min_traces_max_routes',
+            DEFAULT_MIN_TRACES_MAX_ROUTES,
+        ))
+    except (TypeError, ValueError):
+        raise ZipkinError(
+            '`zipkin.min_traces_per_route` and `zipkin.min_traces_max_routes`'
+            ' must be integers'
+        )
+    try:
+        window = float(settings.get(
+            'zipkin.min_traces_window',
+            DEFAULT_MIN_TRACES_WINDOW,
+        ))
+    except (TypeError, ValueError):
+        raise ZipkinError('`zipkin.min_traces_window` must be a number')
+    if min_traces < 1 or max_routes < 1 or window <= 0:
+        raise ZipkinError(
+            '`zipkin.min_traces_per_route`, `zipkin.min_traces_window` and'
+            ' `zipkin.min_traces_max_routes` must be positive'
+        )
+    return RouteReservoir(min_traces, window, max_routes)
+
+
+DEFAULT_ERROR_BOOST_TRACING_PERCENT = 100.0
+DEFAULT_ERROR_BOOST_DURATION = 60.0
+DEFAULT_ERROR_BOOST_HALF_LIFE = 10.0
+DEFAULT_ERROR_BOOST_MIN_REQUESTS = 20
+DEFAULT_ERROR_BOOST_MAX_TRACES_PER_SECOND = 10.0
+
+
+class _RouteErrors:
+    """Exponentially decaying number of requests and errors of a route."""
+
+    __slots__ = ('requests', 'errors', 'updated')
+
+    def __init__(self, now: float) -> None:
+        self.requests = 0.0
+        self.errors = 0.0
+        self.updated = now
+
+
+class ErrorRateBoost:
+    """Tracks the error rate of every route, and boosts the tracing percent
+    of the routes whose rate reaches `threshold` percent. The boost starts at
+    `tracing_percent` and decreases linearly to nothing over `duration`
+    seconds after the last request that kept the rate above the threshold.
+
+    :param threshold: percent of the requests of a route that must fail.
+    :param tracing_percent: tracing percent of a route when boosted.
+    :param duration: seconds the boost lasts.
+    :param half_life: seconds after which a request weighs half as much in
+        the error rate.
+    :param min_requests: weight of the requests below which a route isn't
+        boosted, so that a single failure of a rare route doesn't.
+    :param max_traces_per_second: max number of requests traced because of a
+        boost per second, whatever the number of boosted routes.
+    :param max_routes: max number of routes whose error rate is tracked.
+    :param clock: returns the current time in seconds.
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        tracing_percent: float = DEFAULT_ERROR_BOOST_TRACING_PERCENT,
+        duration: float = DEFAULT_ERROR_BOOST_DURATION,
+        half_life: float = DEFAULT_ERROR_BOOST_HALF_LIFE,
+        min_requests: int = DEFAULT_ERROR_BOOST_MIN_REQUESTS,
+        max_traces_per_second: float = DEFAULT_ERROR_BOOST_MAX_TRACES_PER_SECOND,
+        max_routes: int = 1000,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.threshold = threshold
+        self.tracing_percent = tracing_percent
+        self.duration = duration
+        self.half_life = half_life
+        self.min_requests = min_requests
+        self.max_traces_per_second = max_traces_per_second
+        self.max_routes = max_routes
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._routes: Dict[Optional[str], _RouteErrors] = {}
+        # When the boost of each boosted route ends.
+        self._boosted: Dict[Optional[str], float] = {}
+        self._tokens = max_traces_per_second
+        self._tokens_updated = clock()
+
+    @property
+    def boosting(self) -> bool:
+        """Whether any route is boosted, which is checked before matching the
+        route of a request.
+        """
+        return bool(self._boosted)
+
+    def record(self, route_name: Optional[str], error: bool) -> None:
+        """Records the outcome of a request.
+
+        :param route_name: the name of the request's route, None if it didn't
+            match any.
+        :param error: whether it raised or returned a 5xx.
+        """
+        now = self._clock()
+        with self._lock:
+            route = self._routes.get(route_name)
+            if route is None:
+                if len(self._routes) >= self.max_routes:
+                    return
+                route = self._routes[route_name] = _RouteErrors(now)
+            decay = 0.5 ** ((now - route.updated) / self.half_life)
+            route.requests = route.requests * decay + 1
+            route.errors = route.errors * decay + error
+            route.updated = now
+            if error and route.requests >= self.min_requests and \
+                    route.errors * 100 >= route.requests * self.threshold:
+                if route_name not in self._boosted:
+                    log.info(
+                        'Boosting the tracing of route %s, %.0f%% of its'
+                        ' requests failed',
+                        route_name,
+                        route.errors * 100 / route.requests,
+                    )
+                self._boosted[route_name] = now + self.duration
+
+    def sample(self, route_name: Optional[str]) -> bool:
+        """Whether to trace a request the tracing percent didn't pick because
+        its route is boosted.
+        """
+        boost_end = self._boosted.get(route_name)
+        if boost_end is None:
+            return False
+        now = self._clock()
+        remaining = boost_end - now
+        if remaining <= 0:
+            # A concurrent extension that's lost is made again by the next
+            # failure of the route.
+            self._boosted.pop(route_name, None)
+            return False
+        if not should_sample_as_per_zipkin_tracing_percent(
+            self.tracing_percent * remaining / self.duration,
+        ):
+            return False
+        with self._lock:
+            self._tokens = min(
+                self._tokens + (now - self._tokens_updated) *
+                self.max_traces_per_second,
+                self.max_traces_per_second,
+            )
+            self._tokens_updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        return True
+
+
+def error_rate_boost_from_settings(settings: Dict[str, Any]) -> ErrorRateBoost:
+    """Creates an :class:`ErrorRateBoost` configured from the Pyramid registry
+    settings.
+
+    Here are the supported settings:
+
+    zipkin.error_boost_threshold: percent of the requests of a route that
+        must fail for it to be boosted.
+    zipkin.error_boost_tracing_percent: tracing percent of a boosted route.
+        Defaults to 100.
+    zipkin.error_boost_duration: seconds the boost lasts. Defaults to 60.
+    zipkin.error_boost_half_life: seconds after which a request weighs half
+        as much in the error rate. Defaults to 10.
+    zipkin.error_boost_min_requests: weight of the requests below which a
+        route isn't boosted. Defaults to 20.
+    zipkin.error_boost_max_traces_per_second: max number of requests traced
+        because of a boost per second. Defaults to 10.
+
+    :raises ZipkinError: if a setting is invalid.
+    """
+    threshold = validate_tracing_percent(
+        settings['zipkin.error_boost_threshold'],
+        'zipkin.error_boost_threshold',
+    )
+    tracing_percent = validate_tracing_percent(
+        settings.get(
+            'zipkin.error_boost_tracing_percent',
+            DEFAULT_ERROR_BOOST_TRACING_PERCENT,
+        ),
+        'zipkin.error_boost_tracing_percent',
+    )
+    numbers = {}
+    for name, default in (
+        ('duration', DEFAULT_ERROR_BOOST_DURATION),
+        ('half_life', DEFAULT_ERROR_BOOST_HALF_LIFE),
+        ('min_requests', DEFAULT_ERROR_BOOST_MIN_REQUESTS),
+        ('max_traces_per_second', DEFAULT_ERROR_BOOST_MAX_TRACES_PER_SECOND),
+    ):
+        key = f'zipkin.error_boost_{name}'
+        try:
+            numbers[name] = float(settings.get(key, default))
+        except (TypeError, ValueError):
+            numbers[name] = 0
+        if not numbers[name] > 0:
+            raise ZipkinError(f'`{key}` must be a positive number')
+    return ErrorRateBoost(
+        threshold,
+        tracing_percent,
+        duration=numbers['duration'],
+        half_life=numbers['half_life'],
+        min_requests=int(numbers['min_requests']),
+        max_traces_per_second=numbers['max_traces_per_second'],
+    )
+
+
+class SamplingSettings(NamedTuple):
+    """The settings `is_tracing` decides with, compiled once by `includeme`
+    rather than looked up and coerced on every request.
+    """
+    is_tracing: Optional[Callable[[Request], bool]]
+    blacklisted_paths: Tuple[Pattern[str], ...]
+    blacklisted_routes: FrozenSet[str]
+    debug_flag_forces_sampling: bool
+    debug_flag_bypasses_blacklists: bool
+    sampling_rules: Optional[SamplingRules]
+    sampling_control: Optional[SamplingControl]
+    tracing_percent: float
+    route_reservoir: Optional[RouteReservoir]
+    error_boost: Optional[ErrorRateBoost]
+
+
+def sampling_settings_from_settings(settings: Dict[str, Any]) -> SamplingSettings:
+    """Compiles the sampling settings from the Pyramid registry settings. The
+    sampling control, route reservoir and error rate boost are the ones set,
+    `includeme` creates the missing ones.
+
+    :raises ZipkinError: if a setting is invalid.
+    """
+    sampling_rules = settings.get('zipkin.sampling_rules')
+    return SamplingSettings(
+        is_tracing=settings.get('zipkin.is_tracing'),
+        blacklisted_paths=compile_blacklisted_paths(
+            settings.get('zipkin.blacklisted_paths', []),
+        ),
+        blacklisted_routes=frozenset(
+            settings.get('zipkin.blacklisted_routes', []),
+        ),
+        debug_flag_forces_sampling=asbool(
+            settings.get('zipkin.debug_flag_forces_sampling', True),
+        ),
+        debug_flag_bypasses_blacklists=asbool(
+            settings.get('zipkin.debug_flag_bypasses_blacklists', False),
+        ),
+        sampling_rules=sampling_rules_from_setting(sampling_rules)
+        if sampling_rules else None,
+        sampling_control=settings.get('zipkin.sampling_control'),
+        tracing_percent=validate_tracing_percent(
+            settings.get(
+                'zipkin.tracing_percent',
+                DEFAULT_REQUEST_TRACING_PERCENT,
+            ),
+            'zipkin.tracing_percent',
+        ),
+        route_reservoir=settings.get('zipkin.route_reservoir'),
+        error_boost=settings.get('zipkin.error_boost'),
+    )
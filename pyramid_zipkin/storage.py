@@ -0,0 +1,134 @@
+"""Span storage that keeps the memory used by long-running requests bounded.
+
+py_zipkin keeps every finished child span in memory until the root span
+exits. :class:`IncrementalSpanStorage` ships them as soon as enough of them
+have piled up, and drops new child spans once a request has produced too
+many of them.
+"""
+import logging
+import threading
+from typing import List
+from typing import Optional
+
+from py_zipkin.encoding._helpers import copy_endpoint_with_new_service_name
+from py_zipkin.encoding._helpers import Span
+from py_zipkin.logging_helper import ZipkinBatchSender
+from py_zipkin.logging_helper import TransportHandler
+from py_zipkin.logging_helper import ZipkinLoggingContext
+from py_zipkin.storage import SpanStorage
+
+from pyramid_zipkin.aggregation import aggregate_spans
+
+
+log = logging.getLogger(__name__)
+
+# Fixed part of an encoded V2 JSON span: ids, timestamps, kind and endpoint.
+_SPAN_SIZE_OVERHEAD = 250
+
+
+def estimate_span_size(span: Span) -> int:
+    """Cheap approximation of the size of the span once encoded."""
+    size = _SPAN_SIZE_OVERHEAD + len(span.name or '')
+    for key, value in span.tags.items():
+        size += len(str(key)) + len(str(value)) + 8
+    for key in span.annotations:
+        size += len(key) + 40
+    return size
+
+
+class IncrementalSpanStorage(SpanStorage):
+    """Span storage that ships child spans while the request is still running.
+
+    Spans are sent to the logging context's handlers, the same way they'd be
+    at the end of the request, as soon as `flush_spans` spans or roughly
+    `flush_bytes` bytes are stored. After `max_spans` child spans any new one
+    is dropped and counted in `dropped`.
+
+    :param logging_context: logging context of the request's root span.
+    :param flush_spans: number of stored spans that triggers a flush.
+    :param flush_bytes: approximate encoded size that triggers a flush.
+    :param max_spans: max number of child spans kept for a request.
+    :param aggregate_min_count: if set, the flushed spans are aggregated with
+        `aggregate_spans`. A run of spans split by a flush is aggregated in
+        two parts.
+    :param aggregate_max_duration: passed to `aggregate_spans`.
+    """
+
+    def __init__(
+        self,
+        logging_context: ZipkinLoggingContext,
+        flush_spans: Optional[int] = None,
+        flush_bytes: Optional[int] = None,
+        max_spans: Optional[int] = None,
+        aggregate_min_count: Optional[int] = None,
+        aggregate_max_duration: Optional[float] = None,
+    ) -> None:
+        super().__init__()
+        self.logging_context = logging_context
+        self.flush_spans = flush_spans
+        self.flush_bytes = flush_bytes
+        self.max_spans = max_spans
+        self.aggregate_min_count = aggregate_min_count
+        self.aggregate_max_duration = aggregate_max_duration
+        self.accepted = 0
+        self.dropped = 0
+        self._stored_bytes = 0
+        self._lock = threading.Lock()
+
+    def append(self, span: Span) -> None:
+        with self._lock:
+            if self.max_spans is not None and self.accepted >= self.max_spans:
+                self.dropped += 1
+                return
+            self.accepted += 1
+            super().append(span)
+            if self.flush_bytes is not None:
+                self._stored_bytes += estimate_span_size(span)
+
+            if (
+                self.flush_spans is not None and len(self) >= self.flush_spans
+            ) or (
+                self.flush_bytes is not None and
+                self._stored_bytes >= self.flush_bytes
+            ):
+                self._flush()
+
+    def clear(self) -> None:
+        super().clear()
+        self._stored_bytes = 0
+
+    def _flush(self) -> None:
+        spans = list(self)
+        self.clear()
+        if self.aggregate_min_count is not None:
+            spans = aggregate_spans(
+                spans,
+                self.aggregate_min_count,
+                self.aggregate_max_duration,
+            )
+
+        context = self.logging_context
+        handlers: List[Optional[TransportHandler]] = []
+        if context.firehose_handler:
+            handlers.append(context.firehose_handler)
+        if context.zipkin_attrs.is_sampled:
+            handlers.append(context.transport_handler)
+
+        try:
+            for span in spans:
+                assert span.local_endpoint is not None
+                span.local_endpoint = copy_endpoint_with_new_service_name(
+                    context.endpoint,
+                    span.local_endpoint.service_name,
+                )
+            for handler in handlers:
+                with ZipkinBatchSender(
+                    handler,
+                    context.max_span_batch_size,
+                    context.encoder,
+                ) as sender:
+                    for span in spans:
+                        sender.add_span(span)
+        except Exception as e:
+            # This runs when a child span exits, in the middle of the view.
+            log.error(f'Error emitting zipkin spans. {e!r}')
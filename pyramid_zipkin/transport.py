@@ -0,0 +1,485 @@
+"""Transport handlers that move span encoding and shipping off the request
+thread.
+
+Configuring a :class:`BackgroundEncodingTransport` as
+`zipkin.transport_handler` makes `zipkin_tween` hand the finished spans over
+as raw records. They're encoded and sent by a background thread, so neither
+the encoding nor the transport's I/O is paid on the request path.
+
+Under backpressure the transport sheds spans by priority: `zipkin_tween`
+classifies the spans of each request as low, normal or high priority, and a
+full queue makes room for higher priority spans by dropping lower priority
+ones, so that the traces of errors and slow requests survive an overload.
+
+A :class:`FanOutTransport` sends the same encoded payloads to several
+transports, which is how `zipkin_tween` emits the spans of sampled requests
+to both the transport and the firehose without encoding them twice. When
+they're all background transports, the first one to encode a batch of raw
+spans shares the result with the others.
+"""
+import collections
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+from py_zipkin.encoding._encoders import IEncoder
+from py_zipkin.encoding._helpers import Span
+from py_zipkin.logging_helper import TransportHandler
+from py_zipkin.logging_helper import ZipkinBatchSender
+from py_zipkin.transport import BaseTransportHandler
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_QUEUED_SPANS = 10000
+
+DEFAULT_MAX_PENDING_PAYLOADS = 1000
+
+# Spans of requests sampled by the tracing percent.
+SPAN_PRIORITY_LOW = 0
+# Spans of requests the caller asked to sample with X-B3-Sampled, and of
+# already encoded payloads, whose origin is unknown.
+SPAN_PRIORITY_NORMAL = 1
+# Spans of failed or slow requests, and of requests with the debug flag.
+SPAN_PRIORITY_HIGH = 2
+
+
+class _PendingSpan(NamedTuple):
+    """A span that is yet to be encoded. py_zipkin's batch sender only needs
+    the `len()` of what the encoder returns, which is 1 here.
+    """
+    span: Span
+
+
+class _SharedEncoding:
+    """The encoded payloads of a :class:`SpanBatch` sent to several
+    transports, by max span batch size and max payload size, so that it's
+    only encoded once per distinct limits.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.payloads: Dict[
+            Tuple[Optional[int], Optional[int]],
+            List[Union[str, bytes]],
+        ] = {}
+
+
+class SpanBatch(NamedTuple):
+    """A list of raw spans together with the encoder to encode them with, and
+    their priority.
+    """
+    spans: List[Span]
+    encoder: IEncoder
+    priority: int = SPAN_PRIORITY_NORMAL
+    shared_encoding: Optional[_SharedEncoding] = None
+
+
+class _CollectingTransport(BaseTransportHandler):
+    """Keeps the payloads instead of sending them."""
+
+    def __init__(self, max_payload_bytes: Optional[int]) -> None:
+        super().__init__()
+        self.max_payload_bytes = max_payload_bytes
+        self.payloads: List[Union[str, bytes]] = []
+
+    def get_max_payload_bytes(self) -> Optional[int]:
+        return self.max_payload_bytes
+
+    def send(self, payload: Union[str, bytes]) -> None:
+        self.payloads.append(payload)
+
+
+class DeferredEncoder(IEncoder):
+    """Encoder that defers the actual encoding to whoever receives the
+    payload: `encode_queue` returns a :class:`SpanBatch` rather than bytes.
+
+    :param encoder: the encoder the receiver should use.
+    :param priority: priority of the batches, which can be raised until the
+        last one is returned.
+    """
+
+    def __init__(
+        self,
+        encoder: IEncoder,
+        priority: int = SPAN_PRIORITY_NORMAL,
+    ) -> None:
+        self.encoder = encoder
+        self.priority = priority
+
+    def fits(
+        self,
+        current_count: int,
+        current_size: int,
+        max_size: int,
+        new_span: Union[str, bytes],
+    ) -> bool:
+        # The payload size is only known once encoded, which is when the
+        # background transport batches the spans according to max_size.
+        return True
+
+    def encode_span(  # type: ignore[override]
+        self,
+        span: Span,
+    ) -> _PendingSpan:
+        return _PendingSpan(span)
+
+    def encode_queue(  # type: ignore[override]
+        self,
+        queue: List[_PendingSpan],
+    ) -> SpanBatch:
+        return SpanBatch(
+            [pending.span for pending in queue],
+            self.encoder,
+            self.priority,
+        )
+
+
+Payload = Union[str, bytes, SpanBatch]
+
+
+def _priority(payload: Payload) -> int:
+    if isinstance(payload, SpanBatch):
+        return payload.priority
+    return SPAN_PRIORITY_NORMAL
+
+
+class BackgroundEncodingTransport(BaseTransportHandler):
+    """Transport that encodes and sends spans from a background thread.
+
+    Both raw :class:`SpanBatch` payloads and already encoded payloads are
+    queued. The queue is bounded by `max_queued_spans`: once full, the oldest
+    payloads of lower priority than a new one are dropped to make room for
+    it, or the new one is dropped if that's not enough. Dropped spans are
+    counted in `dropped_spans`, and by priority in
+    `dropped_spans_by_priority`, instead of growing the worker's memory.
+    Higher priority payloads are sent first. The thread is started lazily,
+    and again after a fork.
+
+    :param transport_handler: the transport that sends the encoded payloads.
+    :param max_queued_spans: max number of spans waiting to be sent.
+    :param max_span_batch_size: max number of spans per sent payload.
+    """
+
+    def __init__(
+        self,
+        transport_handler: TransportHandler,
+        max_queued_spans: int = DEFAULT_MAX_QUEUED_SPANS,
+        max_span_batch_size: Optional[int] = None,
+    ) -> None:
+        super().__init__()
+        self.transport_handler = transport_handler
+        self.max_queued_spans = max_queued_spans
+        self.max_span_batch_size = max_span_batch_size
+        self.dropped_spans = 0
+        self.dropped_spans_by_priority = [0] * (SPAN_PRIORITY_HIGH + 1)
+
+        # One queue and span count per priority.
+        self._queues: List[Deque[Payload]] = [
+            collections.deque() for _ in range(SPAN_PRIORITY_HIGH + 1)
+        ]
+        self._queued_spans_by_priority = [0] * (SPAN_PRIORITY_HIGH + 1)
+        self._queued_spans = 0
+        self._sending = False
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._fork_hook_registered = False
+
+    def get_max_payload_bytes(self) -> Optional[int]:
+        # Spans are batched according to the wrapped transport's limit when
+        # they're encoded, not when they're queued.
+        return None
+
+    @staticmethod
+    def _count_spans(payload: Payload) -> int:
+        if isinstance(payload, SpanBatch):
+            return len(payload.spans)
+        # Already encoded, size unknown.
+        return 1
+
+    def _ensure_worker(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run,
+            name='pyramid_zipkin-encoder',
+            daemon=True,
+        )
+        self._thread.start()
+        if not self._fork_hook_registered:
+            self._fork_hook_registered = True
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # The queued payloads are the parent's, its thread doesn't exist in
+        # the child and the lock may have been held by one of its threads.
+        self._condition = threading.Condition()
+        for queue in self._queues:
+            queue.clear()
+        self._queued_spans_by_priority = [0] * (SPAN_PRIORITY_HIGH + 1)
+        self._queued_spans = 0
+        self._sending = False
+        self._thread = None
+
+    def send(self, payload: Payload) -> None:
+        span_count = self._count_spans(payload)
+        priority = _priority(payload)
+        with self._condition:
+            self._ensure_worker()
+            if self._queued_spans + span_count > self.max_queued_spans and \
+                    not self._make_room(span_count, priority):
+                self._count_dropped(span_count, priority)
+                return
+            self._queues[priority].append(payload)
+            self._queued_spans_by_priority[priority] += span_count
+            self._queued_spans += span_count
+            self._condition.notify()
+
+    def _make_room(self, span_count: int, priority: int) -> bool:
+        """Drops the oldest queued payloads of lower priority until
+        `span_count` more spans fit, if dropping all of them would be enough.
+        """
+        droppable = sum(self._queued_spans_by_priority[:priority])
+        needed = self._queued_spans + span_count - self.max_queued_spans
+        if droppable < needed:
+            return False
+        for lower in range(priority):
+            queue = self._queues[lower]
+            while queue and \
+                    self._queued_spans + span_count > self.max_queued_spans:
+                dropped = self._count_spans(queue.popleft())
+                self._queued_spans_by_priority[lower] -= dropped
+                self._queued_spans -= dropped
+                self._count_dropped(dropped, lower)
+        return True
+
+    def _count_dropped(self, span_count: int, priority: int) -> None:
+        self.dropped_spans += span_count
+        self.dropped_spans_by_priority[priority] += span_count
+
+    def _get(self) -> Payload:
+        with self._condition:
+            while not any(self._queues):
+                self._condition.wait()
+            queue = next(queue for queue in reversed(self._queues) if queue)
+            payload = queue.popleft()
+            span_count = self._count_spans(payload)
+            self._queued_spans_by_priority[_priority(payload)] -= span_count
+            self._queued_spans -= span_count
+            self._sending = True
+            return payload
+
+    def _send(self, payload: Payload) -> None:
+        if isinstance(payload, SpanBatch):
+            if payload.shared_encoding is None:
+                self._encode(payload, self.transport_handler)
+                return
+            encoded_payloads = self._encode_shared(
+                payload,
+                payload.shared_encoding,
+            )
+            for encoded in encoded_payloads:
+                self.transport_handler(encoded)
+        else:
+            self.transport_handler(payload)
+
+    def _encode(self, batch: SpanBatch, handler: TransportHandler) -> None:
+        with ZipkinBatchSender(
+            handler,
+            self.max_span_batch_size,
+            batch.encoder,
+        ) as sender:
+            for span in batch.spans:
+                sender.add_span(span)
+
+    def _encode_shared(
+        self,
+        batch: SpanBatch,
+        shared_encoding: _SharedEncoding,
+    ) -> List[Union[str, bytes]]:
+        """Encodes the batch, unless another transport it was sent to
+        already did with the same limits.
+        """
+        max_payload_bytes = self.transport_handler.get_max_payload_bytes() \
+            if isinstance(self.transport_handler, BaseTransportHandler) \
+            else None
+        key = (self.max_span_batch_size, max_payload_bytes)
+        with shared_encoding.lock:
+            payloads = shared_encoding.payloads.get(key)
+            if payloads is None:
+                collector = _CollectingTransport(max_payload_bytes)
+                self._encode(batch, collector)
+                payloads = shared_encoding.payloads[key] = collector.payloads
+        return payloads
+
+    def _run(self) -> None:
+        while True:
+            payload = self._get()
+            try:
+                self._send(payload)
+            except Exception:
+                log.exception('Error sending zipkin spans')
+            finally:
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until everything queued so far has been sent.
+
+        :param timeout: max seconds to wait, forever if None.
+        :returns: True if the queue was emptied before the timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not any(self._queues) and not self._sending,
+                timeout,
+            )
+
+
+class FanOutTransport(BaseTransportHandler):
+    """Transport that sends every payload to several transports. The spans
+    are encoded once, and the same immutable payload is handed to each of
+    them. Payloads are batched according to the lowest of their limits.
+
+    The transports are called one after the other on the calling thread, an
+    error in one of them being logged rather than preventing the others from
+    getting the payload. With `max_workers` they're called concurrently from
+    a thread pool instead, which is started lazily, and again after a fork.
+    At most `max_pending` payloads wait for a transport of the pool, so that a
+    slow transport doesn't make them pile up: once full, the oldest waiting
+    payload of lower priority than a new one is dropped to make room for it,
+    or the new one is dropped if there's none. Dropped payloads are counted
+    in `dropped_payloads`, and by priority in `dropped_payloads_by_priority`.
+    Transports that already send from a background thread, such as
+    :class:`BackgroundEncodingTransport`, don't need it.
+
+    :param transport_handlers: the transports to send the payloads to.
+    :param max_workers: size of the thread pool, or None to call the
+        transports on the calling thread.
+    :param max_pending: max number of payloads submitted to the thread pool
+        and not sent yet, counting one per transport. Defaults to
+        `DEFAULT_MAX_PENDING_PAYLOADS`.
+    """
+
+    def __init__(
+        self,
+        transport_handlers: Sequence[TransportHandler],
+        max_workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+    ) -> None:
+        super().__init__()
+        self.transport_handlers = list(transport_handlers)
+        self.max_workers = max_workers
+        self.max_pending = DEFAULT_MAX_PENDING_PAYLOADS \
+            if max_pending is None else max_pending
+        self.dropped_payloads = 0
+        self.dropped_payloads_by_priority = [0] * (SPAN_PRIORITY_HIGH + 1)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # The futures not done yet per priority, oldest first.
+        self._pending: List[Dict['Future[None]', None]] = [
+            {} for _ in range(SPAN_PRIORITY_HIGH + 1)
+        ]
+        self._lock = threading.Lock()
+        self._fork_hook_registered = False
+
+    def get_max_payload_bytes(self) -> Optional[int]:
+        limits = [
+            limit for limit in (
+                handler.get_max_payload_bytes()
+                for handler in self.transport_handlers
+                if isinstance(handler, BaseTransportHandler)
+            )
+            if limit is not None
+        ]
+        return min(limits) if limits else None
+
+    def send(self, payload: Payload) -> None:
+        if isinstance(payload, SpanBatch) and len(self.transport_handlers) > 1:
+            payload = payload._replace(shared_encoding=_SharedEncoding())
+        if self.max_workers is None:
+            for handler in self.transport_handlers:
+                self._send(handler, payload)
+            return
+        priority = _priority(payload)
+        with self._lock:
+            executor = self._ensure_executor()
+            pending = self._pending[priority]
+            for handler in self.transport_handlers:
+                if sum(map(len, self._pending)) >= self.max_pending and \
+                        not self._make_room(priority):
+                    self._count_dropped(priority)
+                    continue
+                future = executor.submit(self._send, handler, payload)
+                pending[future] = None
+                future.add_done_callback(self._discard_pending)
+
+    def _make_room(self, priority: int) -> bool:
+        """Cancels the oldest waiting payload of lower priority, if any."""
+        for lower in range(priority):
+            for future in list(self._pending[lower]):
+                # Fails if a transport is already sending it.
+                if future.cancel():
+                    self._count_dropped(lower)
+                    return True
+        return False
+
+    def _count_dropped(self, priority: int) -> None:
+        self.dropped_payloads += 1
+        self.dropped_payloads_by_priority[priority] += 1
+
+    def _discard_pending(self, future: 'Future[None]') -> None:
+        for pending in self._pending:
+            pending.pop(future, None)
+
+    @staticmethod
+    def _send(handler: TransportHandler, payload: Payload) -> None:
+        try:
+            # Spans are only handed over as a SpanBatch if all the handlers
+            # are BackgroundEncodingTransports.
+            handler(payload)  # type: ignore[arg-type]
+        except Exception:
+            log.exception('Error sending zipkin spans')
+
+    def _ensure_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='pyramid_zipkin-fan-out',
+            )
+            if not self._fork_hook_registered:
+                self._fork_hook_registered = True
+                os.register_at_fork(after_in_child=self._after_fork)
+        return self._executor
+
+    def _after_fork(self) -> None:
+        # In a forked child the pool's threads don't exist, the payloads
+        # still pending are the parent's and the lock may have been held by
+        # one of its threads.
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = [{} for _ in range(SPAN_PRIORITY_HIGH + 1)]
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until everything submitted to the thread pool so far has been
+        sent.
+
+        :param timeout: max seconds to wait, forever if None.
+        :returns: True if everything was sent before the timeout.
+        """
+        with self._lock:
+            pending = [
+                future for futures in self._pending for future in futures
+            ]
+        return not wait(pending, timeout).not_done
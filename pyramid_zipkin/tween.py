@@ -1,61 +1,128 @@
 import functools
+import operator
+import sys
+import time
 import traceback
 import warnings
 from collections import namedtuple
+from contextlib import ExitStack
 from typing import Any
 from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
 
 from py_zipkin import Encoding
 from py_zipkin import Kind
 from py_zipkin.exception import ZipkinError
 from py_zipkin.storage import get_default_tracer
+from py_zipkin.storage import Tracer
 from py_zipkin.transport import BaseTransportHandler
+from py_zipkin.zipkin import zipkin_span
 from pyramid.registry import Registry
 from pyramid.request import Request
 from pyramid.response import Response
+from pyramid.settings import asbool
+from zope.interface import Interface
 
+from pyramid_zipkin.request_helper import B3_DEBUG_FLAG
+from pyramid_zipkin.request_helper import _route_name_getter
 from pyramid_zipkin.request_helper import create_zipkin_attr
 from pyramid_zipkin.request_helper import get_binary_annotations
+from pyramid_zipkin.request_helper import is_sampled
+from pyramid_zipkin.request_helper import parse_b3_flags
+from pyramid_zipkin.request_helper import parse_request_start
 from pyramid_zipkin.request_helper import should_not_sample_path
 from pyramid_zipkin.request_helper import should_not_sample_route
+from pyramid_zipkin.sampling import _header_environ_key
+from pyramid_zipkin.sampling import error_rate_boost_from_settings
+from pyramid_zipkin.sampling import route_reservoir_from_settings
+from pyramid_zipkin.sampling import sampling_control_from_settings
+from pyramid_zipkin.sampling import sampling_settings_from_settings
 
+# The modules backing the optional features are only imported once a
+# request needs them, so that importing the tween stays cheap.
+if TYPE_CHECKING:  # pragma: no cover
+    from pyramid_zipkin.encoding import FastV2JSONEncoder
+    from pyramid_zipkin.phases import RequestPhases
+    from pyramid_zipkin.storage import IncrementalSpanStorage
+    from pyramid_zipkin.transport import DeferredEncoder
+    from pyramid_zipkin.transport import FanOutTransport
 
-def _getattr_path(obj: Any, path: str) -> Any:
-    """
-    getattr for a dot separated path
 
-    If an AttributeError is raised, it will return None.
+class IZipkinSettings(Interface):  # type: ignore[misc]
+    """Marker interface of the registry utility holding the `zipkin.*`
+    settings compiled at configuration time by `includeme`.
     """
-    if not path:
-        return None
-
-    for attr in path.split('.'):
-        obj = getattr(obj, attr, None)
-    return obj
 
 
-_ZipkinSettings = namedtuple('_ZipkinSettings', [
-    'zipkin_attrs',
+# The settings that don't depend on the request, parsed and validated once.
+_CompiledSettings = namedtuple('_CompiledSettings', [
+    'create_zipkin_attr',
     'transport_handler',
+    'request_context',
     'service_name',
-    'span_name',
     'add_logging_annotation',
-    'report_root_timestamp',
+    'report_root_timestamp_setting',
     'host',
-    'port',
-    'context_stack',
+    'port_setting',
     'firehose_handler',
     'post_handler_hook',
     'max_span_batch_size',
     'use_pattern_as_span_name',
     'encoding',
+    'encoder',
+    'incremental_flush_spans',
+    'incremental_flush_bytes',
+    'max_child_spans',
+    'trace_streaming_responses',
+    'request_phases',
+    'use_contextvars_stack',
+    'transport_defers_encoding',
+    'firehose_defers_encoding',
+    'sampling',
+    'slow_request_threshold',
+    'metrics_recorder',
+    'fan_out_handler',
+    'set_extra_binary_annotations',
+    'hooks_only_when_reported',
+    'annotate_hook_durations',
+    'record_cpu_time',
+    'record_gc_pauses',
+    'request_start_environ_key',
+    'backdate_to_request_start',
+    'aggregate_spans_min_count',
+    'aggregate_spans_max_duration',
 ])
 
+# The settings that depend on the request, next to the compiled ones.
+_ZipkinSettings = namedtuple('_ZipkinSettings', [
+    'zipkin_attrs',
+    'span_name',
+    'context_stack',
+    'report_root_timestamp',
+    'port',
+    'use_firehose',
+    'compiled_settings',
+])
 
-def _get_settings_from_request(request: Request) -> _ZipkinSettings:
-    """Extracts Zipkin attributes and configuration from request attributes.
-    See the `zipkin_span` context in py-zipkin for more detaied information on
-    all the settings.
+
+@functools.lru_cache(maxsize=None)
+def _get_fast_v2_json_encoder() -> 'FastV2JSONEncoder':
+    """Shared so that the encoder's fragment caches are reused across
+    requests.
+    """
+    from pyramid_zipkin.encoding import FastV2JSONEncoder
+    return FastV2JSONEncoder()
+
+
+def _compile_settings(settings: Dict[str, Any]) -> _CompiledSettings:
+    """Parses, coerces and validates the settings that don't depend on the
+    request. See the `zipkin_span` context in py-zipkin for more detaied
+    information on all the settings.
 
     Here are the supported Pyramid registry settings:
 
@@ -74,21 +141,86 @@ def _get_settings_from_request(request: Request) -> _ZipkinSettings:
     zipkin.firehose_handler: [EXPERIMENTAL] this enables "firehose tracing",
         which will log 100% of the spans to this handler, regardless of
         sampling decision. This is experimental and may change or be removed
-        at any time without warning.
+        at any time without warning. The spans of sampled requests are
+        encoded once for both handlers.
     zipkin.use_pattern_as_span_name: if true, we'll use the pyramid route pattern
         as span name. If false (default) we'll keep using the raw url path.
-    """
-    settings = request.registry.settings
+    zipkin.use_fast_encoder: if true, spans are encoded with pyramid_zipkin's
+        FastV2JSONEncoder rather than py_zipkin's. Requires Encoding.V2_JSON.
+    zipkin.incremental_flush_spans: if set, child spans are emitted in batches
+        of this size while the request is still running, rather than all at
+        once at the end of it.
+    zipkin.incremental_flush_bytes: same, but the batches are emitted once
+        their estimated encoded size reaches this many bytes.
+    zipkin.max_child_spans: max number of child spans recorded for a request.
+        The ones after that are dropped and counted in the root span's
+        `zipkin.dropped_spans` tag.
+    zipkin.trace_streaming_responses: if true, the server span of a response
+        with a streaming app_iter only ends once the WSGI server closes it,
+        rather than when the view returns.
+    zipkin.trace_request_phases: 'annotations' or 'spans' to record the
+        phases of Pyramid's request processing on sampled requests. Requires
+        including `pyramid_zipkin.phases`.
+    zipkin.use_contextvars_stack: if true, the Zipkin attributes are stored in
+        a context variable rather than in a list shared by every copy of the
+        context. Can't be used with zipkin.request_context.
+    zipkin.slow_request_threshold_ms: requests that take longer than this
+        have their spans handed over to a background transport with a high
+        priority, like failed requests, so that they're the last to be
+        dropped if it's overloaded.
+    zipkin.metrics_recorder: MetricsRecorder recording the latency and status
+        of every request by route, sampled or not. `includeme` creates one if
+        zipkin.metrics_handler is set.
+    zipkin.set_extra_binary_annotations: called with the request and the
+        response, returns tags to add to the server span.
+    zipkin.hooks_only_when_reported: if true, zipkin.post_handler_hook and
+        zipkin.set_extra_binary_annotations are only called for the requests
+        whose spans are reported, because they're sampled or a firehose is
+        set.
+    zipkin.annotate_hook_durations: if true, the time spent in each of these
+        hooks is added to the server span as a `zipkin.<hook>.duration_ms`
+        tag. It's recorded by zipkin.metrics_recorder as well.
+    zipkin.record_cpu_time: if true, the CPU time the request's thread spent
+        in the view is added to the server span of sampled requests, next to
+        the wall time.
+    zipkin.record_gc_pauses: if true, the number and duration of the garbage
+        collections that ran on the request's thread during the view are
+        added to the server span of sampled requests.
+    zipkin.request_start_header: header a load balancer sets to the time it
+        received the request, e.g. X-Request-Start. The time the request then
+        spent queued is added to the server span of reported requests as the
+        `queue.duration_ms` tag, and recorded by zipkin.metrics_recorder for
+        every request.
+    zipkin.backdate_to_request_start: if true, the server span of reported
+        requests starts when the load balancer received the request rather
+        than when the tween did.
+    zipkin.error_boost: ErrorRateBoost the outcome of every request is
+        recorded by, so that `is_tracing` traces more requests of the routes
+        that fail. `includeme` creates one if zipkin.error_boost_threshold is
+        set.
+    zipkin.aggregate_spans_min_count: if set, runs of at least this many
+        consecutive sibling spans with the same name and service are
+        replaced with a single span before being emitted.
+    zipkin.aggregate_spans_max_duration_ms: spans that took longer than this
+        aren't aggregated.
 
-    # Creates zipkin_attrs and attaches a zipkin_trace_id attr to the request
-    if 'zipkin.create_zipkin_attr' in settings:
-        zipkin_attrs = settings['zipkin.create_zipkin_attr'](request)
-    else:
-        zipkin_attrs = create_zipkin_attr(request)
+    Boolean settings accept the strings Pyramid's `asbool` does, so that
+    they can be set from a .ini file, and so do numbers and `zipkin.encoding`,
+    which can be the name of an Encoding.
+
+    :raises ZipkinError: if a setting is missing or invalid.
+    """
+    create_attrs = settings.get('zipkin.create_zipkin_attr', create_zipkin_attr)
+    _check_callable(settings, 'zipkin.create_zipkin_attr', create_attrs)
 
     if 'zipkin.transport_handler' in settings:
         transport_handler = settings['zipkin.transport_handler']
         if not isinstance(transport_handler, BaseTransportHandler):
+            _check_callable(
+                settings,
+                'zipkin.transport_handler',
+                transport_handler,
+            )
             warnings.warn(
                 'Using a function as transport_handler is deprecated. '
                 'Please extend py_zipkin.transport.BaseTransportHandler',
@@ -103,47 +235,329 @@ def _get_settings_from_request(request: Request) -> _ZipkinSettings:
             " it: https://github.com/Yelp/py_zipkin#transport"
         )
 
-    context_stack = _getattr_path(request, settings.get('zipkin.request_context'))
+    # Resolved into a getter once, it's called on every request.
+    request_context = settings.get('zipkin.request_context')
+    if request_context:
+        request_context = operator.attrgetter(request_context)
+    else:
+        request_context = None
+    use_contextvars_stack = asbool(settings.get('zipkin.use_contextvars_stack'))
+    if use_contextvars_stack and 'zipkin.request_context' in settings:
+        raise ZipkinError(
+            '`zipkin.use_contextvars_stack` and `zipkin.request_context` are'
+            ' mutually exclusive'
+        )
+
+    if 'zipkin.report_root_timestamp' in settings:
+        report_root_timestamp = asbool(settings['zipkin.report_root_timestamp'])
+    else:
+        # Decided per request, see `_get_settings_from_request`.
+        report_root_timestamp = None
+    firehose_handler = settings.get('zipkin.firehose_handler')
+    post_handler_hook = settings.get('zipkin.post_handler_hook')
+    if post_handler_hook is not None:
+        _check_callable(settings, 'zipkin.post_handler_hook', post_handler_hook)
+    set_extra_binary_annotations = settings.get(
+        'zipkin.set_extra_binary_annotations',
+    )
+    if set_extra_binary_annotations is not None:
+        _check_callable(
+            settings,
+            'zipkin.set_extra_binary_annotations',
+            set_extra_binary_annotations,
+        )
+
+    encoding = _get_encoding(settings)
+    encoder = None
+    if asbool(settings.get('zipkin.use_fast_encoder')):
+        if encoding != Encoding.V2_JSON:
+            raise ZipkinError(
+                '`zipkin.use_fast_encoder` requires `zipkin.encoding` to be'
+                f' Encoding.V2_JSON, not {encoding}'
+            )
+        encoder = _get_fast_v2_json_encoder()
 
-    service_name = settings.get('service_name', 'unknown')
-    span_name = f'{request.method} {request.path}'
-    add_logging_annotation = settings.get(
-        'zipkin.add_logging_annotation',
-        False,
+    return _CompiledSettings(
+        create_zipkin_attr=create_attrs,
+        transport_handler=transport_handler,
+        request_context=request_context,
+        service_name=settings.get('service_name', 'unknown'),
+        add_logging_annotation=asbool(
+            settings.get('zipkin.add_logging_annotation'),
+        ),
+        report_root_timestamp_setting=report_root_timestamp,
+        host=settings.get('zipkin.host'),
+        port_setting=_get_optional_int(settings, 'zipkin.port'),
+        firehose_handler=firehose_handler,
+        post_handler_hook=post_handler_hook,
+        max_span_batch_size=_get_optional_int(
+            settings,
+            'zipkin.max_span_batch_size',
+        ),
+        use_pattern_as_span_name=asbool(
+            settings.get('zipkin.use_pattern_as_span_name'),
+        ),
+        encoding=encoding,
+        encoder=encoder,
+        incremental_flush_spans=_get_optional_int(
+            settings,
+            'zipkin.incremental_flush_spans',
+        ),
+        incremental_flush_bytes=_get_optional_int(
+            settings,
+            'zipkin.incremental_flush_bytes',
+        ),
+        max_child_spans=_get_optional_int(settings, 'zipkin.max_child_spans'),
+        trace_streaming_responses=asbool(
+            settings.get('zipkin.trace_streaming_responses'),
+        ),
+        request_phases=settings.get('zipkin.trace_request_phases'),
+        use_contextvars_stack=use_contextvars_stack,
+        transport_defers_encoding=_defers_encoding(transport_handler, None),
+        firehose_defers_encoding=firehose_handler is None or _defers_encoding(
+            firehose_handler,
+            None,
+        ),
+        sampling=sampling_settings_from_settings(settings),
+        slow_request_threshold=_get_optional_seconds(
+            settings,
+            'zipkin.slow_request_threshold_ms',
+        ),
+        metrics_recorder=settings.get('zipkin.metrics_recorder'),
+        fan_out_handler=_get_fan_out_handler(
+            transport_handler,
+            firehose_handler,
+            None,
+        ),
+        set_extra_binary_annotations=set_extra_binary_annotations,
+        hooks_only_when_reported=asbool(
+            settings.get('zipkin.hooks_only_when_reported'),
+        ),
+        annotate_hook_durations=asbool(
+            settings.get('zipkin.annotate_hook_durations'),
+        ),
+        record_cpu_time=asbool(settings.get('zipkin.record_cpu_time')),
+        record_gc_pauses=asbool(settings.get('zipkin.record_gc_pauses')),
+        request_start_environ_key=_get_request_start_environ_key(settings),
+        backdate_to_request_start=asbool(
+            settings.get('zipkin.backdate_to_request_start'),
+        ),
+        aggregate_spans_min_count=_get_aggregate_spans_min_count(settings),
+        aggregate_spans_max_duration=_get_optional_seconds(
+            settings,
+            'zipkin.aggregate_spans_max_duration_ms',
+        ),
     )
 
+
+def _get_settings_from_request(
+    request: Request,
+    compiled_settings: Optional[_CompiledSettings] = None,
+) -> _ZipkinSettings:
+    """Extracts Zipkin attributes and configuration from request attributes.
+
+    :param compiled_settings: the settings compiled by `includeme`. They're
+        compiled from the registry's settings on every request otherwise.
+    """
+    if compiled_settings is None:
+        compiled_settings = _compile_settings(request.registry.settings)
+
+    sampling = compiled_settings.sampling
+    # Pyramid only matches the route after the tweens, it's matched at most
+    # once, for both the sampling decision and the firehose.
+    get_route_name = _route_name_getter()
+    if compiled_settings.create_zipkin_attr is create_zipkin_attr:
+        zipkin_attrs = create_zipkin_attr(request, sampling, get_route_name)
+    else:
+        zipkin_attrs = compiled_settings.create_zipkin_attr(request)
+    # Stored in the request object so that they're still available once we
+    # leave the pyramid_zipkin tween, e.g. to log them in the pyramid
+    # exc_logger, which runs after all tweens have been exited.
+    request.zipkin_trace_id = zipkin_attrs.trace_id
+    request.zipkin_span_id = zipkin_attrs.span_id
+
     # If the incoming request doesn't have Zipkin headers, this request is
     # assumed to be the root span of a trace. There's also a configuration
     # override to allow services to write their own logic for reporting
     # timestamp/duration.
-    if 'zipkin.report_root_timestamp' in settings:
-        report_root_timestamp = settings['zipkin.report_root_timestamp']
-    else:
+    report_root_timestamp = compiled_settings.report_root_timestamp_setting
+    if report_root_timestamp is None:
         report_root_timestamp = 'X-B3-TraceId' not in request.headers
-    zipkin_host = settings.get('zipkin.host')
-    zipkin_port = settings.get('zipkin.port', request.server_port)
-    firehose_handler = settings.get('zipkin.firehose_handler')
-    post_handler_hook = settings.get('zipkin.post_handler_hook')
-    max_span_batch_size = settings.get('zipkin.max_span_batch_size')
-    use_pattern_as_span_name = bool(
-        settings.get('zipkin.use_pattern_as_span_name', False),
+    port = compiled_settings.port_setting
+    if port is None:
+        port = request.server_port
+    # Only use the firehose_handler if the current request is not
+    # blacklisted. This prevents py_zipkin from emitting firehose spans for
+    # blacklisted paths like /status
+    use_firehose = compiled_settings.firehose_handler is not None and not (
+        should_not_sample_path(request, sampling.blacklisted_paths) or
+        should_not_sample_route(
+            request,
+            get_route_name,
+            sampling.blacklisted_routes,
+        )
     )
-    encoding = settings.get('zipkin.encoding', Encoding.V2_JSON)
-    return _ZipkinSettings(
+    context_stack = None
+    if compiled_settings.request_context is not None:
+        try:
+            context_stack = compiled_settings.request_context(request)
+        except AttributeError:
+            pass
+
+    return _ZipkinSettings._make((
         zipkin_attrs,
-        transport_handler,
-        service_name,
-        span_name,
-        add_logging_annotation,
-        report_root_timestamp,
-        zipkin_host,
-        zipkin_port,
+        f'{request.method} {request.path}',
         context_stack,
-        firehose_handler,
-        post_handler_hook,
-        max_span_batch_size,
-        use_pattern_as_span_name,
-        encoding=encoding,
+        report_root_timestamp,
+        port,
+        use_firehose,
+        compiled_settings,
+    ))
+
+
+def _register_compiled_settings(registry: Registry) -> None:
+    """Config action compiling the settings into an :class:`IZipkinSettings`
+    utility, so that a misconfiguration fails at startup. The registry's
+    settings are left as they are. A `SamplingControl` is created unless one
+    is already set, as are a `RouteReservoir` if
+    `zipkin.min_traces_per_route` is set, an `ErrorRateBoost` if
+    `zipkin.error_boost_threshold` is set and a `MetricsRecorder` if
+    `zipkin.metrics_handler` is set. The handlers are called from a thread
+    pool if `zipkin.fan_out_max_workers` is set, with at most
+    `zipkin.fan_out_max_pending` payloads waiting, which is only done here so
+    that there's a single pool.
+    """
+    settings = registry.settings
+    compiled_settings = _compile_settings(settings)
+    fan_out_max_workers = _get_optional_int(
+        settings,
+        'zipkin.fan_out_max_workers',
+    )
+    if fan_out_max_workers is not None and \
+            compiled_settings.fan_out_handler is not None:
+        compiled_settings = compiled_settings._replace(
+            fan_out_handler=_get_fan_out_handler(
+                compiled_settings.transport_handler,
+                compiled_settings.firehose_handler,
+                fan_out_max_workers,
+                _get_optional_int(settings, 'zipkin.fan_out_max_pending'),
+            ),
+        )
+    sampling = compiled_settings.sampling
+    if sampling.sampling_control is None:
+        sampling = sampling._replace(
+            sampling_control=sampling_control_from_settings(settings),
+        )
+    if sampling.route_reservoir is None and \
+            settings.get('zipkin.min_traces_per_route') is not None:
+        sampling = sampling._replace(
+            route_reservoir=route_reservoir_from_settings(settings),
+        )
+    if sampling.error_boost is None and \
+            settings.get('zipkin.error_boost_threshold') is not None:
+        sampling = sampling._replace(
+            error_boost=error_rate_boost_from_settings(settings),
+        )
+    compiled_settings = compiled_settings._replace(sampling=sampling)
+    if compiled_settings.metrics_recorder is None and \
+            settings.get('zipkin.metrics_handler') is not None:
+        from pyramid_zipkin.metrics import metrics_recorder_from_settings
+        compiled_settings = compiled_settings._replace(
+            metrics_recorder=metrics_recorder_from_settings(settings),
+        )
+    registry.registerUtility(compiled_settings, IZipkinSettings)
+
+
+def _check_callable(settings: Dict[str, Any], key: str, value: Any) -> None:
+    if not callable(value):
+        raise ZipkinError(f'`{key}` must be callable, not {value!r}')
+
+
+def _get_optional_int(settings: Dict[str, Any], key: str) -> Optional[int]:
+    value = settings.get(key)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ZipkinError(f'`{key}` must be an integer, not {value!r}')
+
+
+def _get_optional_seconds(settings: Dict[str, Any], key: str) -> Optional[float]:
+    """Converts a setting in milliseconds to seconds."""
+    milliseconds = _get_optional_int(settings, key)
+    return None if milliseconds is None else milliseconds / 1000
+
+
+def _get_request_start_environ_key(settings: Dict[str, Any]) -> Optional[str]:
+    header = settings.get('zipkin.request_start_header')
+    if header is None:
+        return None
+    if not isinstance(header, str) or not header:
+        raise ZipkinError(
+            '`zipkin.request_start_header` must be a header name, not'
+            f' {header!r}'
+        )
+    return _header_environ_key(header)
+
+
+def _get_aggregate_spans_min_count(settings: Dict[str, Any]) -> Optional[int]:
+    min_count = _get_optional_int(settings, 'zipkin.aggregate_spans_min_count')
+    if min_count is not None and min_count < 2:
+        raise ZipkinError(
+            '`zipkin.aggregate_spans_min_count` must be at least 2, not'
+            f' {min_count!r}'
+        )
+    return min_count
+
+
+def _get_encoding(settings: Dict[str, Any]) -> Encoding:
+    value = settings.get('zipkin.encoding', Encoding.V2_JSON)
+    try:
+        return Encoding(value)
+    except ValueError:
+        raise ZipkinError(
+            '`zipkin.encoding` must be one of '
+            f'{", ".join(e.value for e in Encoding)}, not {value!r}'
+        )
+
+
+def _get_fan_out_handler(
+    transport_handler: Any,
+    firehose_handler: Optional[Any],
+    max_workers: Optional[int],
+    max_pending: Optional[int] = None,
+) -> Optional['FanOutTransport']:
+    """Handler emitting the spans of sampled requests to both the firehose
+    and the transport, so that they're only encoded once.
+    """
+    if firehose_handler is None:
+        return None
+    from pyramid_zipkin.transport import FanOutTransport
+    return FanOutTransport(
+        [firehose_handler, transport_handler],
+        max_workers,
+        max_pending,
+    )
+
+
+def _defers_encoding(
+    transport_handler: Any,
+    firehose_handler: Optional[Any],
+) -> bool:
+    """Whether every handler the spans are emitted to encodes them in the
+    background, in which case they can be handed over unencoded.
+    """
+    transport = sys.modules.get('pyramid_zipkin.transport')
+    if transport is None:
+        # Nothing could have created a BackgroundEncodingTransport.
+        return False
+    return isinstance(
+        transport_handler,
+        transport.BackgroundEncodingTransport,
+    ) and (
+        firehose_handler is None or
+        isinstance(firehose_handler, transport.BackgroundEncodingTransport)
     )
 
 
@@ -160,71 +574,475 @@ def zipkin_tween(handler: Handler, registry: Registry) -> Handler:
     Consumes custom create_zipkin_attr function if one is set in the pyramid
     registry.
 
+    Uses the settings compiled by `includeme` if the registry has them, and
+    reads them from the registry on every request otherwise, for apps adding
+    the tween on their own.
+
     :param handler: pyramid request handler
     :param registry: pyramid app registry
 
     :returns: pyramid tween
     """
+    compiled_settings = None
+    if isinstance(registry, Registry):
+        compiled_settings = registry.queryUtility(IZipkinSettings)
+
     def tween(request: Request) -> Response:
-        zipkin_settings = _get_settings_from_request(request)
+        zipkin_settings = _get_settings_from_request(request, compiled_settings)
+        settings = zipkin_settings.compiled_settings
         tracer = get_default_tracer()
 
         tween_kwargs = dict(
-            service_name=zipkin_settings.service_name,
+            service_name=settings.service_name,
             span_name=zipkin_settings.span_name,
             zipkin_attrs=zipkin_settings.zipkin_attrs,
-            transport_handler=zipkin_settings.transport_handler,
-            host=zipkin_settings.host,
+            transport_handler=settings.transport_handler,
+            host=settings.host,
             port=zipkin_settings.port,
-            add_logging_annotation=zipkin_settings.add_logging_annotation,
+            add_logging_annotation=settings.add_logging_annotation,
             report_root_timestamp=zipkin_settings.report_root_timestamp,
             context_stack=zipkin_settings.context_stack,
-            max_span_batch_size=zipkin_settings.max_span_batch_size,
-            encoding=zipkin_settings.encoding,
+            max_span_batch_size=settings.max_span_batch_size,
+            encoding=settings.encoding,
             kind=Kind.SERVER,
         )
 
-        # Only set the firehose_handler if it's defined and only if the current
-        # request is not blacklisted. This prevents py_zipkin from emitting
-        # firehose spans for blacklisted paths like /status
-        if zipkin_settings.firehose_handler is not None and \
-                not should_not_sample_path(request) and \
-                not should_not_sample_route(request):
-            tween_kwargs['firehose_handler'] = zipkin_settings.firehose_handler
-
-        with tracer.zipkin_span(**tween_kwargs) as zipkin_context:
-            response = None
-            try:
-                response = handler(request)
-            except Exception as e:
-                exception_type = type(e).__name__
-                exception_stacktrace = traceback.format_exc()
-                zipkin_context.update_binary_annotations({
-                    'error.type': exception_type,
-                    'response_status_code': '500',
-                    'http.response.status_code': '500',
-                    'exception.stacktrace': exception_stacktrace,
-                })
-                zipkin_context.add_annotation(exception_type)
-                raise e
-            finally:
-                if zipkin_settings.use_pattern_as_span_name \
-                        and request.matched_route:
-                    zipkin_context.override_span_name('{} {}'.format(
-                        request.method,
-                        request.matched_route.pattern,
-                    ))
-                zipkin_context.update_binary_annotations(
-                    get_binary_annotations(request, response),
+        if zipkin_settings.use_firehose:
+            if zipkin_settings.zipkin_attrs.is_sampled:
+                # py_zipkin would encode the spans once per handler.
+                tween_kwargs['transport_handler'] = \
+                    settings.fan_out_handler
+            else:
+                tween_kwargs['firehose_handler'] = \
+                    settings.firehose_handler
+
+        if settings.use_contextvars_stack:
+            _use_context_var_stack(tracer)
+
+        with ExitStack() as exit_stack:
+            exit_stack.callback(
+                setattr,
+                tracer,
+                '_span_storage',
+                tracer._span_storage,
+            )
+            # zipkin_span.__exit__'s signature is missing an Optional.
+            zipkin_context: zipkin_span = exit_stack.enter_context(
+                tracer.zipkin_span(**tween_kwargs),  # type: ignore[arg-type]
+            )
+            _configure_logging_context(
+                zipkin_context,
+                zipkin_settings,
+                tracer,
+                request,
+                exit_stack,
+            )
+            queue_duration = None
+            if settings.request_start_environ_key is not None:
+                queue_duration = _get_queue_duration(
+                    request,
+                    zipkin_context,
+                    zipkin_settings,
                 )
 
-                if zipkin_settings.post_handler_hook:
-                    zipkin_settings.post_handler_hook(
-                        request,
-                        response,
-                        zipkin_context
-                    )
+            if is_sampled(zipkin_context):
+                request.zipkin_server_span = zipkin_context
+            request_phases = None
+            if settings.request_phases:
+                from pyramid_zipkin.phases import start_request_phases
+                request_phases = start_request_phases(
+                    request,
+                    zipkin_context,
+                    tracer,
+                    settings.request_phases,
+                )
+
+            response = _handle_request(
+                handler,
+                request,
+                zipkin_context,
+                zipkin_settings,
+                request_phases,
+                queue_duration,
+            )
+
+            if settings.trace_streaming_responses and \
+                    zipkin_context.logging_context is not None and \
+                    _is_streaming(response.app_iter, request.environ):
+                # The span is going to be closed by the WSGI server, once
+                # it's done iterating over the response.
+                content_length = response.content_length
+                response.app_iter = _TracedAppIter(
+                    response.app_iter,
+                    zipkin_context,
+                    exit_stack.pop_all(),
+                )
+                response.content_length = content_length
 
             return response
 
     return tween
+
+
+def _is_streaming(app_iter: Iterable[bytes], environ: Dict[str, Any]) -> bool:
+    """Whether the response's body is generated while the WSGI server
+    iterates over it. Wrapping the server's `wsgi.file_wrapper` would stop
+    it from sending the file with sendfile().
+    """
+    if isinstance(app_iter, (list, tuple)):
+        return False
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    return not (
+        isinstance(file_wrapper, type) and isinstance(app_iter, file_wrapper)
+    )
+
+
+def _use_context_var_stack(tracer: Tracer) -> None:
+    from pyramid_zipkin.context import context_var_stack
+    if tracer._context_stack is not context_var_stack:
+        # Set directly, passing it as `context_stack` to zipkin_span
+        # would log a deprecation warning on every request.
+        tracer._context_stack = context_var_stack
+
+
+def _configure_logging_context(
+    zipkin_context: zipkin_span,
+    zipkin_settings: _ZipkinSettings,
+    tracer: Tracer,
+    request: Request,
+    exit_stack: ExitStack,
+) -> None:
+    """Applies the settings that py_zipkin's `zipkin_span` doesn't take as
+    arguments to the root span's logging context. There's no logging context
+    if the spans aren't going to be emitted.
+
+    The callbacks that need to run right before the root span is emitted are
+    pushed onto `exit_stack`.
+    """
+    logging_context = zipkin_context.logging_context
+    if logging_context is None:
+        return
+    settings = zipkin_settings.compiled_settings
+
+    if settings.encoder is not None:
+        logging_context.encoder = settings.encoder
+    emits_to_firehose = logging_context.firehose_handler is not None or \
+        logging_context.transport_handler is settings.fan_out_handler
+    if settings.transport_defers_encoding and (
+        not emits_to_firehose or settings.firehose_defers_encoding
+    ):
+        from pyramid_zipkin.transport import DeferredEncoder
+        deferred_encoder = DeferredEncoder(
+            logging_context.encoder,
+            _initial_span_priority(request, zipkin_settings),
+        )
+        logging_context.encoder = deferred_encoder
+        exit_stack.callback(
+            _raise_span_priority,
+            deferred_encoder,
+            zipkin_context,
+            logging_context.tags,
+            zipkin_settings,
+        )
+
+    if settings.aggregate_spans_min_count is not None:
+        exit_stack.callback(
+            _aggregate_child_spans,
+            tracer,
+            settings.aggregate_spans_min_count,
+            settings.aggregate_spans_max_duration,
+        )
+
+    if (
+        settings.incremental_flush_spans is None and
+        settings.incremental_flush_bytes is None and
+        settings.max_child_spans is None
+    ):
+        return
+    from pyramid_zipkin.storage import IncrementalSpanStorage
+    span_storage = IncrementalSpanStorage(
+        logging_context,
+        flush_spans=settings.incremental_flush_spans,
+        flush_bytes=settings.incremental_flush_bytes,
+        max_spans=settings.max_child_spans,
+        aggregate_min_count=settings.aggregate_spans_min_count,
+        aggregate_max_duration=settings.aggregate_spans_max_duration,
+    )
+    tracer._span_storage = span_storage
+    exit_stack.callback(_add_dropped_spans_tag, zipkin_context, span_storage)
+
+
+def _get_queue_duration(
+    request: Request,
+    zipkin_context: zipkin_span,
+    zipkin_settings: _ZipkinSettings,
+) -> Optional[float]:
+    """Time the request spent queued between the load balancer that set
+    `zipkin.request_start_header` and the start of the server span, or None
+    if the header is missing or invalid. It's added to the server span if
+    it's reported, which is then backdated to the request's start if
+    `zipkin.backdate_to_request_start` is set.
+    """
+    settings = zipkin_settings.compiled_settings
+    request_start = parse_request_start(
+        request.environ.get(settings.request_start_environ_key),
+    )
+    if request_start is None:
+        return None
+    # The load balancer's clock may be ahead of this host's.
+    queue_duration = max(zipkin_context.start_timestamp - request_start, 0.0)
+    logging_context = zipkin_context.logging_context
+    if logging_context is not None:
+        zipkin_context.update_binary_annotations({
+            'queue.duration_ms': f'{queue_duration * 1000:.3f}',
+        })
+        if settings.backdate_to_request_start:
+            logging_context.start_timestamp -= queue_duration
+    return queue_duration
+
+
+def _initial_span_priority(
+    request: Request,
+    zipkin_settings: _ZipkinSettings,
+) -> int:
+    """Priority of the spans of a request when they're handed over to a
+    background transport: high with the debug flag, normal if the caller
+    asked for the request to be sampled and low if the tracing percent
+    picked it.
+    """
+    from pyramid_zipkin.transport import SPAN_PRIORITY_HIGH
+    from pyramid_zipkin.transport import SPAN_PRIORITY_LOW
+    from pyramid_zipkin.transport import SPAN_PRIORITY_NORMAL
+
+    if parse_b3_flags(zipkin_settings.zipkin_attrs.flags) & B3_DEBUG_FLAG:
+        return SPAN_PRIORITY_HIGH
+    if request.headers.get('X-B3-Sampled') == '1':
+        return SPAN_PRIORITY_NORMAL
+    return SPAN_PRIORITY_LOW
+
+
+def _raise_span_priority(
+    deferred_encoder: 'DeferredEncoder',
+    zipkin_context: zipkin_span,
+    tags: Dict[str, Optional[str]],
+    zipkin_settings: _ZipkinSettings,
+) -> None:
+    """Raises the priority of the spans of a request that failed or took more
+    than `zipkin.slow_request_threshold_ms`, right before they're emitted.
+    Spans flushed while the request was running keep the initial priority.
+    """
+    from pyramid_zipkin.transport import SPAN_PRIORITY_HIGH
+
+    status_code = tags.get('http.response.status_code')
+    slow_request_threshold = \
+        zipkin_settings.compiled_settings.slow_request_threshold
+    if (
+        'error.type' in tags or
+        (status_code is not None and int(status_code) >= 500) or
+        (
+            slow_request_threshold is not None and
+            time.time() - zipkin_context.start_timestamp >=
+            slow_request_threshold
+        )
+    ):
+        deferred_encoder.priority = SPAN_PRIORITY_HIGH
+
+
+def _handle_request(
+    handler: Handler,
+    request: Request,
+    zipkin_context: zipkin_span,
+    zipkin_settings: _ZipkinSettings,
+    request_phases: Optional['RequestPhases'],
+    queue_duration: Optional[float],
+) -> Response:
+    settings = zipkin_settings.compiled_settings
+    response = None
+    resource_usage = None
+    if (
+        settings.record_cpu_time or settings.record_gc_pauses
+    ) and is_sampled(zipkin_context):
+        from pyramid_zipkin.resource_usage import ResourceUsage
+        resource_usage = ResourceUsage(
+            settings.record_cpu_time,
+            settings.record_gc_pauses,
+        )
+        resource_usage.start()
+    start = time.perf_counter()
+    try:
+        response = handler(request)
+    except Exception as e:
+        exception_type = type(e).__name__
+        exception_stacktrace = traceback.format_exc()
+        zipkin_context.update_binary_annotations({
+            'error.type': exception_type,
+            'response_status_code': '500',
+            'http.response.status_code': '500',
+            'exception.stacktrace': exception_stacktrace,
+        })
+        zipkin_context.add_annotation(exception_type)
+        raise e
+    finally:
+        if resource_usage is not None:
+            zipkin_context.update_binary_annotations(resource_usage.stop())
+        if request_phases is not None:
+            request_phases.finish()
+        if settings.use_pattern_as_span_name \
+                and request.matched_route:
+            zipkin_context.override_span_name('{} {}'.format(
+                request.method,
+                request.matched_route.pattern,
+            ))
+        duration = time.perf_counter() - start
+        zipkin_context.update_binary_annotations(
+            get_binary_annotations(
+                request,
+                response,
+                extra_binary_annotations=False,
+            ),
+        )
+        hook_durations: Dict[str, float] = {}
+        try:
+            # Spans that aren't reported have no logging context.
+            if not settings.hooks_only_when_reported or \
+                    zipkin_context.logging_context is not None:
+                _run_hooks(
+                    request,
+                    response,
+                    zipkin_context,
+                    zipkin_settings,
+                    hook_durations,
+                )
+        finally:
+            route_name = request.matched_route.name \
+                if request.matched_route else None
+            status_code = 500 if response is None else response.status_code
+            if settings.metrics_recorder is not None:
+                settings.metrics_recorder.record(
+                    route_name,
+                    duration,
+                    status_code,
+                    hook_durations,
+                    queue_duration,
+                )
+            if settings.sampling.error_boost is not None:
+                settings.sampling.error_boost.record(
+                    route_name,
+                    status_code >= 500,
+                )
+
+    return response
+
+
+def _run_hooks(
+    request: Request,
+    response: Optional[Response],
+    zipkin_context: zipkin_span,
+    zipkin_settings: _ZipkinSettings,
+    hook_durations: Dict[str, float],
+) -> None:
+    """Runs the user's hooks, and stores how long each of them took in
+    `hook_durations`, even if it raised.
+    """
+    settings = zipkin_settings.compiled_settings
+    hook = settings.set_extra_binary_annotations
+    if hook is not None:
+        start = time.perf_counter()
+        try:
+            zipkin_context.update_binary_annotations(hook(request, response))
+        finally:
+            hook_durations['set_extra_binary_annotations'] = \
+                time.perf_counter() - start
+
+    hook = settings.post_handler_hook
+    if hook is not None:
+        start = time.perf_counter()
+        try:
+            hook(request, response, zipkin_context)
+        finally:
+            hook_durations['post_handler_hook'] = time.perf_counter() - start
+
+    if settings.annotate_hook_durations and hook_durations:
+        zipkin_context.update_binary_annotations({
+            f'zipkin.{name}.duration_ms': f'{hook_duration * 1000:.3f}'
+            for name, hook_duration in hook_durations.items()
+        })
+
+
+def _aggregate_child_spans(
+    tracer: Tracer,
+    min_count: int,
+    max_duration: Optional[float],
+) -> None:
+    """Aggregates the child spans stored for the request, right before
+    they're emitted with the server span.
+    """
+    from pyramid_zipkin.aggregation import aggregate_spans
+    span_storage = tracer._span_storage
+    spans = aggregate_spans(span_storage, min_count, max_duration)
+    if len(spans) < len(span_storage):
+        span_storage.clear()
+        span_storage.extend(spans)
+
+
+def _add_dropped_spans_tag(
+    zipkin_context: zipkin_span,
+    span_storage: 'IncrementalSpanStorage',
+) -> None:
+    if span_storage.dropped:
+        zipkin_context.update_binary_annotations({
+            'zipkin.dropped_spans': str(span_storage.dropped),
+        })
+
+
+class _TracedAppIter:
+    """Wraps a streaming response body so that the server span only ends when
+    the WSGI server closes it. Records the time the first chunk of the body
+    was produced as the `wsgi.first_byte` annotation and the number of bytes
+    streamed as the `http.response.body.size` tag.
+
+    :param app_iter: the response's original app_iter.
+    :param zipkin_context: the request's server span.
+    :param exit_stack: exits the server span when closed.
+    """
+
+    def __init__(
+        self,
+        app_iter: Iterable[bytes],
+        zipkin_context: zipkin_span,
+        exit_stack: ExitStack,
+    ) -> None:
+        self.app_iter = app_iter
+        self.zipkin_context = zipkin_context
+        self.exit_stack = exit_stack
+        self.body_size = 0
+        self._exc_info: Tuple[Any, Any, Any] = (None, None, None)
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            for chunk in self.app_iter:
+                if chunk and not self.body_size:
+                    self.zipkin_context.add_annotation('wsgi.first_byte')
+                self.body_size += len(chunk)
+                yield chunk
+        except Exception as e:
+            # The status code has already been sent, so unlike errors raised
+            # by the view this doesn't override it.
+            self._exc_info = sys.exc_info()
+            self.zipkin_context.update_binary_annotations({
+                'error.type': type(e).__name__,
+                'exception.stacktrace': traceback.format_exc(),
+            })
+            self.zipkin_context.add_annotation(type(e).__name__)
+            raise
+
+    def close(self) -> None:
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.zipkin_context.update_binary_annotations({
+                'http.response.body.size': str(self.body_size),
+            })
+            self.exit_stack.__exit__(*self._exc_info)
@@ -25,6 +25,9 @@ setup(
         'py_zipkin >= 0.18.1',
         'pyramid',
     ],
+    extras_require={
+        'client': ['requests'],
+    },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
@@ -1,3 +1,7 @@
+import io
+import time
+from types import MappingProxyType
+
 from py_zipkin import Encoding
 from py_zipkin.zipkin import create_http_headers_for_new_span
 from py_zipkin.zipkin import zipkin_span
@@ -6,6 +10,9 @@ from pyramid.response import Response
 from pyramid.tweens import EXCVIEW
 from pyramid.view import view_config
 
+from pyramid_zipkin.client import session_from_settings
+from pyramid_zipkin.zipkin import create_http_headers_for_request
+
 
 @view_config(route_name='sample_route', renderer='json')
 def sample(dummy_request):
@@ -58,6 +65,106 @@ def span_context(dummy_request):
             return {}
 
 
+@view_config(route_name='many_spans', renderer='json')
+def many_spans(dummy_request):
+    count = int(dummy_request.params.get('count', 10))
+    for i in range(count):
+        with zipkin_span(
+            service_name='child',
+            span_name='query',
+            binary_annotations={'index': str(i)},
+        ):
+            pass
+    return {'count': count}
+
+
+@view_config(route_name='repeated_spans', renderer='json')
+def repeated_spans(dummy_request):
+    count = int(dummy_request.params.get('count', 10))
+    with zipkin_span(service_name='child', span_name='get'):
+        for i in range(count):
+            with zipkin_span(
+                service_name='cache',
+                span_name='get',
+                binary_annotations={'index': str(i)},
+            ):
+                pass
+        with zipkin_span(service_name='db', span_name='query'):
+            pass
+        for i in range(count):
+            with zipkin_span(service_name='cache', span_name='get'):
+                pass
+    return {'count': count}
+
+
+@view_config(route_name='streaming')
+def streaming(dummy_request):
+    def body():
+        yield b''
+        with zipkin_span(service_name='child', span_name='chunk'):
+            time.sleep(0.05)
+        yield b'foo'
+        if 'fail' in dummy_request.params:
+            raise ValueError('stream broken')
+        yield b'bar'
+
+    return Response(app_iter=body(), content_length=6)
+
+
+def pets_root_factory(request):
+    return {'pets': {'42': {'name': 'Rex'}}}
+
+
+@view_config(route_name='phases', renderer='json')
+def phases(dummy_request):
+    return {'name': dummy_request.context['name']}
+
+
+@view_config(route_name='large_json', renderer='json')
+def large_json(dummy_request):
+    count = int(dummy_request.params.get('count', 1000))
+    return [{'id': i, 'name': f'item {i}'} for i in range(count)]
+
+
+@view_config(route_name='file_wrapper')
+def file_wrapper(dummy_request):
+    file_wrapper = dummy_request.environ['wsgi.file_wrapper']
+    return Response(
+        app_iter=file_wrapper(io.BytesIO(b'foobar')),
+        content_length=6,
+    )
+
+
+@view_config(route_name='string_renderer', renderer='string')
+def string_renderer(dummy_request):
+    return 'héllo'
+
+
+@view_config(route_name='fan_out', renderer='json')
+def fan_out(dummy_request):
+    calls = int(dummy_request.params.get('calls', 3))
+    headers = [
+        create_http_headers_for_request(dummy_request) for _ in range(calls)
+    ]
+    with zipkin_span(service_name='child', span_name='batch'):
+        headers.append(create_http_headers_for_request(dummy_request))
+    return [dict(h) for h in headers] + [
+        {
+            'same_mapping': headers[0] is headers[1],
+            'read_only': all(
+                isinstance(h, MappingProxyType) for h in headers
+            ),
+        },
+    ]
+
+
+@view_config(route_name='client_call', renderer='json')
+def client_call(dummy_request):
+    session = dummy_request.registry.zipkin_session
+    response = session.get(dummy_request.params['url'], timeout=5)
+    return {'status_code': response.status_code}
+
+
 @view_config(route_name='decorator_context', renderer='json')
 def decorator_context(dummy_request):
 
@@ -124,6 +231,15 @@ def main(global_config, **settings):
     config.add_route('sample_route_child_span', '/sample_child_span')
     config.add_route('span_context', '/span_context')
     config.add_route('decorator_context', '/decorator_context')
+    config.add_route('many_spans', '/many_spans')
+    config.add_route('repeated_spans', '/repeated_spans')
+    config.add_route('streaming', '/streaming')
+    config.add_route('file_wrapper', '/file_wrapper')
+    config.add_route('phases', '/phases/*traverse', factory=pets_root_factory)
+    config.add_route('large_json', '/large_json')
+    config.add_route('string_renderer', '/string_renderer')
+    config.add_route('fan_out', '/fan_out')
+    config.add_route('client_call', '/client_call')
     config.add_route('pattern_route', '/pet/{petId}')
 
     config.add_route('server_error', '/server_error')
@@ -133,6 +249,10 @@ def main(global_config, **settings):
 
     config.scan()
 
+    config.include('pyramid_zipkin.phases')
+    config.include('pyramid_zipkin.renderers')
+    config.registry.zipkin_session = session_from_settings(settings)
+
     config.add_tween('pyramid_zipkin.tween.zipkin_tween', over=EXCVIEW)
 
     return config.make_wsgi_app()
@@ -0,0 +1,288 @@
+import json
+from unittest import mock
+
+import pytest
+from py_zipkin.zipkin import ZipkinAttrs
+from pyramid.config import Configurator
+from pyramid.exceptions import ConfigurationExecutionError
+from pyramid.interfaces import IRequestExtensions
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin.sampling import ErrorRateBoost
+from pyramid_zipkin.sampling import RouteReservoir
+from pyramid_zipkin.sampling import SamplingControl
+from pyramid_zipkin.sampling import SamplingRules
+from pyramid_zipkin.tween import IZipkinSettings
+from tests.acceptance.test_helper import MockTransport
+
+
+def _make_app(settings):
+    config = Configurator(settings=settings)
+    config.include('pyramid_zipkin')
+    config.add_route('sample_route', '/sample')
+    config.add_view(
+        lambda request: {},
+        route_name='sample_route',
+        renderer='json',
+    )
+    return config.make_wsgi_app()
+
+
+def test_includeme_compiles_settings():
+    transport = MockTransport()
+    app = _make_app({
+        'zipkin.transport_handler': transport,
+        'zipkin.tracing_percent': '100',
+        'zipkin.use_pattern_as_span_name': 'true',
+    })
+
+    compiled_settings = app.registry.getUtility(IZipkinSettings)
+    assert compiled_settings.transport_handler is transport
+    assert compiled_settings.sampling.tracing_percent == 100.0
+    # The user's settings are left as they are.
+    assert app.registry.settings['zipkin.tracing_percent'] == '100'
+
+    WebTestApp(app).get('/sample', status=200)
+
+    span, = json.loads(transport.output[0])
+    assert span['name'] == 'GET /sample'
+    assert span['kind'] == 'SERVER'
+
+
+def test_includeme_includes_enabled_features():
+    transport = MockTransport()
+    app = _make_app({
+        'zipkin.transport_handler': transport,
+        'zipkin.tracing_percent': '100',
+        'zipkin.trace_request_phases': 'spans',
+        'zipkin.trace_renderers': 'spans',
+    })
+
+    WebTestApp(app).get('/sample', status=200)
+
+    span_names = {span['name'] for span in json.loads(transport.output[0])}
+    assert {'pyramid.view', 'render json'} <= span_names
+
+
+def test_includeme_uses_the_compiled_settings():
+    transport = MockTransport()
+    app = _make_app({
+        'zipkin.transport_handler': transport,
+        'zipkin.tracing_percent': 100,
+    })
+    # Changing the settings once the app is configured has no effect.
+    app.registry.settings['zipkin.transport_handler'] = MockTransport()
+
+    WebTestApp(app).get('/sample', status=200)
+
+    assert len(transport.output) == 1
+
+
+@pytest.mark.parametrize('settings', [
+    {},
+    {'zipkin.transport_handler': MockTransport(), 'zipkin.encoding': 'json'},
+    {'zipkin.transport_handler': MockTransport(), 'zipkin.tracing_percent': 'x'},
+])
+def test_includeme_fails_on_invalid_settings(settings):
+    with pytest.raises(ConfigurationExecutionError) as e:
+        _make_app(settings)
+
+    assert 'ZipkinError' in str(e.value)
+
+
+def test_includeme_leaves_the_settings_alone():
+    settings = {
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.tracing_percent': '25',
+        'zipkin.blacklisted_paths': [r'^/favicon'],
+    }
+    app = _make_app(dict(settings))
+
+    with mock.patch(
+        'pyramid_zipkin.request_helper.re.compile',
+    ) as mock_compile:
+        WebTestApp(app).get('/sample', status=200)
+
+    assert not mock_compile.called
+    assert {
+        key: value for key, value in app.registry.settings.items()
+        if key.startswith('zipkin.')
+    } == settings
+
+
+def test_includeme_creates_a_sampling_control():
+    app = _make_app({
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.tracing_percent': '25',
+    })
+
+    sampling = app.registry.getUtility(IZipkinSettings).sampling
+    assert sampling.sampling_control.state == (True, 25.0, {})
+
+
+def test_includeme_keeps_the_sampling_control():
+    transport = MockTransport()
+    control = SamplingControl(tracing_percent=100)
+    app = _make_app({
+        'zipkin.transport_handler': transport,
+        'zipkin.sampling_control': control,
+    })
+    control.update(enabled=False)
+
+    WebTestApp(app).get('/sample', status=200)
+
+    sampling = app.registry.getUtility(IZipkinSettings).sampling
+    assert sampling.sampling_control is control
+    assert transport.output == []
+
+
+def test_includeme_creates_a_metrics_recorder():
+    handler = mock.Mock()
+    app = _make_app({
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.metrics_handler': handler,
+    })
+    recorder = app.registry.getUtility(IZipkinSettings).metrics_recorder
+
+    WebTestApp(app).get('/sample', status=200)
+    recorder.stop()
+
+    [snapshot], _ = handler.call_args
+    assert snapshot['sample_route'].statuses == {'2xx': 1}
+    assert 'zipkin.metrics_recorder' not in app.registry.settings
+
+
+def test_includeme_calls_transport_and_firehose_from_a_thread_pool():
+    transport = MockTransport()
+    firehose = MockTransport()
+    app = _make_app({
+        'zipkin.transport_handler': transport,
+        'zipkin.firehose_handler': firehose,
+        'zipkin.tracing_percent': 100,
+        'zipkin.fan_out_max_workers': '2',
+        'zipkin.fan_out_max_pending': '10',
+    })
+    fan_out_handler = app.registry.getUtility(IZipkinSettings).fan_out_handler
+
+    WebTestApp(app).get('/sample', status=200)
+
+    assert fan_out_handler.max_workers == 2
+    assert fan_out_handler.max_pending == 10
+    assert fan_out_handler.flush(timeout=5)
+    assert transport.output == firehose.output
+    assert len(transport.output) == 1
+
+
+def test_includeme_keeps_the_zipkin_ids_on_the_request():
+    transport = MockTransport()
+    seen = []
+
+    def view(request):
+        request.add_finished_callback(lambda request: seen.append((
+            request.zipkin_trace_id,
+            request.zipkin_span_id,
+        )))
+        return {}
+
+    config = Configurator(settings={
+        'zipkin.transport_handler': transport,
+        'zipkin.tracing_percent': 100,
+    })
+    config.include('pyramid_zipkin')
+    config.add_route('sample_route', '/sample')
+    config.add_view(view, route_name='sample_route', renderer='json')
+    app = config.make_wsgi_app()
+
+    with mock.patch(
+        'pyramid_zipkin.request_helper.generate_random_128bit_string',
+        return_value='37133d482ba4f605890bccef7abce8f0',
+    ) as mock_generate:
+        WebTestApp(app).get('/sample', status=200)
+
+    # Still available once the tween exited, and only generated once.
+    span, = json.loads(transport.output[0])
+    # Without request methods, which make Pyramid create a request class
+    # per request.
+    assert app.registry.queryUtility(IRequestExtensions) is None
+    assert seen == [(span['traceId'], span['id'])]
+    assert span['traceId'] == '37133d482ba4f605890bccef7abce8f0'
+    assert mock_generate.call_count == 1
+
+
+def test_includeme_doesnt_generate_unused_zipkin_ids():
+    seen = []
+    app = _make_app({
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.create_zipkin_attr': lambda request: ZipkinAttrs(
+            trace_id='37133d482ba4f605890bccef7abce8f0',
+            span_id='17133d482ba4f605',
+            parent_span_id=None,
+            flags='0',
+            is_sampled=False,
+        ),
+        'zipkin.post_handler_hook': lambda request, response, span: seen.append(
+            (request.zipkin_trace_id, request.zipkin_span_id),
+        ),
+    })
+
+    with mock.patch(
+        'pyramid_zipkin.request_helper.generate_random_128bit_string',
+    ) as mock_generate:
+        WebTestApp(app).get('/sample', status=200)
+
+    assert not mock_generate.called
+    # The request has the ids of the trace, not random ones.
+    assert seen == [('37133d482ba4f605890bccef7abce8f0', '17133d482ba4f605')]
+
+
+def test_includeme_compiles_sampling_rules():
+    transport = MockTransport()
+    app = _make_app({
+        'zipkin.transport_handler': transport,
+        'zipkin.tracing_percent': 100,
+        'zipkin.sampling_rules': '[{"path": "/sample", "rate": 0}]',
+    })
+
+    WebTestApp(app).get('/sample', status=200)
+
+    rules = app.registry.getUtility(IZipkinSettings).sampling.sampling_rules
+    assert isinstance(rules, SamplingRules)
+    assert transport.output == []
+
+
+def test_includeme_creates_a_route_reservoir():
+    transport = MockTransport()
+    app = _make_app({
+        'zipkin.transport_handler': transport,
+        'zipkin.tracing_percent': 0,
+        'zipkin.min_traces_per_route': '1',
+    })
+
+    WebTestApp(app).get('/sample', status=200)
+    WebTestApp(app).get('/sample', status=200)
+
+    sampling = app.registry.getUtility(IZipkinSettings).sampling
+    reservoir = sampling.route_reservoir
+    assert isinstance(reservoir, RouteReservoir)
+    assert len(transport.output) == 1
+
+
+def test_includeme_creates_an_error_rate_boost():
+    app = _make_app({
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.error_boost_threshold': '10',
+    })
+
+    WebTestApp(app).get('/sample', status=200)
+
+    boost = app.registry.getUtility(IZipkinSettings).sampling.error_boost
+    assert isinstance(boost, ErrorRateBoost)
+    assert boost._routes['sample_route'].requests == 1
+
+
+def test_includeme_fails_on_invalid_sampling_rules():
+    with pytest.raises(ConfigurationExecutionError):
+        _make_app({
+            'zipkin.transport_handler': MockTransport(),
+            'zipkin.sampling_rules': [{'path': '/sample'}],
+        })
@@ -0,0 +1,114 @@
+import json
+from unittest import mock
+
+import pytest
+from py_zipkin.exception import ZipkinError
+from pyramid.interfaces import IRendererFactory
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import renderers
+from tests.acceptance.test_helper import generate_app_main
+
+
+def _get_spans(transport):
+    [payload] = transport.output
+    return json.loads(payload)
+
+
+def test_renderers_traced_as_tags():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_renderers': 'annotations',
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    response = WebTestApp(app_main).get('/large_json?count=100', status=200)
+
+    [server_span] = _get_spans(transport)
+    tags = server_span['tags']
+    assert tags['pyramid.renderer'] == 'json'
+    assert tags['pyramid.render.size'] == str(len(response.body))
+    assert float(tags['pyramid.render.duration_ms']) >= 0
+
+
+def test_renderers_traced_as_spans():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_renderers': 'spans',
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    response = WebTestApp(app_main).get('/string_renderer', status=200)
+
+    render_span, server_span = _get_spans(transport)
+    assert render_span['name'] == 'render string'
+    assert render_span['parentId'] == server_span['id']
+    assert render_span['tags'] == {'pyramid.render.size': '6'}
+    assert len(response.body) == 6
+
+
+def test_renderers_not_traced_if_not_sampled():
+    settings = {
+        'zipkin.tracing_percent': 0,
+        'zipkin.trace_renderers': 'spans',
+    }
+    app_main, transport, firehose = generate_app_main(settings, firehose=True)
+
+    WebTestApp(app_main).get('/large_json', status=200)
+
+    assert transport.output == []
+    [server_span] = _get_spans(firehose)
+    assert 'pyramid.renderer' not in server_span['tags']
+
+
+def test_renderers_arent_wrapped_by_default():
+    app_main, _, _ = generate_app_main({})
+
+    factory = app_main.registry.getUtility(IRendererFactory, name='json')
+    assert not isinstance(factory, renderers.TracedRendererFactory)
+
+
+def test_renderers_are_wrapped_once():
+    app_main, _, _ = generate_app_main({'zipkin.trace_renderers': 'spans'})
+    registry = app_main.registry
+    renderers._wrap_renderer_factories(registry, as_spans=True)
+
+    factory = registry.getUtility(IRendererFactory, name='json')
+    assert not isinstance(factory.factory, renderers.TracedRendererFactory)
+
+
+def test_renderer_returning_none():
+    factory = renderers.TracedRendererFactory(
+        lambda info: lambda value, system: None,
+        'none',
+        as_spans=False,
+    )
+    request = mock.Mock()
+
+    assert factory(None)({}, {'request': request}) is None
+    [tags], _ = request.zipkin_server_span.update_binary_annotations.call_args
+    assert tags['pyramid.render.size'] == '0'
+
+
+@pytest.mark.parametrize('result,charset,size', [
+    ('héllo', 'latin-1', '5'),
+    ('héllo', None, '6'),
+    (b'h\xc3\xa9llo', 'latin-1', '6'),
+])
+def test_renderer_size_in_bytes(result, charset, size):
+    factory = renderers.TracedRendererFactory(
+        lambda info: lambda value, system: result,
+        'string',
+        as_spans=False,
+    )
+    request = mock.Mock()
+    request.response.charset = charset
+
+    factory(None)({}, {'request': request})
+    [tags], _ = request.zipkin_server_span.update_binary_annotations.call_args
+    assert tags['pyramid.render.size'] == size
+
+
+def test_invalid_renderers_mode():
+    with pytest.raises(ZipkinError):
+        generate_app_main({'zipkin.trace_renderers': 'logs'})
@@ -0,0 +1,136 @@
+import json
+from unittest import mock
+
+import pytest
+from py_zipkin.exception import ZipkinError
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import phases
+from tests.acceptance.test_helper import generate_app_main
+
+
+def _get_spans(transport):
+    [payload] = transport.output
+    return json.loads(payload)
+
+
+def test_request_phases_as_annotations():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_request_phases': 'annotations',
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    response = WebTestApp(app_main).get('/phases/pets/42', status=200)
+
+    assert response.json == {'name': 'Rex'}
+    [server_span] = _get_spans(transport)
+    annotations = server_span['annotations']
+    assert [a['value'] for a in annotations] == [
+        'pyramid.route_match',
+        'pyramid.traversal',
+        'pyramid.view',
+        'pyramid.render',
+        'pyramid.response',
+    ]
+    timestamps = [a['timestamp'] for a in annotations]
+    assert timestamps == sorted(timestamps)
+
+
+def test_request_phases_as_spans():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_request_phases': 'spans',
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    WebTestApp(app_main).get('/phases/pets/42', status=200)
+
+    *phase_spans, server_span = _get_spans(transport)
+    assert [span['name'] for span in phase_spans] == [
+        'pyramid.route_match',
+        'pyramid.traversal',
+        'pyramid.view',
+        'pyramid.render',
+    ]
+    for span in phase_spans:
+        assert span['parentId'] == server_span['id']
+        assert span['localEndpoint'] == server_span['localEndpoint']
+        assert server_span['timestamp'] <= span['timestamp']
+    for span, next_span in zip(phase_spans, phase_spans[1:]):
+        assert span['timestamp'] + span.get('duration', 0) <= \
+            next_span['timestamp'] + 1
+
+
+def test_request_phases_without_renderer():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_request_phases': 'spans',
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    WebTestApp(app_main).get('/server_error', status=500)
+
+    assert [span['name'] for span in _get_spans(transport)[:-1]] == [
+        'pyramid.route_match',
+        'pyramid.traversal',
+        'pyramid.view',
+    ]
+
+
+def test_request_phases_arent_recorded_if_not_sampled():
+    settings = {
+        'zipkin.tracing_percent': 0,
+        'zipkin.trace_request_phases': 'spans',
+    }
+    app_main, transport, firehose = generate_app_main(settings, firehose=True)
+
+    with mock.patch.object(phases.RequestPhases, 'start') as mock_start:
+        WebTestApp(app_main).get('/phases/pets/42', status=200)
+
+    assert not mock_start.called
+    assert transport.output == []
+    assert len(_get_spans(firehose)) == 1
+
+
+def test_subscribers_arent_registered_by_default():
+    app_main, _, _ = generate_app_main({'zipkin.tracing_percent': 100})
+
+    assert not app_main.registry.has_listeners
+
+
+def test_invalid_request_phases_mode():
+    with pytest.raises(ZipkinError):
+        generate_app_main({'zipkin.trace_request_phases': 'logs'})
+
+
+def test_repeated_phases_are_ignored():
+    zipkin_context = mock.Mock()
+    request_phases = phases.RequestPhases(
+        zipkin_context,
+        mock.Mock(),
+        as_spans=False,
+    )
+
+    request_phases.start('render')
+    request_phases.start('render')
+
+    assert zipkin_context.add_annotation.call_count == 1
+
+
+def test_finish_without_any_phase():
+    tracer = mock.Mock()
+    request_phases = phases.RequestPhases(mock.Mock(), tracer, as_spans=True)
+
+    request_phases.finish()
+
+    assert not tracer.add_span.called
+
+
+def test_local_span_isnt_recorded_without_logging_context():
+    zipkin_context = mock.Mock(logging_context=None)
+    tracer = mock.Mock()
+
+    phases.add_local_span(zipkin_context, tracer, 'render', 1.0, 2.0)
+
+    assert not tracer.add_span.called
@@ -1,4 +1,5 @@
 import json
+import math
 import time
 from unittest import mock
 
@@ -8,6 +9,7 @@ from py_zipkin.zipkin import ZipkinAttrs
 from webtest import TestApp as WebTestApp
 
 from .app import main
+from pyramid_zipkin.metrics import MetricsRecorder
 from pyramid_zipkin.version import __version__
 from tests.acceptance.test_helper import generate_app_main
 
@@ -473,3 +475,146 @@ def test_sample_server_ipv6(get_span):
         'port': 80,
         'ipv6': '2001:db8:85a3::8a2e:370:7334',
     }
+
+
+@pytest.mark.parametrize('tracing_percent,headers,firehose,called', [
+    (0, {}, False, 0),
+    (0, {'X-B3-Sampled': '1'}, False, 1),
+    (0, {}, True, 1),
+    (100, {}, False, 1),
+])
+def test_hooks_only_when_reported(tracing_percent, headers, firehose, called):
+    post_handler_hook = mock.Mock()
+    set_extra_binary_annotations = mock.Mock(return_value={})
+    app_main, _, _ = generate_app_main({
+        'zipkin.tracing_percent': tracing_percent,
+        'zipkin.hooks_only_when_reported': 'true',
+        'zipkin.post_handler_hook': post_handler_hook,
+        'zipkin.set_extra_binary_annotations': set_extra_binary_annotations,
+    }, firehose=firehose)
+
+    WebTestApp(app_main).get('/sample', headers=headers, status=200)
+
+    assert post_handler_hook.call_count == called
+    assert set_extra_binary_annotations.call_count == called
+
+
+def test_hooks_run_for_unreported_requests_by_default():
+    post_handler_hook = mock.Mock()
+    app_main, _, _ = generate_app_main({
+        'zipkin.tracing_percent': 0,
+        'zipkin.post_handler_hook': post_handler_hook,
+    })
+
+    WebTestApp(app_main).get('/sample', status=200)
+
+    assert post_handler_hook.call_count == 1
+
+
+def test_hook_durations():
+    recorder = MetricsRecorder(mock.Mock())
+
+    def slow_hook(request, response, zipkin_context=None):
+        time.sleep(0.01)
+        return {}
+
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.annotate_hook_durations': True,
+        'zipkin.post_handler_hook': slow_hook,
+        'zipkin.set_extra_binary_annotations': slow_hook,
+        'zipkin.metrics_recorder': recorder,
+    })
+
+    WebTestApp(app_main).get('/sample', status=200)
+
+    span, = json.loads(transport.output[0])
+    hooks = recorder.snapshot()['sample_route'].hooks
+    for hook in ('post_handler_hook', 'set_extra_binary_annotations'):
+        assert float(span['tags'][f'zipkin.{hook}.duration_ms']) >= 10
+        assert hooks[hook].count == 1
+        assert hooks[hook].max >= 0.01
+
+
+def test_hook_durations_are_recorded_if_the_hook_fails():
+    recorder = MetricsRecorder(mock.Mock())
+    app_main, _, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.post_handler_hook': mock.Mock(side_effect=ValueError),
+        'zipkin.metrics_recorder': recorder,
+    })
+
+    with pytest.raises(ValueError):
+        WebTestApp(app_main).get('/sample')
+
+    hooks = recorder.snapshot()['sample_route'].hooks
+    assert list(hooks) == ['post_handler_hook']
+
+
+@pytest.mark.parametrize('backdate', [False, True])
+def test_queue_duration(backdate):
+    recorder = MetricsRecorder(mock.Mock())
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.report_root_timestamp': True,
+        'zipkin.request_start_header': 'X-Request-Start',
+        'zipkin.backdate_to_request_start': backdate,
+        'zipkin.metrics_recorder': recorder,
+    })
+    # Truncated so that the header doesn't round it up.
+    request_start = math.floor((time.time() - 0.5) * 1000) / 1000
+
+    WebTestApp(app_main).get(
+        '/sample',
+        headers={'X-Request-Start': f't={request_start:.3f}'},
+        status=200,
+    )
+
+    span, = json.loads(transport.output[0])
+    assert 500 <= float(span['tags']['queue.duration_ms']) < 1500
+    assert (span['duration'] >= 500000) is backdate
+    assert (span['timestamp'] <= request_start * 1e6 + 1000) is backdate
+    queue_time = recorder.snapshot()['sample_route'].queue_time
+    assert queue_time.count == 1
+    assert 0.5 <= queue_time.max < 1.5
+
+
+def test_queue_duration_is_recorded_for_unsampled_requests():
+    recorder = MetricsRecorder(mock.Mock())
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 0,
+        'zipkin.request_start_header': 'X-Request-Start',
+        'zipkin.metrics_recorder': recorder,
+    })
+
+    WebTestApp(app_main).get(
+        '/sample',
+        headers={'X-Request-Start': str(int(time.time() * 1000) - 200)},
+        status=200,
+    )
+
+    assert transport.output == []
+    queue_time = recorder.snapshot()['sample_route'].queue_time
+    assert queue_time.count == 1
+    assert 0.2 <= queue_time.max < 1.2
+
+
+@pytest.mark.parametrize('headers,tag', [
+    ({}, None),
+    ({'X-Request-Start': 'garbage'}, None),
+    ({'X-Request-Start': f't={time.time() + 3600:.3f}'}, '0.000'),
+])
+def test_queue_duration_missing_or_invalid_header(headers, tag):
+    recorder = MetricsRecorder(mock.Mock())
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.request_start_header': 'X-Request-Start',
+        'zipkin.metrics_recorder': recorder,
+    })
+
+    WebTestApp(app_main).get('/sample', headers=headers, status=200)
+
+    span, = json.loads(transport.output[0])
+    assert span['tags'].get('queue.duration_ms') == tag
+    queue_time = recorder.snapshot()['sample_route'].queue_time
+    assert queue_time.count == (tag is not None)
@@ -142,3 +142,57 @@ def test_add_logging_annotation():
     assert server_span['annotations'] == [
         {'timestamp': mock.ANY, 'value': 'py_zipkin.logging_end'},
     ]
+
+
+def test_http_headers_for_request_sampled():
+    settings = {'zipkin.tracing_percent': 100}
+    app_main, transport, _ = generate_app_main(settings)
+
+    *headers, child_headers, same = WebTestApp(app_main).get(
+        '/fan_out',
+        status=200,
+    ).json
+
+    child_span, server_span = json.loads(transport.output[0])
+    assert not same['same_mapping']
+    assert same['read_only']
+    assert len({h['X-B3-SpanId'] for h in headers}) == 3
+    for h in headers:
+        assert h['X-B3-ParentSpanId'] == server_span['id']
+        assert h['X-B3-TraceId'] == server_span['traceId']
+        assert h['X-B3-Sampled'] == '1'
+        assert h['X-B3-Flags'] == '0'
+    assert child_headers['X-B3-ParentSpanId'] == child_span['id']
+
+
+def test_http_headers_for_request_not_sampled():
+    settings = {'zipkin.tracing_percent': 0}
+    app_main, _, _ = generate_app_main(settings)
+
+    *headers, child_headers, same = WebTestApp(app_main).get(
+        '/fan_out',
+        status=200,
+    ).json
+
+    assert same['same_mapping']
+    assert same['read_only']
+    assert headers[0] == headers[1] == headers[2]
+    assert headers[0]['X-B3-Sampled'] == '0'
+    assert child_headers['X-B3-ParentSpanId'] != \
+        headers[0]['X-B3-ParentSpanId']
+
+
+def test_debug_flag_is_sampled_and_propagated():
+    settings = {'zipkin.tracing_percent': 0}
+    app_main, transport, _ = generate_app_main(settings)
+
+    *headers, _, _ = WebTestApp(app_main).get(
+        '/fan_out',
+        headers={'X-B3-TraceId': 'a' * 32, 'X-B3-Flags': '1'},
+        status=200,
+    ).json
+
+    assert len(transport.output) == 1
+    for h in headers:
+        assert h['X-B3-Sampled'] == '1'
+        assert h['X-B3-Flags'] == '1'
@@ -0,0 +1,129 @@
+import json
+from wsgiref.util import FileWrapper
+
+import pytest
+from py_zipkin.storage import get_default_tracer
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import tween
+from tests.acceptance.test_helper import generate_app_main
+
+
+def _get_spans(transport):
+    [payload] = transport.output
+    return json.loads(payload)
+
+
+def _get_app_iter(app_main, path, **environ):
+    return app_main(
+        {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'wsgi.url_scheme': 'http',
+            **environ,
+        },
+        lambda status, headers: None,
+    )
+
+
+def test_server_span_ends_when_streaming_response_is_closed():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_streaming_responses': True,
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    response = WebTestApp(app_main).get('/streaming', status=200)
+
+    assert response.body == b'foobar'
+    assert response.content_length == 6
+    child_span, server_span = _get_spans(transport)
+    assert child_span['parentId'] == server_span['id']
+    assert server_span['duration'] >= 50000
+    assert server_span['tags']['http.response.body.size'] == '6'
+    assert server_span['tags']['response_status_code'] == '200'
+    [first_byte] = server_span['annotations']
+    assert first_byte['value'] == 'wsgi.first_byte'
+    assert first_byte['timestamp'] >= child_span['timestamp']
+    assert not get_default_tracer().is_transport_configured()
+    assert get_default_tracer().get_zipkin_attrs() is None
+
+
+def test_server_span_ends_with_the_view_by_default():
+    settings = {'zipkin.tracing_percent': 100}
+    app_main, transport, _ = generate_app_main(settings)
+    app_iter = _get_app_iter(app_main, '/streaming')
+
+    # The view hasn't started generating the body yet.
+    [server_span] = _get_spans(transport)
+    assert 'http.response.body.size' not in server_span['tags']
+    assert b''.join(app_iter) == b'foobar'
+
+
+def test_non_streaming_responses_arent_wrapped():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_streaming_responses': True,
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    WebTestApp(app_main).get('/sample', status=200)
+
+    [server_span] = _get_spans(transport)
+    assert 'http.response.body.size' not in server_span['tags']
+
+
+def test_file_wrapper_responses_arent_wrapped():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_streaming_responses': True,
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    app_iter = _get_app_iter(
+        app_main,
+        '/file_wrapper',
+        **{'wsgi.file_wrapper': FileWrapper},
+    )
+
+    assert isinstance(app_iter, FileWrapper)
+    [server_span] = _get_spans(transport)
+    assert 'http.response.body.size' not in server_span['tags']
+    assert b''.join(app_iter) == b'foobar'
+
+
+def test_streaming_responses_of_untraced_requests_arent_wrapped():
+    settings = {
+        'zipkin.tracing_percent': 0,
+        'zipkin.trace_streaming_responses': True,
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    app_iter = _get_app_iter(app_main, '/streaming')
+
+    assert not isinstance(app_iter, tween._TracedAppIter)
+    assert b''.join(app_iter) == b'foobar'
+    assert transport.output == []
+
+
+def test_streaming_errors_are_recorded():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_streaming_responses': True,
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    with pytest.raises(ValueError):
+        WebTestApp(app_main).get('/streaming?fail=1')
+
+    _, server_span = _get_spans(transport)
+    assert server_span['tags']['error.type'] == 'ValueError'
+    assert server_span['tags']['error'] == 'ValueError: stream broken'
+    assert server_span['tags']['http.response.body.size'] == '3'
+    assert server_span['tags']['response_status_code'] == '200'
+    assert [a['value'] for a in server_span['annotations']] == [
+        'wsgi.first_byte',
+        'ValueError',
+    ]
@@ -0,0 +1,144 @@
+import json
+
+import pytest
+from py_zipkin import Kind
+from py_zipkin.encoding._helpers import create_endpoint
+from py_zipkin.encoding._helpers import Span
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import aggregation
+from tests.acceptance.test_helper import generate_app_main
+
+
+def _span(span_id, timestamp, duration, name='get', parent_id='a', **kwargs):
+    return Span(
+        trace_id='66ec982fcfba8bf3b32d71d76e4a16a3',
+        name=name,
+        parent_id=parent_id,
+        span_id=span_id,
+        kind=Kind.CLIENT,
+        timestamp=timestamp,
+        duration=duration,
+        local_endpoint=create_endpoint(80, 'cache', '127.0.0.1'),
+        **kwargs
+    )
+
+
+def test_aggregate_spans():
+    spans = [
+        _span('1', 10.0, 0.002, tags={'key': 'a'}, annotations={'hit': 10.001}),
+        _span('2', 10.1, 0.001, tags={'key': 'b'}),
+        _span('3', 10.2, 0.003),
+        _span('4', 10.3, 0.001, name='set'),
+    ]
+
+    merged, last = aggregation.aggregate_spans(spans, min_count=3)
+
+    assert last is spans[3]
+    assert merged.span_id == '1'
+    assert merged.timestamp == 10.0
+    assert merged.duration == pytest.approx(0.203)
+    assert merged.annotations == {'hit': 10.001}
+    assert merged.tags == {
+        'key': 'a',
+        'zipkin.aggregate.count': '3',
+        'zipkin.aggregate.total_duration_ms': '6.000',
+        'zipkin.aggregate.min_duration_ms': '1.000',
+        'zipkin.aggregate.max_duration_ms': '3.000',
+    }
+    # The first span isn't modified.
+    assert spans[0].tags == {'key': 'a'}
+
+
+def test_short_runs_and_different_spans_are_kept():
+    spans = [
+        _span('1', 10.0, 0.001),
+        _span('2', 10.1, 0.001),
+        _span('3', 10.2, 0.001, parent_id='b'),
+        _span('4', 10.3, 0.001, parent_id='b'),
+    ]
+
+    assert aggregation.aggregate_spans(spans, min_count=3) == spans
+
+
+def test_slow_spans_arent_aggregated():
+    spans = [
+        _span('1', 10.0, 0.001),
+        _span('2', 10.1, 0.5),
+        _span('3', 10.2, 0.6),
+        _span('4', 10.3, 0.001),
+        _span('5', 10.4, 0.001),
+    ]
+
+    aggregated = aggregation.aggregate_spans(
+        spans,
+        min_count=2,
+        max_duration=0.1,
+    )
+
+    assert [span.span_id for span in aggregated] == ['1', '2', '3', '4']
+    assert aggregated[3].tags['zipkin.aggregate.count'] == '2'
+
+
+def _get_spans(transport):
+    return [span for p in transport.output for span in json.loads(p)]
+
+
+def test_repeated_spans_are_aggregated():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.aggregate_spans_min_count': '3',
+    })
+
+    WebTestApp(app_main).get('/repeated_spans?count=50', status=200)
+
+    spans = _get_spans(transport)
+    assert [
+        (span['localEndpoint']['serviceName'], span['name'])
+        for span in spans
+    ] == [
+        ('cache', 'get'),
+        ('db', 'query'),
+        ('cache', 'get'),
+        ('child', 'get'),
+        ('acceptance_service', 'GET /repeated_spans'),
+    ]
+    first_run, _, second_run, child, server = spans
+    assert first_run['tags']['index'] == '0'
+    assert first_run['tags']['zipkin.aggregate.count'] == '50'
+    assert second_run['tags']['zipkin.aggregate.count'] == '50'
+    assert first_run['parentId'] == child['id']
+    assert child['parentId'] == server['id']
+    assert 'tags' not in child
+
+
+def test_repeated_spans_are_aggregated_when_flushed():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.aggregate_spans_min_count': '3',
+        'zipkin.incremental_flush_spans': '30',
+    })
+
+    WebTestApp(app_main).get('/repeated_spans?count=20', status=200)
+
+    counts = [
+        span.get('tags', {}).get('zipkin.aggregate.count')
+        for span in _get_spans(transport)
+    ]
+    # The second run is split by the flush after the 30th span.
+    assert counts == ['20', None, '9', '11', None, None]
+
+
+@pytest.mark.parametrize('settings', [
+    {},
+    {'zipkin.aggregate_spans_min_count': 6},
+])
+def test_spans_arent_aggregated(settings):
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        **settings,
+    })
+
+    WebTestApp(app_main).get('/repeated_spans?count=5', status=200)
+
+    assert len(_get_spans(transport)) == 13
@@ -0,0 +1,196 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+import pytest
+import requests
+from py_zipkin.exception import ZipkinError
+from py_zipkin.storage import get_default_tracer
+from py_zipkin.util import ZipkinAttrs
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import client
+from tests.acceptance.test_helper import generate_app_main
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.received_headers.append(dict(self.headers))
+        body = b'{}'
+        self.send_response(201 if self.path == '/created' else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.received_headers = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _url(server, path='/'):
+    return f'http://127.0.0.1:{server.server_port}{path}'
+
+
+def test_client_span_for_sampled_request(http_server):
+    settings = {'zipkin.tracing_percent': 100}
+    app_main, transport, _ = generate_app_main(settings)
+
+    WebTestApp(app_main).get(
+        '/client_call',
+        {'url': _url(http_server, '/created')},
+        status=200,
+    )
+
+    client_span, server_span = json.loads(transport.output[0])
+    assert client_span['kind'] == 'CLIENT'
+    assert client_span['name'] == 'GET 127.0.0.1'
+    assert client_span['parentId'] == server_span['id']
+    assert client_span['localEndpoint'] == server_span['localEndpoint']
+    assert client_span['remoteEndpoint'] == {
+        'serviceName': '127.0.0.1',
+        'ipv4': '127.0.0.1',
+        'port': http_server.server_port,
+    }
+    assert client_span['tags'] == {
+        'http.request.method': 'GET',
+        'url.full': _url(http_server, '/created'),
+        'server.address': '127.0.0.1',
+        'server.port': str(http_server.server_port),
+        'http.response.status_code': '201',
+    }
+
+    [headers] = http_server.received_headers
+    assert headers['X-B3-TraceId'] == server_span['traceId']
+    assert headers['X-B3-SpanId'] == client_span['id']
+    assert headers['X-B3-ParentSpanId'] == server_span['id']
+    assert headers['X-B3-Sampled'] == '1'
+
+
+def test_unsampled_request_only_propagates_headers(http_server):
+    settings = {'zipkin.tracing_percent': 0}
+    app_main, transport, _ = generate_app_main(settings)
+
+    with mock.patch.object(client, 'Span') as mock_span:
+        WebTestApp(app_main).get(
+            '/client_call',
+            {'url': _url(http_server)},
+            status=200,
+        )
+
+    assert not mock_span.called
+    assert transport.output == []
+    [headers] = http_server.received_headers
+    assert headers['X-B3-Sampled'] == '0'
+
+
+def test_no_headers_outside_of_a_trace(http_server):
+    session = client.ZipkinSession()
+
+    assert session.get(_url(http_server)).status_code == 200
+
+    [headers] = http_server.received_headers
+    assert 'X-B3-TraceId' not in headers
+
+
+def test_connections_are_pooled(http_server):
+    session = client.ZipkinSession()
+    for _ in range(3):
+        session.get(_url(http_server))
+
+    pools = session.get_adapter(_url(http_server)).poolmanager.pools
+    [pool_key] = pools.keys()
+    pool = pools[pool_key]
+    assert pool.num_connections == 1
+    assert pool.num_requests == 3
+
+
+def test_client_span_for_failed_request():
+    tracer = get_default_tracer()
+    session = client.ZipkinSession('my_service')
+    tracer.push_zipkin_attrs(ZipkinAttrs('a' * 32, 'b' * 16, None, '0', True))
+    tracer.set_transport_configured(configured=True)
+    try:
+        with pytest.raises(requests.ConnectionError):
+            # Nothing listens on port 1.
+            session.get('http://127.0.0.1:1/')
+        [span] = tracer.get_spans()
+    finally:
+        tracer.pop_zipkin_attrs()
+        tracer.set_transport_configured(configured=False)
+        tracer.clear()
+
+    assert span.tags['error.type'] == 'ConnectionError'
+    assert 'http.response.status_code' not in span.tags
+    assert span.local_endpoint.service_name == 'my_service'
+
+
+def test_client_span_strips_the_credentials_from_the_url(http_server):
+    tracer = get_default_tracer()
+    session = client.ZipkinSession()
+    url = _url(http_server, '/created?q=1')
+    tracer.push_zipkin_attrs(ZipkinAttrs('a' * 32, 'b' * 16, None, '0', True))
+    tracer.set_transport_configured(configured=True)
+    try:
+        session.get(url.replace('http://', 'http://user:secret@'))
+        [span] = tracer.get_spans()
+    finally:
+        tracer.pop_zipkin_attrs()
+        tracer.set_transport_configured(configured=False)
+        tracer.clear()
+
+    assert span.tags['url.full'] == url
+    [headers] = http_server.received_headers
+    assert 'Authorization' in headers
+
+
+def test_remote_endpoints_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(client, '_MAX_CACHED_ENDPOINTS', 2)
+    session = client.ZipkinSession()
+    for port in range(5):
+        endpoint = session._remote_endpoint('example.com', port)
+        assert endpoint is session._remote_endpoint('example.com', port)
+
+    assert endpoint.service_name == 'example.com'
+    assert endpoint.ipv4 is None
+    assert len(session._remote_endpoints) <= 2
+
+
+def test_session_from_settings():
+    session = client.session_from_settings({
+        'service_name': 'my_service',
+        'zipkin.client.pool_connections': '2',
+        'zipkin.client.pool_maxsize': '20',
+        'zipkin.client.max_retries': 3,
+    })
+
+    adapter = session.get_adapter('https://example.com')
+    assert session.local_endpoint.service_name == 'my_service'
+    assert adapter._pool_connections == 2
+    assert adapter._pool_maxsize == 20
+    assert adapter.max_retries.total == 3
+
+
+@pytest.mark.parametrize('setting', [
+    'zipkin.client.pool_connections',
+    'zipkin.client.pool_maxsize',
+    'zipkin.client.max_retries',
+])
+def test_session_from_settings_invalid_integer(setting):
+    with pytest.raises(ZipkinError) as e:
+        client.session_from_settings({setting: 'ten'})
+
+    assert setting in str(e.value)
@@ -0,0 +1,142 @@
+import asyncio
+import contextvars
+import json
+import operator
+from unittest import mock
+
+import pytest
+from py_zipkin.exception import ZipkinError
+from py_zipkin.storage import get_default_tracer
+from py_zipkin.storage import Stack
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import context
+from pyramid_zipkin import tween
+from tests.acceptance.test_helper import generate_app_main
+from tests.acceptance.test_helper import MockTransport
+
+
+@pytest.fixture
+def stack():
+    return context.ContextVarStack()
+
+
+@pytest.fixture
+def default_tracer():
+    tracer = get_default_tracer()
+    old_context_stack = tracer._context_stack
+    yield tracer
+    tracer._context_stack = old_context_stack
+
+
+def test_context_var_stack(stack):
+    assert stack.get() is None
+    assert stack.pop() is None
+
+    stack.push('a')
+    stack.push('b')
+    assert stack.get() == 'b'
+    assert stack.pop() == 'b'
+    assert stack.get() == 'a'
+    assert stack.pop() == 'a'
+    assert stack.get() is None
+
+
+def test_context_var_stack_copies_dont_share_state(stack):
+    stack.push('a')
+    copied_context = contextvars.copy_context()
+
+    copied_context.run(stack.push, 'b')
+
+    assert copied_context.run(stack.get) == 'b'
+    assert stack.pop() == 'a'
+    assert copied_context.run(stack.get) == 'b'
+
+
+def test_context_var_stack_in_concurrent_tasks(stack):
+    async def task(name):
+        stack.push(name)
+        await asyncio.sleep(0)
+        current = stack.get()
+        stack.pop()
+        return current
+
+    async def main():
+        return await asyncio.gather(task('a'), task('b'))
+
+    assert asyncio.run(main()) == ['a', 'b']
+    assert stack.get() is None
+
+
+def test_context_var_stack_copy(stack):
+    stack.push('a')
+    stack.push('b')
+
+    the_copy = stack.copy()
+    stack.pop()
+    stack.pop()
+
+    assert type(the_copy) is Stack
+    assert the_copy.pop() == 'b'
+    assert the_copy.pop() == 'a'
+
+
+def test_tween_uses_context_var_stack(default_tracer):
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.use_contextvars_stack': True,
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    WebTestApp(app_main).get('/span_context', status=200)
+    WebTestApp(app_main).get('/span_context', status=200)
+
+    assert default_tracer._context_stack is context.context_var_stack
+    assert context.context_var_stack.get() is None
+    grandchild, child, server = json.loads(transport.output[1])
+    assert grandchild['parentId'] == child['id']
+    assert child['parentId'] == server['id']
+
+
+def test_context_var_stack_and_request_context_are_exclusive():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.use_contextvars_stack': True,
+        'zipkin.request_context': 'rctxstorage.zipkin_context',
+    }
+    app_main, _, _ = generate_app_main(settings)
+
+    with pytest.raises(ZipkinError):
+        WebTestApp(app_main).get('/sample', status=200)
+
+
+def test_request_context_is_compiled_into_a_getter(get_request):
+    compiled_settings = tween._compile_settings({
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.request_context': 'rctxstorage.zipkin_context',
+    })
+    context_stack = Stack()
+    get_request.rctxstorage = mock.Mock(zipkin_context=context_stack)
+
+    zipkin_settings = tween._get_settings_from_request(
+        get_request,
+        compiled_settings,
+    )
+
+    assert isinstance(compiled_settings.request_context, operator.attrgetter)
+    assert zipkin_settings.context_stack is context_stack
+
+
+def test_request_context_missing_from_the_request(get_request):
+    compiled_settings = tween._compile_settings({
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.request_context': 'rctxstorage.zipkin_context',
+    })
+    get_request.rctxstorage = object()
+
+    zipkin_settings = tween._get_settings_from_request(
+        get_request,
+        compiled_settings,
+    )
+
+    assert zipkin_settings.context_stack is None
@@ -0,0 +1,120 @@
+import json
+
+import pytest
+from py_zipkin import Encoding
+from py_zipkin import Kind
+from py_zipkin.encoding import get_encoder
+from py_zipkin.encoding._helpers import create_endpoint
+from py_zipkin.encoding._helpers import Span
+from py_zipkin.exception import ZipkinError
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import encoding
+from tests.acceptance.test_helper import generate_app_main
+
+
+LOCAL_ENDPOINT = create_endpoint(80, 'acceptance_service', '10.0.0.1')
+
+
+def _span(**kwargs):
+    span_kwargs = dict(
+        trace_id='66ec982fcfba8bf3b32d71d76e4a16a3',
+        name='GET /sample',
+        parent_id=None,
+        span_id='17133d482ba4f605',
+        kind=Kind.SERVER,
+        timestamp=1664500000.123456,
+        duration=0.0421,
+        local_endpoint=LOCAL_ENDPOINT,
+    )
+    span_kwargs.update(kwargs)
+    return Span(**span_kwargs)
+
+
+@pytest.mark.parametrize('span', [
+    _span(),
+    _span(name=None, timestamp=None, duration=None, local_endpoint=None),
+    _span(parent_id='37133d482ba4f605', shared=True),
+    _span(kind=Kind.LOCAL),
+    _span(kind=Kind.CLIENT),
+    _span(span_id=None),
+    _span(name='GET /café/"quoted"\\\n\t\x00/\U0001f600'),
+    _span(local_endpoint=create_endpoint(0, 'svc', '::1')),
+    _span(local_endpoint=create_endpoint(use_defaults=False)),
+    _span(remote_endpoint=create_endpoint(8888, 'remote', '192.168.1.1')),
+    _span(tags={
+        'http.uri': '/sample',
+        'response_status_code': '200',
+        'unicode.é': 'value ☃ "with" \\ escapes',
+        'none': None,
+        'int': 42,
+    }),
+    _span(tags={1: 'int key', '1': 'str key'}),
+    _span(annotations={
+        'foo': 1664500002.0,
+        'ba"r': 1664500001.5,
+        'wsgi.first_byte': 1664500000.2,
+    }),
+])
+def test_fast_encoder_matches_py_zipkin_byte_for_byte(span):
+    expected = get_encoder(Encoding.V2_JSON).encode_span(span)
+    fast_encoder = encoding.FastV2JSONEncoder()
+
+    assert fast_encoder.encode_span(span) == expected
+    # Second time around the fragments come from the caches.
+    assert fast_encoder.encode_span(span) == expected
+
+
+def test_fast_encoder_validates_span_id():
+    with pytest.raises(ValueError):
+        encoding.FastV2JSONEncoder().encode_span(_span(span_id='not hex'))
+
+
+def test_fast_encoder_queue_and_fits():
+    py_zipkin_encoder = get_encoder(Encoding.V2_JSON)
+    fast_encoder = encoding.FastV2JSONEncoder()
+    queue = ['{"a": 1}', '{"b": 2}']
+
+    assert fast_encoder.encode_queue(queue) == \
+        py_zipkin_encoder.encode_queue(queue)
+    for max_size in (20, 21, 22):
+        assert fast_encoder.fits(2, 16, max_size, '{"c": 3}') == \
+            py_zipkin_encoder.fits(2, 16, max_size, '{"c": 3}')
+
+
+def test_fast_encoder_caches_are_bounded(monkeypatch):
+    monkeypatch.setattr(encoding, '_MAX_CACHED_FRAGMENTS', 2)
+    fast_encoder = encoding.FastV2JSONEncoder()
+    for i in range(5):
+        fast_encoder.encode_span(_span(
+            local_endpoint=create_endpoint(i + 1, 'svc', '10.0.0.1'),
+            tags={f'key{i}': 'value'},
+        ))
+
+    assert len(fast_encoder._endpoints) <= 2
+    assert len(fast_encoder._keys) <= 2
+
+
+def test_tween_uses_fast_encoder():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.use_fast_encoder': True,
+    }
+    app_main, transport, _ = generate_app_main(settings)
+
+    WebTestApp(app_main).get('/span_context', status=200)
+
+    spans = json.loads(transport.output[0])
+    assert [span['name'] for span in spans] == ['put', 'get', 'GET /span_context']
+
+
+def test_tween_rejects_fast_encoder_with_other_encodings():
+    settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.use_fast_encoder': True,
+    }
+    app_main, _, _ = generate_app_main(settings)
+    app_main.registry.settings['zipkin.encoding'] = Encoding.V2_PROTO3
+
+    with pytest.raises(ZipkinError):
+        WebTestApp(app_main).get('/sample', status=200)
@@ -0,0 +1,240 @@
+import json
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+from py_zipkin import Encoding
+from py_zipkin.transport import BaseTransportHandler
+
+from pyramid_zipkin import exporter
+from tests.acceptance.test_helper import MockTransport
+
+
+class FileTransport(BaseTransportHandler):
+    """Transport usable from the exporter child process."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_max_payload_bytes(self):
+        return None
+
+    def send(self, payload):
+        with open(self.path, 'ab') as f:
+            f.write(payload + b'\n')
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / 'zipkin.sock')
+
+
+@pytest.fixture
+def running_exporter(socket_path):
+    transport = MockTransport()
+    span_exporter = exporter.SpanExporter(
+        socket_path,
+        transport,
+        flush_interval=0.05,
+    )
+    thread = threading.Thread(target=span_exporter.serve_forever)
+    thread.start()
+    yield span_exporter, transport
+    span_exporter.stop()
+    thread.join()
+    span_exporter.close()
+
+
+def _wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_unix_socket_transport_drops_when_exporter_is_down(socket_path):
+    transport = exporter.UnixSocketTransport(socket_path)
+    transport('[{"id": "1"}]')
+    assert transport.dropped == 1
+    transport.close()
+
+
+def test_unix_socket_transport_max_payload_bytes(socket_path):
+    transport = exporter.UnixSocketTransport(socket_path, max_payload_bytes=10)
+    assert transport.get_max_payload_bytes() == 10
+
+
+def test_unix_socket_transport_max_payload_bytes_fits_the_receive_buffer(
+    socket_path,
+):
+    with pytest.raises(ValueError):
+        exporter.UnixSocketTransport(
+            socket_path,
+            max_payload_bytes=exporter.MAX_DATAGRAM_BYTES + 1,
+        )
+
+
+def test_unix_socket_transport_recreates_socket_after_fork(socket_path):
+    transport = exporter.UnixSocketTransport(socket_path)
+    sock = transport._get_socket()
+    assert transport._get_socket() is sock
+    transport._pid = -1
+    assert transport._get_socket() is not sock
+    transport.close()
+    transport.close()
+
+
+def test_exporter_merges_payloads_from_many_workers(
+    socket_path,
+    running_exporter,
+):
+    _, transport = running_exporter
+    workers = [exporter.UnixSocketTransport(socket_path) for _ in range(3)]
+    for i, worker in enumerate(workers):
+        worker(json.dumps([{'id': str(i)}, {'id': str(i + 10)}]))
+
+    _wait_for(lambda: transport.output)
+
+    assert len(transport.output) == 1
+    spans = json.loads(transport.output[0])
+    assert sorted(s['id'] for s in spans) == ['0', '1', '10', '11', '12', '2']
+    assert all(worker.dropped == 0 for worker in workers)
+
+
+def test_exporter_keeps_serving_after_a_transport_error(socket_path, caplog):
+    transport = MockTransport()
+    transport.send = mock.Mock(side_effect=[ConnectionError, None])
+    span_exporter = exporter.SpanExporter(
+        socket_path,
+        transport,
+        flush_interval=0.05,
+    )
+    thread = threading.Thread(target=span_exporter.serve_forever)
+    thread.start()
+    worker = exporter.UnixSocketTransport(socket_path)
+
+    worker('[{"id": "1"}]')
+    _wait_for(lambda: span_exporter.failed_batches == 1)
+    worker('[{"id": "2"}]')
+    _wait_for(lambda: transport.send.call_count == 2)
+    span_exporter.stop()
+    thread.join()
+    span_exporter.close()
+    worker.close()
+
+    assert transport.send.call_args[0][0] == b'[{"id": "2"}]'
+    assert 'Error shipping zipkin spans' in caplog.text
+
+
+def test_exporter_flushes_when_batch_is_full(socket_path):
+    transport = MockTransport()
+    span_exporter = exporter.SpanExporter(
+        socket_path,
+        transport,
+        max_batch_bytes=30,
+    )
+    span_exporter.add_payload(b'[{"id": "1"},{"id": "2"}]')
+    span_exporter.add_payload(b'[{"id": "3"}]')
+    span_exporter.add_payload(b'[]')
+    assert transport.output == [b'[{"id": "1"},{"id": "2"}]']
+
+    span_exporter.flush()
+    span_exporter.flush()
+    assert transport.output[1] == b'[{"id": "3"}]'
+    span_exporter.close()
+
+
+def test_exporter_caps_batches_to_transport_max_payload(socket_path):
+    transport = exporter.UnixSocketTransport('unused', max_payload_bytes=100)
+    span_exporter = exporter.SpanExporter(socket_path, transport)
+    assert span_exporter.max_batch_bytes == 100
+    span_exporter.close()
+    span_exporter.close()
+    transport.close()
+
+
+def test_exporter_concatenates_protobuf_payloads(socket_path):
+    transport = MockTransport()
+    span_exporter = exporter.SpanExporter(
+        socket_path,
+        transport,
+        encoding=Encoding.V2_PROTO3,
+        max_batch_bytes=4,
+    )
+    span_exporter.add_payload(b'ab')
+    span_exporter.add_payload(b'cd')
+    span_exporter.add_payload(b'ef')
+    span_exporter.flush()
+    assert transport.output == [b'abcd', b'ef']
+    span_exporter.close()
+
+
+def test_exporter_rejects_thrift(socket_path):
+    with pytest.raises(ValueError):
+        exporter.SpanExporter(
+            socket_path,
+            MockTransport(),
+            encoding=Encoding.V1_THRIFT,
+        )
+
+
+def test_start_span_exporter_ships_spans_until_terminated(
+    socket_path,
+    tmp_path,
+):
+    output = str(tmp_path / 'spans')
+    process = exporter.start_span_exporter(
+        socket_path,
+        FileTransport(output),
+        flush_interval=60,
+    )
+    try:
+        worker = exporter.UnixSocketTransport(socket_path)
+        worker('[{"id": "1"}]')
+        worker('[{"id": "2"}]')
+        assert worker.dropped == 0
+    finally:
+        process.terminate()
+        process.join(5)
+
+    # Terminating the exporter flushes the pending batch and removes the socket.
+    with open(output, 'rb') as f:
+        assert json.loads(f.read()) == [{'id': '1'}, {'id': '2'}]
+    assert not os.path.exists(socket_path)
+
+
+def test_exporter_accepts_function_transports_and_drains(socket_path):
+    output = []
+    span_exporter = exporter.SpanExporter(
+        socket_path,
+        output.append,
+        flush_interval=60,
+    )
+    assert span_exporter.max_batch_bytes == exporter.DEFAULT_MAX_BATCH_BYTES
+
+    worker = exporter.UnixSocketTransport(socket_path)
+    worker(b'[{"id": "1"}]')
+    # Datagrams still queued on the socket are drained on shutdown.
+    span_exporter._drain()
+    span_exporter.flush()
+
+    assert output == [b'[{"id": "1"}]']
+    span_exporter.close()
+    worker.close()
+
+
+def test_start_span_exporter_raises_if_not_ready(socket_path):
+    with mock.patch.object(
+        exporter.multiprocessing,
+        'Process',
+        autospec=True,
+    ) as mock_process:
+        with pytest.raises(RuntimeError):
+            exporter.start_span_exporter(
+                socket_path,
+                MockTransport(),
+                timeout=0.01,
+            )
+    mock_process.return_value.terminate.assert_called_once_with()
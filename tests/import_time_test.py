@@ -0,0 +1,87 @@
+import subprocess
+import sys
+
+import pytest
+
+
+# Budgets in ms, with some room for slow CI machines. Locally importing the
+# package takes ~0.1ms and including it ~10ms, most of it py_zipkin.
+IMPORT_BUDGET_MS = 2
+INCLUDEME_BUDGET_MS = 30
+
+# The only modules of the package that including it imports, the others are
+# imported when the features that need them are enabled.
+INCLUDEME_MODULES = {
+    'pyramid_zipkin.request_helper',
+    'pyramid_zipkin.sampling',
+    'pyramid_zipkin.tween',
+    'pyramid_zipkin.version',
+}
+
+INCLUDEME = '''
+import sys
+from pyramid.config import Configurator
+config = Configurator(settings={settings!r})
+sys.stderr.write('-- includeme --\\n')
+sys.stderr.flush()
+config.include('pyramid_zipkin')
+'''
+
+
+def _importtime(code):
+    """Runs `code` in a new interpreter with `-X importtime` and returns the
+    modules imported after the last `-- includeme --` marker, if any, along
+    with their cumulative import time in ms.
+    """
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+    imported = {}
+    for line in stderr.splitlines():
+        if line == '-- includeme --':
+            imported = {}
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue  # The header
+        imported[name.strip()] = (
+            int(cumulative) / 1000,
+            # Nested imports are indented.
+            len(name) - len(name.lstrip()) == 1,
+        )
+    return imported
+
+
+def _total_ms(imported):
+    return sum(ms for ms, top_level in imported.values() if top_level)
+
+
+def test_import_pyramid_zipkin():
+    imported = _importtime('import pyramid_zipkin')
+
+    assert 'pyramid' not in imported
+    assert 'py_zipkin' not in imported
+    assert imported['pyramid_zipkin'][0] < IMPORT_BUDGET_MS
+
+
+def test_includeme():
+    imported = _importtime(INCLUDEME.format(settings={}))
+
+    assert {
+        name for name in imported if name.startswith('pyramid_zipkin.')
+    } == INCLUDEME_MODULES
+    assert _total_ms(imported) < INCLUDEME_BUDGET_MS
+
+
+@pytest.mark.parametrize('setting,module', [
+    ('zipkin.trace_request_phases', 'pyramid_zipkin.phases'),
+    ('zipkin.trace_renderers', 'pyramid_zipkin.renderers'),
+])
+def test_includeme_imports_enabled_features(setting, module):
+    imported = _importtime(INCLUDEME.format(settings={setting: 'spans'}))
+
+    assert module in imported
@@ -0,0 +1,210 @@
+import json
+import threading
+from unittest import mock
+
+import pytest
+from py_zipkin.exception import ZipkinError
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import metrics
+from pyramid_zipkin import tween
+from tests.acceptance.test_helper import generate_app_main
+from tests.acceptance.test_helper import MockTransport
+
+
+@pytest.fixture
+def recorder():
+    recorder = metrics.MetricsRecorder(mock.Mock(), interval=0.01)
+    yield recorder
+    recorder.stop()
+
+
+def test_histogram_percentiles():
+    histogram = metrics.LatencyHistogram()
+    assert histogram.percentile(50) == 0.0
+
+    for ms in range(1, 101):
+        histogram.record(ms / 1000)
+    histogram.record(0)
+
+    assert histogram.count == 101
+    assert histogram.max == 0.1
+    assert histogram.percentile(0) == 1e-6
+    assert histogram.percentile(50) == pytest.approx(0.05, rel=0.09)
+    assert histogram.percentile(99) == pytest.approx(0.099, rel=0.09)
+    assert histogram.percentile(100) == 0.1
+
+
+def test_histogram_merge_and_round_trip():
+    first = metrics.LatencyHistogram()
+    second = metrics.LatencyHistogram()
+    for ms in range(1, 51):
+        first.record(ms / 1000)
+        second.record((ms + 50) / 1000)
+    merged = metrics.LatencyHistogram()
+    for ms in range(1, 101):
+        merged.record(ms / 1000)
+
+    first.merge(metrics.LatencyHistogram.from_dict(
+        json.loads(json.dumps(second.to_dict())),
+    ))
+
+    assert first.buckets == merged.buckets
+    assert first.count == 100
+    assert first.total == pytest.approx(merged.total)
+    assert first.max == 0.1
+
+
+def test_route_metrics():
+    route_metrics = metrics.RouteMetrics()
+    route_metrics.record(0.1, 200)
+    route_metrics.record(0.2, 204, {'post_handler_hook': 0.01})
+    route_metrics.record(0.3, 503, {'post_handler_hook': 0.02}, 0.005)
+    other = metrics.RouteMetrics.from_dict(route_metrics.to_dict())
+    other.record(0.1, 200, {'set_extra_binary_annotations': 0.01}, 0.001)
+
+    route_metrics.merge(other)
+
+    assert route_metrics.statuses == {'2xx': 5, '5xx': 2}
+    assert route_metrics.latency.count == 7
+    assert route_metrics.hooks['post_handler_hook'].count == 4
+    assert route_metrics.hooks['set_extra_binary_annotations'].count == 1
+    assert route_metrics.queue_time.count == 3
+    assert route_metrics.queue_time.max == 0.005
+
+
+def test_route_metrics_from_dict_without_queue_time():
+    data = metrics.RouteMetrics().to_dict()
+    del data['queue_time']
+
+    assert metrics.RouteMetrics.from_dict(data).queue_time.count == 0
+
+
+def test_recorder_snapshot_resets_the_metrics(recorder):
+    recorder.record('home', 0.1, 200)
+    recorder.record(None, 0.1, 404)
+
+    snapshot = recorder.snapshot()
+
+    assert snapshot['home'].statuses == {'2xx': 1}
+    assert snapshot[metrics.UNMATCHED_ROUTE].statuses == {'4xx': 1}
+    assert recorder.snapshot() == {}
+
+
+def test_recorder_export(recorder):
+    recorder.export()
+    assert not recorder.handler.called
+
+    recorder.record('home', 0.1, 200)
+    recorder.export()
+
+    [snapshot], _ = recorder.handler.call_args
+    assert list(snapshot) == ['home']
+
+
+def test_recorder_logs_handler_errors(recorder, caplog):
+    recorder.handler.side_effect = ValueError('statsd is down')
+    recorder.record('home', 0.1, 200)
+
+    recorder.export()
+
+    assert 'Error exporting zipkin metrics' in caplog.text
+
+
+def test_recorder_exports_periodically(recorder):
+    exported = threading.Event()
+    recorder.handler.side_effect = lambda snapshot: exported.set()
+    recorder.start()
+    # Already started.
+    recorder.start()
+
+    recorder.record('home', 0.1, 200)
+
+    assert exported.wait(5)
+
+
+def test_recorder_after_fork(recorder):
+    recorder._after_fork()
+    assert recorder._thread is None
+
+    recorder.start()
+    parent_thread = recorder._thread
+    recorder.record('home', 0.1, 200)
+
+    recorder._after_fork()
+
+    assert recorder._thread is not parent_thread
+    assert recorder.snapshot() == {}
+    # Restarting doesn't register the fork hook again.
+    recorder.stop()
+    recorder.start()
+    assert recorder._thread is not None
+
+
+def test_recorder_concurrent_records(recorder):
+    def record():
+        for _ in range(1000):
+            recorder.record('home', 0.01, 200)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert recorder.snapshot()['home'].latency.count == 8000
+
+
+def test_metrics_recorder_from_settings():
+    handler = mock.Mock()
+    recorder = metrics.metrics_recorder_from_settings({
+        'zipkin.metrics_handler': handler,
+        'zipkin.metrics_interval': '30',
+    })
+    recorder.stop()
+
+    assert recorder.handler is handler
+    assert recorder.interval == 30.0
+
+
+@pytest.mark.parametrize('settings', [
+    {'zipkin.metrics_handler': 'statsd'},
+    {'zipkin.metrics_handler': print, 'zipkin.metrics_interval': 'often'},
+])
+def test_metrics_recorder_from_settings_invalid(settings):
+    with pytest.raises(ZipkinError):
+        metrics.metrics_recorder_from_settings(settings)
+
+
+def test_tween_records_every_request(recorder):
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 0,
+        'zipkin.metrics_recorder': recorder,
+    })
+    app = WebTestApp(app_main)
+
+    app.get('/sample', status=200)
+    app.get('/sample', status=200)
+    app.get('/server_error', status=500)
+    app.get('/not_a_route', status=404)
+
+    snapshot = recorder.snapshot()
+    assert transport.output == []
+    assert snapshot['sample_route'].statuses == {'2xx': 2}
+    assert snapshot['sample_route'].latency.count == 2
+    assert snapshot['server_error'].statuses == {'5xx': 1}
+    assert snapshot[metrics.UNMATCHED_ROUTE].statuses == {'4xx': 1}
+
+
+def test_tween_records_exceptions_as_server_errors(recorder, get_request):
+    get_request.registry.settings = {
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.metrics_recorder': recorder,
+    }
+    handler = mock.Mock(side_effect=ValueError)
+
+    with pytest.raises(ValueError):
+        tween.zipkin_tween(handler, mock.Mock())(get_request)
+
+    snapshot = recorder.snapshot()
+    assert snapshot[metrics.UNMATCHED_ROUTE].statuses == {'5xx': 1}
@@ -1,6 +1,10 @@
 from unittest import mock
 
+import pytest
+
 from pyramid_zipkin import request_helper
+from pyramid_zipkin.sampling import RouteReservoir
+from pyramid_zipkin.sampling import SamplingControl
 
 
 def test_should_not_sample_path_returns_true_if_path_is_blacklisted(
@@ -116,6 +120,20 @@ def test_get_trace_id_returns_header_value_if_present_128bit(dummy_request):
         request_helper.get_trace_id(dummy_request)
 
 
+@mock.patch(
+    'pyramid_zipkin.request_helper.generate_random_128bit_string',
+    autospec=True
+)
+def test_get_trace_id_only_generates_an_id_if_missing(
+    mock_gen_random, dummy_request
+):
+    dummy_request.headers = {'X-B3-TraceId': '48485a3953bb6124'}
+
+    request_helper.get_trace_id(dummy_request)
+
+    assert not mock_gen_random.called
+
+
 def test_create_zipkin_attr_runs_custom_is_tracing_if_present(dummy_request):
     is_tracing = mock.Mock(return_value=True)
     dummy_request.registry.settings = {
@@ -208,3 +226,125 @@ def test_update_annotations_from_request_environ():
         'server.port': '8080',
         'url.scheme': 'http',
     }
+
+
+def test_create_http_headers_for_request_outside_of_a_trace(dummy_request):
+    assert request_helper.create_http_headers_for_request(dummy_request) == {}
+
+
+@pytest.mark.parametrize('value,flags', [
+    (None, 0),
+    ('', 0),
+    ('1', 1),
+    ('45', 45),
+    ('debug', 0),
+])
+def test_parse_b3_flags(value, flags):
+    assert request_helper.parse_b3_flags(value) == flags
+
+
+@pytest.mark.parametrize('value,request_start', [
+    (None, None),
+    ('', None),
+    ('t=1700000000.123', 1700000000.123),
+    (' t=1700000000123 ', 1700000000.123),
+    ('1700000000123', 1700000000.123),
+    ('t=1700000000123456', 1700000000.123456),
+    ('1700000000123456789', 1700000000.123456789),
+    ('t=abc', None),
+    ('-1700000000', None),
+    ('inf', None),
+    ('nan', None),
+])
+def test_parse_request_start(value, request_start):
+    assert request_helper.parse_request_start(value) == \
+        pytest.approx(request_start)
+
+
+def test_is_tracing_matches_the_route_once(dummy_request):
+    route = mock.Mock()
+    route.name = 'foo'
+    route_mapper = mock.Mock(return_value={'route': route})
+    dummy_request.registry.queryUtility = lambda _: route_mapper
+    control = SamplingControl(tracing_percent=0)
+    control.update(route_tracing_percents={'bar': 100})
+    dummy_request.registry.settings = {
+        'zipkin.sampling_rules': [{'route': 'bar', 'rate': 100}],
+        'zipkin.blacklisted_routes': ['bar'],
+        'zipkin.sampling_control': control,
+        'zipkin.route_reservoir': RouteReservoir(min_traces=1),
+    }
+
+    # Traced by the reservoir, the route's first request.
+    assert request_helper.is_tracing(dummy_request)
+    assert route_mapper.call_count == 1
+
+
+@pytest.mark.parametrize('sampled_header', [{}, {'X-B3-Sampled': '0'}])
+def test_is_tracing_debug_flag_forces_sampling(dummy_request, sampled_header):
+    dummy_request.registry.settings = {'zipkin.tracing_percent': 0}
+    dummy_request.headers = {'X-B3-Flags': '1', **sampled_header}
+
+    assert request_helper.is_tracing(dummy_request)
+
+
+def test_is_tracing_debug_flag_can_be_ignored(dummy_request):
+    dummy_request.registry.settings = {
+        'zipkin.tracing_percent': 0,
+        'zipkin.debug_flag_forces_sampling': 'false',
+    }
+
+    assert not request_helper.is_tracing(dummy_request, b3_flags=1)
+
+
+@pytest.mark.parametrize('bypass,expected', [(False, False), ('true', True)])
+def test_is_tracing_debug_flag_and_blacklists(dummy_request, bypass, expected):
+    dummy_request.registry.settings = {
+        'zipkin.blacklisted_paths': [r'^/status'],
+        'zipkin.debug_flag_bypasses_blacklists': bypass,
+    }
+    dummy_request.path = '/status'
+
+    assert request_helper.is_tracing(dummy_request, b3_flags=1) is expected
+
+
+def test_is_tracing_kill_switch_wins_over_debug_flag(dummy_request):
+    dummy_request.registry.settings = {
+        'zipkin.sampling_control': SamplingControl(enabled=False),
+        'zipkin.debug_flag_bypasses_blacklists': True,
+    }
+
+    assert not request_helper.is_tracing(dummy_request, b3_flags=1)
+
+
+def test_create_zipkin_attr_parses_flags_once(dummy_request):
+    dummy_request.headers = {'X-B3-Flags': ' 1', 'X-B3-Sampled': '0'}
+
+    with mock.patch.object(
+        request_helper,
+        'parse_b3_flags',
+        wraps=request_helper.parse_b3_flags,
+    ) as mock_parse:
+        zipkin_attrs = request_helper.create_zipkin_attr(dummy_request)
+
+    assert mock_parse.call_count == 1
+    assert zipkin_attrs.flags == '1'
+    assert zipkin_attrs.is_sampled
+
+
+def test_get_binary_annotations_extra_binary_annotations(get_request):
+    get_request.registry.settings = {
+        'zipkin.set_extra_binary_annotations': lambda request, response: {
+            'tenant': 'acme',
+        },
+    }
+
+    annotations = request_helper.get_binary_annotations(get_request, None)
+    assert annotations['tenant'] == 'acme'
+
+    annotations = request_helper.get_binary_annotations(
+        get_request,
+        None,
+        extra_binary_annotations=False,
+    )
+    assert 'tenant' not in annotations
@@ -0,0 +1,91 @@
+import gc
+import json
+import time
+from unittest import mock
+
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import resource_usage
+from tests.acceptance.test_helper import generate_app_main
+
+
+def test_cpu_time():
+    usage = resource_usage.ResourceUsage()
+
+    usage.start()
+    deadline = time.perf_counter() + 0.02
+    while time.perf_counter() < deadline:
+        pass
+    time.sleep(0.02)
+    tags = usage.stop()
+
+    wall_time_ms = float(tags['zipkin.handler.wall_time_ms'])
+    cpu_time_ms = float(tags['zipkin.handler.cpu_time_ms'])
+    assert wall_time_ms >= 40
+    assert 10 <= cpu_time_ms < wall_time_ms
+    assert 'zipkin.gc.pauses' not in tags
+
+
+def test_gc_pauses():
+    usage = resource_usage.ResourceUsage(cpu_time=False, gc_pauses=True)
+
+    usage.start()
+    gc.collect()
+    gc.collect()
+    tags = usage.stop()
+    # Not counted once stopped.
+    gc.collect()
+
+    assert resource_usage._on_gc in gc.callbacks
+    assert 'zipkin.handler.cpu_time_ms' not in tags
+    assert tags['zipkin.gc.pauses'] == '2'
+    assert float(tags['zipkin.gc.pause_time_ms']) > 0
+    assert usage.gc_count == 2
+
+
+def test_gc_callback_is_installed_once():
+    for _ in range(2):
+        usage = resource_usage.ResourceUsage(gc_pauses=True)
+        usage.start()
+        usage.stop()
+
+    assert gc.callbacks.count(resource_usage._on_gc) == 1
+
+
+def test_gc_stop_without_start():
+    usage = resource_usage.ResourceUsage(gc_pauses=True)
+    usage.start()
+
+    # The collection started before the measurement.
+    resource_usage._on_gc('stop', {})
+
+    assert usage.stop()['zipkin.gc.pauses'] == '0'
+
+
+def test_tween_records_resource_usage_of_sampled_requests():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.record_cpu_time': 'true',
+        'zipkin.record_gc_pauses': 'true',
+    })
+
+    WebTestApp(app_main).get('/sample', status=200)
+
+    span, = json.loads(transport.output[0])
+    assert float(span['tags']['zipkin.handler.wall_time_ms']) > 0
+    assert float(span['tags']['zipkin.handler.cpu_time_ms']) > 0
+    assert 'zipkin.gc.pauses' in span['tags']
+    assert 'zipkin.gc.pause_time_ms' in span['tags']
+
+
+def test_tween_doesnt_measure_unsampled_requests():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 0,
+        'zipkin.record_cpu_time': True,
+    })
+
+    with mock.patch.object(resource_usage, 'ResourceUsage') as mock_usage:
+        WebTestApp(app_main).get('/sample', status=200)
+
+    assert not mock_usage.called
+    assert transport.output == []
@@ -0,0 +1,664 @@
+import json
+import threading
+import time
+from unittest import mock
+
+import pytest
+from py_zipkin.exception import ZipkinError
+from pyramid.request import Request
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import sampling
+from pyramid_zipkin.request_helper import is_tracing
+from tests.acceptance.test_helper import generate_app_main
+
+
+@pytest.fixture
+def control():
+    control = sampling.SamplingControl(tracing_percent=10)
+    yield control
+    control.stop_polling()
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_update_replaces_the_state(control):
+    state = control.state
+
+    new_state = control.update(
+        enabled=False,
+        route_tracing_percents={'home': '50'},
+    )
+
+    assert control.state is new_state
+    assert new_state == (False, 10.0, {'home': 50.0})
+    assert state == (True, 10.0, {})
+
+
+@pytest.mark.parametrize('changes', [
+    {'enabled': 'yes'},
+    {'tracing_percent': 200},
+    {'tracing_percent': 'often'},
+    {'route_tracing_percents': {'home': -1}},
+    {'route_tracing_percents': ['home']},
+])
+def test_update_invalid(control, changes):
+    state = control.state
+
+    with pytest.raises(ZipkinError):
+        control.update(**changes)
+
+    assert control.state is state
+
+
+def test_poll_file(control, tmp_path):
+    path = tmp_path / 'sampling.json'
+    control.start_polling(path=str(path), interval=60)
+    assert not control.poll()
+
+    path.write_text(json.dumps({'enabled': False}))
+    assert control.poll()
+    assert control.state == (False, 10.0, {})
+    assert not control.poll()
+
+    path.write_text(json.dumps({'route_tracing_percents': {'home': 100}}))
+    assert control.poll()
+    assert control.state == (True, 10.0, {'home': 100.0})
+
+    path.unlink()
+    assert control.poll()
+    assert control.state == (True, 10.0, {})
+
+
+@pytest.mark.parametrize('content', [
+    'not json',
+    '[1, 2]',
+    '{"tracing_percent": 1000}',
+    '{"unknown": 1}',
+])
+def test_poll_invalid_content(control, tmp_path, content):
+    path = tmp_path / 'sampling.json'
+    path.write_text(content)
+    state = control.state
+
+    control.start_polling(path=str(path), interval=60)
+
+    assert control.state is state
+    assert not control.poll()
+
+
+def test_poll_unreadable_file(control, tmp_path):
+    control.start_polling(path=str(tmp_path), interval=60)
+
+    assert not control.poll()
+
+
+def test_poll_without_source(control):
+    assert not control.poll()
+
+
+def test_poll_env_var(control, monkeypatch):
+    monkeypatch.setenv('ZIPKIN_SAMPLING', '{"tracing_percent": 0}')
+    control.start_polling(env_var='ZIPKIN_SAMPLING', interval=60)
+    assert control.state.tracing_percent == 0
+
+    monkeypatch.delenv('ZIPKIN_SAMPLING')
+    assert control.poll()
+    assert control.state.tracing_percent == 10
+
+
+def test_polling_thread(control, tmp_path):
+    path = tmp_path / 'sampling.json'
+    control.start_polling(path=str(path), interval=0.01)
+    # Starting again replaces the polling thread.
+    control.start_polling(path=str(path), interval=0.01)
+
+    path.write_text('{"enabled": false}')
+
+    _wait_for(lambda: not control.state.enabled)
+
+
+def test_polling_restarts_after_fork(control, tmp_path):
+    path = tmp_path / 'sampling.json'
+    control.start_polling(path=str(path), interval=0.01)
+    parent_thread = control._thread
+
+    control._after_fork()
+
+    assert control._thread is not parent_thread
+    path.write_text('{"enabled": false}')
+    _wait_for(lambda: not control.state.enabled)
+
+    control.stop_polling()
+    control._after_fork()
+    assert control._thread is None
+
+
+def test_start_polling_requires_one_source(control):
+    with pytest.raises(ZipkinError):
+        control.start_polling()
+    with pytest.raises(ZipkinError):
+        control.start_polling(path='a', env_var='b')
+
+
+def test_sampling_control_from_settings(tmp_path):
+    path = tmp_path / 'sampling.json'
+    path.write_text('{"enabled": false}')
+
+    control = sampling.sampling_control_from_settings({
+        'zipkin.tracing_percent': '5',
+        'zipkin.sampling_file': str(path),
+        'zipkin.sampling_poll_interval': '0.01',
+    })
+    control.stop_polling()
+
+    assert control.state == (False, 5.0, {})
+    assert sampling.sampling_control_from_settings({}).state == (True, 0.5, {})
+
+
+def test_sampling_control_from_settings_invalid_interval():
+    with pytest.raises(ZipkinError):
+        sampling.sampling_control_from_settings({
+            'zipkin.sampling_env_var': 'ZIPKIN_SAMPLING',
+            'zipkin.sampling_poll_interval': 'often',
+        })
+
+
+def test_is_tracing_disabled_ignores_sampled_header(dummy_request, control):
+    dummy_request.registry.settings = {'zipkin.sampling_control': control}
+    dummy_request.headers = {'X-B3-Sampled': '1'}
+    assert is_tracing(dummy_request)
+
+    control.update(enabled=False)
+
+    assert not is_tracing(dummy_request)
+
+
+def test_route_tracing_percents(control):
+    control.update(tracing_percent=0, route_tracing_percents={
+        'sample_route': 100,
+    })
+    app_main, transport, _ = generate_app_main({
+        'zipkin.sampling_control': control,
+    })
+
+    WebTestApp(app_main).get('/sample', status=200)
+    WebTestApp(app_main).get('/sample_v2', status=200)
+    WebTestApp(app_main).get('/does_not_exist', status=404)
+
+    assert len(transport.output) == 1
+    span, = json.loads(transport.output[0])
+    assert span['name'] == 'GET /sample'
+
+
+def test_concurrent_updates_arent_lost(control):
+    def update_percent():
+        for i in range(1000):
+            control.update(tracing_percent=i % 100)
+
+    def update_routes():
+        for i in range(1000):
+            control.update(route_tracing_percents={'home': i % 100})
+
+    threads = [
+        threading.Thread(target=update_percent),
+        threading.Thread(target=update_routes),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert control.state == (True, 99.0, {'home': 99.0})
+
+
+def test_updates_under_threaded_request_load(control):
+    control.update(tracing_percent=100)
+    app_main, transport, _ = generate_app_main({
+        'zipkin.sampling_control': control,
+    })
+    stop = threading.Event()
+    errors = []
+
+    def send_requests():
+        app = WebTestApp(app_main)
+        while not stop.is_set():
+            try:
+                app.get('/sample', status=200)
+                # The state is only ever swapped as a whole.
+                assert control.state in (
+                    (True, 100.0, {}),
+                    (False, 0.0, {}),
+                )
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+    threads = [threading.Thread(target=send_requests) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(200):
+        if i % 2:
+            control.update(enabled=True, tracing_percent=100)
+        else:
+            control.update(enabled=False, tracing_percent=0)
+        time.sleep(0.001)
+    control.update(enabled=False, tracing_percent=0)
+    # Let the requests that may have read the previous state finish.
+    time.sleep(0.05)
+    sent = len(transport.output)
+    time.sleep(0.05)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert sent > 0
+    assert len(transport.output) == sent
+
+
+def _blank_request(path='/sample', **kwargs):
+    request = Request.blank(path, **kwargs)
+    request.registry = mock.Mock(settings={})
+    return request
+
+
+@pytest.mark.parametrize('rule,kwargs,matches', [
+    ({}, {}, True),
+    ({'method': 'options'}, {'method': 'OPTIONS'}, True),
+    ({'method': 'OPTIONS'}, {}, False),
+    ({'path': '/sample'}, {}, True),
+    ({'path': '/sam'}, {}, False),
+    ({'path': '/sam.*'}, {}, True),
+    ({'host': 'api.example.com'}, {'host': 'api.example.com:8080'}, True),
+    ({'host': 'api.example.com'}, {'host': 'api.example.com'}, True),
+    ({'host': r'.*\.example\.com'}, {'host': 'example.com'}, False),
+    ({'host': '[::1]'}, {'host': '[::1]'}, False),
+    ({'host': r'\[::1\]'}, {'host': '[::1]'}, True),
+    (
+        {'headers': {'User-Agent': 'kube-probe/.*'}},
+        {'user_agent': 'kube-probe/1.27'},
+        True,
+    ),
+    ({'headers': {'User-Agent': 'kube-probe/.*'}}, {}, False),
+    (
+        {'headers': {'X-Tenant': 'acme', 'Content-Type': 'text/plain'}},
+        {'headers': {'X-Tenant': 'acme'}, 'content_type': 'text/plain'},
+        True,
+    ),
+    (
+        {'method': 'GET', 'headers': {'X-Tenant': 'acme'}},
+        {'headers': {'X-Tenant': 'other'}},
+        False,
+    ),
+])
+def test_sampling_rule_conditions(rule, kwargs, matches):
+    rules = sampling.SamplingRules([dict(rule, rate=25)])
+
+    assert rules.match(_blank_request(**kwargs)) == (25.0 if matches else None)
+
+
+def test_sampling_rules_first_match_wins():
+    rules = sampling.SamplingRules([
+        {'method': 'POST', 'rate': 100},
+        {'path': '/sample', 'rate': 0},
+        {'rate': 10},
+    ])
+
+    assert rules.match(_blank_request(method='POST')) == 100.0
+    assert rules.match(_blank_request()) == 0.0
+    assert rules.match(_blank_request('/other')) == 10.0
+
+
+def test_sampling_rules_match_the_route_once():
+    rules = sampling.SamplingRules([
+        {'route': 'sample_route', 'method': 'POST', 'rate': 100},
+        {'route': 'other', 'rate': 50},
+        {'route': 'sample_.*', 'rate': 0},
+        {'route': '', 'rate': 10},
+    ])
+    with mock.patch(
+        'pyramid_zipkin.request_helper._get_route_name',
+        side_effect=['sample_route', None],
+    ) as mock_get_route_name:
+        assert rules.match(_blank_request()) == 0.0
+        assert rules.match(_blank_request('/nope')) == 10.0
+
+    assert mock_get_route_name.call_count == 2
+
+
+@pytest.mark.parametrize('value', [
+    [{'path': '/status'}],
+    [{'path': '/status', 'rate': 101}],
+    [{'paths': '/status', 'rate': 0}],
+    [{'path': '(', 'rate': 0}],
+    [{'method': 1, 'rate': 0}],
+    [{'headers': ['User-Agent'], 'rate': 0}],
+    ['/status'],
+    {'path': '/status', 'rate': 0},
+    '[{"path": "/status", rate: 0}]',
+])
+def test_invalid_sampling_rules(value):
+    with pytest.raises(ZipkinError):
+        sampling.sampling_rules_from_setting(value)
+
+
+def test_sampling_rules_from_setting():
+    rules = sampling.sampling_rules_from_setting(
+        '[{"method": "OPTIONS", "rate": 0}]',
+    )
+
+    assert sampling.sampling_rules_from_setting(rules) is rules
+    assert rules.match(_blank_request(method='OPTIONS')) == 0.0
+
+
+def test_is_tracing_sampling_rules():
+    request = _blank_request(headers={'User-Agent': 'kube-probe/1.27'})
+    request.registry.settings = {
+        'zipkin.tracing_percent': 100,
+        'zipkin.sampling_rules': [
+            {'headers': {'User-Agent': 'kube-probe/.*'}, 'rate': 0},
+            {'method': 'POST', 'rate': 100},
+        ],
+    }
+    # Rules take precedence over the tracing percent...
+    assert not is_tracing(request)
+    request.method = 'POST'
+    request.user_agent = 'curl'
+    request.registry.settings['zipkin.tracing_percent'] = 0
+    assert is_tracing(request)
+    # ...which applies if no rule matches.
+    request.method = 'GET'
+    assert not is_tracing(request)
+
+
+def test_sampling_rules_dont_override_the_blacklists():
+    request = _blank_request(method='POST')
+    request.registry.settings = {
+        'zipkin.blacklisted_paths': [r'^/sample'],
+        'zipkin.sampling_rules': [{'method': 'POST', 'rate': 100}],
+    }
+
+    assert not is_tracing(request)
+
+
+@pytest.mark.parametrize('headers,expected', [
+    ({'X-B3-Sampled': '1'}, True),
+    ({'X-B3-Flags': '1'}, True),
+    ({'X-B3-Flags': '1', 'X-B3-Sampled': '1'}, True),
+    ({'X-B3-Sampled': '0'}, False),
+])
+def test_sampling_rules_dont_override_the_caller(headers, expected):
+    request = _blank_request(headers=headers)
+    request.registry.settings = {
+        'zipkin.sampling_rules': [
+            {'path': '/sample', 'rate': 0 if expected else 100},
+        ],
+    }
+
+    assert is_tracing(request) is expected
+
+
+def test_sampling_rules_in_the_app():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.sampling_rules': json.dumps([
+            {'route': 'sample_route_v2', 'rate': 0},
+            {'method': 'HEAD', 'rate': 0},
+        ]),
+    })
+    app = WebTestApp(app_main)
+
+    app.get('/sample', status=200)
+    app.get('/sample_v2', status=200)
+    app.head('/sample', status=200)
+
+    span, = json.loads(transport.output[0])
+    assert len(transport.output) == 1
+    assert span['name'] == 'GET /sample'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_route_reservoir():
+    clock = FakeClock()
+    reservoir = sampling.RouteReservoir(2, window=60, clock=clock)
+
+    assert [reservoir.sample('home', False) for _ in range(3)] == [
+        True, True, False,
+    ]
+    # Still traced if the tracing percent picks them.
+    assert reservoir.sample('home', True)
+    assert reservoir.sample(None, False)
+    # The requests the tracing percent picked count.
+    assert reservoir.sample('login', True)
+    assert reservoir.sample('login', False)
+    assert not reservoir.sample('login', False)
+
+    clock.now = 60
+    assert reservoir.sample('home', False)
+
+
+def test_route_reservoir_bounds_the_routes():
+    reservoir = sampling.RouteReservoir(1, max_routes=2, clock=FakeClock())
+
+    assert reservoir.sample('home', False)
+    assert reservoir.sample('login', False)
+    assert not reservoir.sample('checkout', False)
+    assert reservoir.sample('checkout', True)
+    assert not reservoir.sample('home', False)
+
+
+def test_route_reservoir_under_threaded_load():
+    reservoir = sampling.RouteReservoir(100)
+    sampled = []
+
+    def sample():
+        for _ in range(1000):
+            if reservoir.sample('home', False):
+                sampled.append(True)
+
+    threads = [threading.Thread(target=sample) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sampled) == 100
+
+
+def test_route_reservoir_from_settings():
+    reservoir = sampling.route_reservoir_from_settings({
+        'zipkin.min_traces_per_route': '5',
+        'zipkin.min_traces_window': '30',
+        'zipkin.min_traces_max_routes': '10',
+    })
+
+    assert reservoir.min_traces == 5
+    assert reservoir.window == 30.0
+    assert reservoir.max_routes == 10
+
+
+@pytest.mark.parametrize('settings', [
+    {'zipkin.min_traces_per_route': 'many'},
+    {'zipkin.min_traces_per_route': 0},
+    {'zipkin.min_traces_per_route': 1, 'zipkin.min_traces_window': 'long'},
+    {'zipkin.min_traces_per_route': 1, 'zipkin.min_traces_window': 0},
+    {'zipkin.min_traces_per_route': 1, 'zipkin.min_traces_max_routes': -1},
+])
+def test_route_reservoir_from_settings_invalid(settings):
+    with pytest.raises(ZipkinError):
+        sampling.route_reservoir_from_settings(settings)
+
+
+def test_route_reservoir_in_the_app():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 0,
+        'zipkin.route_reservoir': sampling.RouteReservoir(1),
+    })
+    app = WebTestApp(app_main)
+
+    for _ in range(3):
+        app.get('/sample', status=200)
+        app.get('/sample_v2', status=200)
+        app.get('/sample', headers={'X-B3-Sampled': '0'}, status=200)
+
+    assert len(transport.output) == 2
+    span, = json.loads(transport.output[0])
+    assert span['name'] == 'GET /sample'
+
+
+@pytest.fixture
+def boost():
+    return sampling.ErrorRateBoost(
+        50,
+        duration=60,
+        half_life=10,
+        min_requests=4,
+        max_traces_per_second=1000,
+        clock=FakeClock(),
+    )
+
+
+def test_error_rate_boost(boost):
+    for _ in range(3):
+        boost.record('home', True)
+    # Not enough requests yet.
+    assert not boost.boosting
+    boost.record('home', False)
+    boost.record('home', True)
+    assert boost.boosting
+
+    assert boost.sample('home')
+    assert not boost.sample('login')
+    # The boost decays linearly.
+    boost._clock.now = 30
+    with mock.patch('random.random', return_value=0.49):
+        assert boost.sample('home')
+    with mock.patch('random.random', return_value=0.51):
+        assert not boost.sample('home')
+    boost._clock.now = 60
+    assert not boost.sample('home')
+    assert not boost.boosting
+
+
+def test_error_rate_boost_is_extended_while_failing(boost):
+    for _ in range(4):
+        boost.record('home', True)
+    boost._clock.now = 30
+    for _ in range(4):
+        boost.record('home', True)
+    boost._clock.now = 80
+
+    with mock.patch('random.random', return_value=0.1):
+        assert boost.sample('home')
+
+
+def test_error_rate_decays(boost):
+    for _ in range(10):
+        boost.record('home', True)
+    boost._clock.now = 100
+    for _ in range(10):
+        boost.record('home', False)
+    # 10 errors weighing 1 / 1024 each, out of 10 requests.
+    boost._clock.now = 200
+    boost.record('home', True)
+
+    assert boost._boosted['home'] == 60
+    assert not boost.sample('home')
+
+
+def test_error_rate_boost_ignores_successful_routes(boost):
+    for _ in range(20):
+        boost.record('home', False)
+    boost.record('home', True)
+
+    assert not boost.boosting
+
+
+def test_error_rate_boost_max_traces_per_second():
+    clock = FakeClock()
+    boost = sampling.ErrorRateBoost(
+        50,
+        min_requests=1,
+        max_traces_per_second=2,
+        clock=clock,
+    )
+    boost.record('home', True)
+
+    assert [boost.sample('home') for _ in range(3)] == [True, True, False]
+    clock.now = 0.5
+    assert [boost.sample('home') for _ in range(2)] == [True, False]
+
+
+def test_error_rate_boost_bounds_the_routes():
+    boost = sampling.ErrorRateBoost(
+        50,
+        min_requests=1,
+        max_routes=1,
+        clock=FakeClock(),
+    )
+    boost.record('home', False)
+    boost.record('login', True)
+
+    assert not boost.boosting
+
+
+def test_error_rate_boost_from_settings():
+    boost = sampling.error_rate_boost_from_settings({
+        'zipkin.error_boost_threshold': '5',
+        'zipkin.error_boost_tracing_percent': '20',
+        'zipkin.error_boost_duration': '30',
+        'zipkin.error_boost_min_requests': '50',
+    })
+
+    assert boost.threshold == 5.0
+    assert boost.tracing_percent == 20.0
+    assert boost.duration == 30.0
+    assert boost.half_life == sampling.DEFAULT_ERROR_BOOST_HALF_LIFE
+    assert boost.min_requests == 50
+
+
+@pytest.mark.parametrize('settings', [
+    {'zipkin.error_boost_threshold': 'high'},
+    {
+        'zipkin.error_boost_threshold': 5,
+        'zipkin.error_boost_tracing_percent': 200,
+    },
+    {'zipkin.error_boost_threshold': 5, 'zipkin.error_boost_duration': 'long'},
+    {'zipkin.error_boost_threshold': 5, 'zipkin.error_boost_half_life': 0},
+])
+def test_error_rate_boost_from_settings_invalid(settings):
+    with pytest.raises(ZipkinError):
+        sampling.error_rate_boost_from_settings(settings)
+
+
+def test_error_rate_boost_in_the_app():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 0,
+        'zipkin.error_boost': sampling.ErrorRateBoost(
+            50,
+            min_requests=1,
+            clock=FakeClock(),
+        ),
+    })
+    app = WebTestApp(app_main)
+
+    app.get('/server_error', status=500)
+    app.get('/sample', status=200)
+    assert transport.output == []
+    app.get('/server_error', status=500)
+
+    span, = json.loads(transport.output[0])
+    assert len(transport.output) == 1
+    assert span['name'] == 'GET /server_error'
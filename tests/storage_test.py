@@ -0,0 +1,113 @@
+import json
+from unittest import mock
+
+from py_zipkin import Kind
+from py_zipkin.encoding._helpers import Span
+from py_zipkin.storage import get_default_tracer
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import storage
+from tests.acceptance.test_helper import generate_app_main
+
+
+def _span(**kwargs):
+    return Span(
+        trace_id='66ec982fcfba8bf3b32d71d76e4a16a3',
+        name='query',
+        parent_id=None,
+        span_id='17133d482ba4f605',
+        kind=Kind.LOCAL,
+        timestamp=1664500000.0,
+        duration=0.5,
+        **kwargs
+    )
+
+
+def test_estimate_span_size_grows_with_tags_and_annotations():
+    base = storage.estimate_span_size(_span())
+    assert base == storage._SPAN_SIZE_OVERHEAD + len('query')
+
+    tagged = storage.estimate_span_size(_span(
+        tags={'key': 'value'},
+        annotations={'foo': 1664500000.0},
+    ))
+    assert tagged == base + len('keyvalue') + 8 + len('foo') + 40
+
+
+def _payload_sizes(transport):
+    return [len(json.loads(payload)) for payload in transport.output]
+
+
+def test_child_spans_are_flushed_every_n_spans():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.incremental_flush_spans': '4',
+    })
+    tracer = get_default_tracer()
+    original_storage = tracer._span_storage
+
+    WebTestApp(app_main).get('/many_spans?count=10', status=200)
+
+    # The last 2 child spans are emitted along with the root span.
+    assert _payload_sizes(transport) == [4, 4, 3]
+    spans = [span for p in transport.output for span in json.loads(p)]
+    assert [s['tags']['index'] for s in spans[:-1]] == [str(i) for i in range(10)]
+    assert spans[0]['localEndpoint']['serviceName'] == 'child'
+    assert spans[0]['localEndpoint']['ipv4'] == spans[-1]['localEndpoint']['ipv4']
+    assert 'zipkin.dropped_spans' not in spans[-1]['tags']
+    assert tracer._span_storage is original_storage
+
+
+def test_child_spans_are_flushed_by_size():
+    span_size = storage.estimate_span_size(_span(tags={'index': '0'}))
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.incremental_flush_bytes': 3 * span_size,
+    })
+
+    WebTestApp(app_main).get('/many_spans?count=7', status=200)
+
+    assert _payload_sizes(transport) == [3, 3, 2]
+
+
+def test_child_spans_over_the_limit_are_dropped():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.max_child_spans': 3,
+    })
+
+    WebTestApp(app_main).get('/many_spans?count=10', status=200)
+
+    [payload] = transport.output
+    spans = json.loads(payload)
+    assert len(spans) == 4
+    assert spans[-1]['tags']['zipkin.dropped_spans'] == '7'
+
+
+def test_unsampled_spans_are_only_flushed_to_the_firehose():
+    app_main, transport, firehose = generate_app_main(
+        {
+            'zipkin.tracing_percent': 0,
+            'zipkin.incremental_flush_spans': 5,
+        },
+        firehose=True,
+    )
+
+    WebTestApp(app_main).get('/many_spans?count=10', status=200)
+
+    assert transport.output == []
+    assert _payload_sizes(firehose) == [5, 5, 1]
+
+
+def test_flush_errors_are_logged():
+    app_main, transport, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.incremental_flush_spans': 2,
+    })
+    transport.send = mock.Mock(side_effect=[IOError, None, None])
+
+    with mock.patch.object(storage.log, 'error') as mock_log:
+        WebTestApp(app_main).get('/many_spans?count=4', status=200)
+
+    assert mock_log.call_count == 1
+    assert transport.send.call_count == 3
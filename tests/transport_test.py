@@ -0,0 +1,549 @@
+import json
+import threading
+from unittest import mock
+
+import pytest
+from py_zipkin import Encoding
+from py_zipkin import Kind
+from py_zipkin.encoding import get_encoder
+from py_zipkin.encoding._helpers import Span
+from webtest import TestApp as WebTestApp
+
+from pyramid_zipkin import transport
+from tests.acceptance.test_helper import generate_app_main
+from tests.acceptance.test_helper import MockTransport
+
+
+def _span(span_id='17133d482ba4f605'):
+    return Span(
+        trace_id='66ec982fcfba8bf3b32d71d76e4a16a3',
+        name='GET /sample',
+        parent_id=None,
+        span_id=span_id,
+        kind=Kind.SERVER,
+        timestamp=1664500000.0,
+        duration=0.5,
+    )
+
+
+@pytest.fixture
+def encoder():
+    return get_encoder(Encoding.V2_JSON)
+
+
+def test_deferred_encoder_returns_raw_spans(encoder):
+    deferred = transport.DeferredEncoder(encoder)
+    span = _span()
+    pending = deferred.encode_span(span)
+
+    assert deferred.fits(0, 0, 10, pending)
+    assert len(pending) == 1
+    assert deferred.encode_queue([pending]) == transport.SpanBatch(
+        [span],
+        encoder,
+    )
+
+
+def test_background_transport_encodes_off_the_calling_thread(encoder):
+    sink = MockTransport()
+    sink.send = mock.Mock(
+        side_effect=lambda payload: sink.output.append(
+            (threading.current_thread().name, payload),
+        ),
+    )
+    background = transport.BackgroundEncodingTransport(sink)
+    assert background.get_max_payload_bytes() is None
+
+    background(transport.SpanBatch([_span()], encoder))
+    assert background.flush(timeout=5)
+
+    [(thread_name, payload)] = sink.output
+    assert thread_name == 'pyramid_zipkin-encoder'
+    assert json.loads(payload)[0]['id'] == '17133d482ba4f605'
+
+
+def test_background_transport_batches_to_the_sink_limits(encoder):
+    sink = MockTransport()
+    background = transport.BackgroundEncodingTransport(
+        sink,
+        max_span_batch_size=2,
+    )
+    spans = [_span(f'{i:016x}') for i in range(5)]
+
+    background(transport.SpanBatch(spans, encoder))
+    assert background.flush(timeout=5)
+
+    assert [len(json.loads(p)) for p in sink.output] == [2, 2, 1]
+
+
+def test_background_transport_forwards_encoded_payloads():
+    sink = MockTransport()
+    background = transport.BackgroundEncodingTransport(sink)
+
+    background('[{"id": "1"}]')
+    assert background.flush(timeout=5)
+
+    assert sink.output == ['[{"id": "1"}]']
+
+
+def test_background_transport_drops_spans_when_full(encoder):
+    sink = MockTransport()
+    background = transport.BackgroundEncodingTransport(
+        sink,
+        max_queued_spans=2,
+    )
+    # Hold the lock so that the worker can't drain the queue.
+    with background._condition:
+        background(transport.SpanBatch([_span(), _span()], encoder))
+        background(transport.SpanBatch([_span()], encoder))
+        background('[]')
+        assert background._queued_spans == 2
+    assert background.dropped_spans == 2
+
+    assert background.flush(timeout=5)
+    assert len(sink.output) == 1
+
+
+def test_background_transport_logs_transport_errors():
+    sink = mock.Mock(side_effect=[IOError, None])
+    background = transport.BackgroundEncodingTransport(sink)
+
+    with mock.patch.object(transport.log, 'exception') as mock_log:
+        background('[1]')
+        background('[2]')
+        assert background.flush(timeout=5)
+
+    assert mock_log.call_count == 1
+    assert sink.call_count == 2
+
+
+def _hold(lock):
+    """Holds `lock` from another thread, like a thread of the parent process
+    holding it at fork time, until the returned event is set.
+    """
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with lock:
+            acquired.set()
+            release.wait()
+
+    threading.Thread(target=hold, daemon=True).start()
+    acquired.wait()
+    return release
+
+
+def test_background_transport_restarts_worker_after_fork():
+    background = transport.BackgroundEncodingTransport(MockTransport())
+    background('[1]')
+    thread = background._thread
+    release = _hold(background._condition)
+
+    background._after_fork()
+
+    assert background._thread is None
+    assert not any(background._queues)
+    background('[2]')
+    assert background._thread is not thread
+    assert background.flush(timeout=5)
+    release.set()
+
+
+def test_tween_hands_raw_spans_to_background_transport():
+    sink = MockTransport()
+    background = transport.BackgroundEncodingTransport(sink)
+    app_main, _, _ = generate_app_main({'zipkin.tracing_percent': 100})
+    app_main.registry.settings['zipkin.transport_handler'] = background
+
+    with mock.patch.object(
+        background,
+        'send',
+        wraps=background.send,
+    ) as mock_send:
+        WebTestApp(app_main).get('/span_context', status=200)
+
+    [payload], _ = mock_send.call_args
+    assert isinstance(payload, transport.SpanBatch)
+    assert len(payload.spans) == 3
+
+    assert background.flush(timeout=5)
+    spans = json.loads(sink.output[0])
+    assert spans[2]['kind'] == 'SERVER'
+    assert spans[2]['localEndpoint']['serviceName'] == 'acceptance_service'
+
+
+def test_tween_encodes_synchronously_if_firehose_isnt_in_background():
+    sink = MockTransport()
+    background = transport.BackgroundEncodingTransport(sink)
+    app_main, _, firehose = generate_app_main(
+        {'zipkin.tracing_percent': 100},
+        firehose=True,
+    )
+    app_main.registry.settings['zipkin.transport_handler'] = background
+
+    WebTestApp(app_main).get('/sample', status=200)
+
+    assert background.flush(timeout=5)
+    [span] = json.loads(sink.output[0])
+    [firehose_span] = json.loads(firehose.output[0])
+    assert span['id'] == firehose_span['id']
+
+
+def test_deferred_encoder_priority(encoder):
+    deferred = transport.DeferredEncoder(encoder, transport.SPAN_PRIORITY_LOW)
+    deferred.priority = transport.SPAN_PRIORITY_HIGH
+
+    batch = deferred.encode_queue([deferred.encode_span(_span())])
+
+    assert batch.priority == transport.SPAN_PRIORITY_HIGH
+
+
+def _batch(encoder, span_count, priority):
+    return transport.SpanBatch([_span()] * span_count, encoder, priority)
+
+
+def test_background_transport_sheds_low_priority_spans_first(encoder):
+    sink = MockTransport()
+    background = transport.BackgroundEncodingTransport(
+        sink,
+        max_queued_spans=4,
+    )
+    low = transport.SPAN_PRIORITY_LOW
+    normal = transport.SPAN_PRIORITY_NORMAL
+    high = transport.SPAN_PRIORITY_HIGH
+    # Hold the lock so that the worker can't drain the queue, as if the
+    # transport couldn't keep up.
+    with background._condition:
+        background(_batch(encoder, 1, low))
+        background(_batch(encoder, 1, low))
+        background(_batch(encoder, 2, normal))
+        # Full: the oldest low priority batch makes room for a normal one.
+        background(_batch(encoder, 1, normal))
+        assert background.dropped_spans_by_priority == [1, 0, 0]
+        # Dropping the remaining low priority batch isn't enough.
+        background(_batch(encoder, 2, normal))
+        assert background.dropped_spans_by_priority == [1, 2, 0]
+        # Encoded payloads count as normal priority.
+        background('[]')
+        assert background.dropped_spans_by_priority == [2, 2, 0]
+        # A low priority batch never replaces anything.
+        background(_batch(encoder, 1, low))
+        assert background.dropped_spans_by_priority == [3, 2, 0]
+        # High priority batches replace low, then normal ones.
+        background(_batch(encoder, 3, high))
+        assert background.dropped_spans_by_priority == [3, 5, 0]
+        background(_batch(encoder, 2, high))
+        assert background.dropped_spans_by_priority == [3, 5, 2]
+        assert background._queued_spans == 4
+        assert background.dropped_spans == 10
+
+    assert background.flush(timeout=5)
+    # Higher priority payloads are sent first.
+    assert [len(json.loads(payload)) for payload in sink.output] == [3, 0]
+
+
+def test_background_transport_under_saturation(encoder):
+    # The sink is slower than the requests: only the high priority spans
+    # should make it.
+    sending = threading.Event()
+    release = threading.Event()
+
+    def sink(payload):
+        sending.set()
+        release.wait(5)
+
+    sink = mock.Mock(side_effect=sink)
+    background = transport.BackgroundEncodingTransport(
+        sink,
+        max_queued_spans=10,
+    )
+    background(_batch(encoder, 1, transport.SPAN_PRIORITY_LOW))
+    assert sending.wait(5)
+    for i in range(100):
+        background(_batch(encoder, 1, transport.SPAN_PRIORITY_LOW))
+        background(_batch(encoder, 1, transport.SPAN_PRIORITY_NORMAL))
+        if i % 10 == 0:
+            background(_batch(encoder, 1, transport.SPAN_PRIORITY_HIGH))
+    release.set()
+    assert background.flush(timeout=5)
+
+    assert background.dropped_spans_by_priority[transport.SPAN_PRIORITY_HIGH] \
+        == 0
+    # The first low priority batch was already being sent.
+    assert sink.call_count == 11
+    assert background.dropped_spans == 211 - 11
+
+
+@pytest.mark.parametrize('path,headers,settings,priority', [
+    ('/sample', {}, {}, transport.SPAN_PRIORITY_LOW),
+    ('/sample', {'X-B3-Sampled': '1'}, {}, transport.SPAN_PRIORITY_NORMAL),
+    ('/sample', {'X-B3-Flags': '1'}, {}, transport.SPAN_PRIORITY_HIGH),
+    ('/server_error', {}, {}, transport.SPAN_PRIORITY_HIGH),
+    ('/client_error', {}, {}, transport.SPAN_PRIORITY_LOW),
+    (
+        '/sample',
+        {},
+        {'zipkin.slow_request_threshold_ms': 0},
+        transport.SPAN_PRIORITY_HIGH,
+    ),
+    (
+        '/sample',
+        {},
+        {'zipkin.slow_request_threshold_ms': 60000},
+        transport.SPAN_PRIORITY_LOW,
+    ),
+])
+def test_tween_classifies_span_priority(path, headers, settings, priority):
+    background = transport.BackgroundEncodingTransport(MockTransport())
+    app_main, _, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        **settings,
+    })
+    app_main.registry.settings['zipkin.transport_handler'] = background
+
+    with mock.patch.object(background, 'send') as mock_send:
+        WebTestApp(app_main).get(path, headers=headers, expect_errors=True)
+
+    [payload], _ = mock_send.call_args
+    assert payload.priority == priority
+
+
+def test_tween_classifies_exceptions_as_high_priority():
+    background = transport.BackgroundEncodingTransport(MockTransport())
+    app_main, _, _ = generate_app_main({
+        'zipkin.tracing_percent': 100,
+        'zipkin.trace_streaming_responses': True,
+    })
+    app_main.registry.settings['zipkin.transport_handler'] = background
+
+    with mock.patch.object(background, 'send') as mock_send:
+        with pytest.raises(ValueError):
+            WebTestApp(app_main).get('/streaming?fail=1')
+
+    [payload], _ = mock_send.call_args
+    assert payload.priority == transport.SPAN_PRIORITY_HIGH
+
+
+class _LimitedTransport(MockTransport):
+    def __init__(self, max_payload_bytes):
+        super().__init__()
+        self.max_payload_bytes = max_payload_bytes
+
+    def get_max_payload_bytes(self):
+        return self.max_payload_bytes
+
+
+def test_fan_out_transport_sends_the_same_payload_to_every_transport():
+    first = MockTransport()
+    second = mock.Mock(side_effect=ValueError('sink is down'))
+    third = MockTransport()
+    fan_out = transport.FanOutTransport([first, second, third])
+    payload = b'[]'
+
+    fan_out(payload)
+
+    # An error in one transport doesn't prevent the others from sending.
+    assert first.output[0] is payload
+    second.assert_called_once_with(payload)
+    assert third.output[0] is payload
+    assert fan_out.flush(timeout=0)
+
+
+@pytest.mark.parametrize('limits,max_payload_bytes', [
+    ([None, None], None),
+    ([1000, None], 1000),
+    ([1000, 500], 500),
+])
+def test_fan_out_transport_max_payload_bytes(limits, max_payload_bytes):
+    fan_out = transport.FanOutTransport(
+        [_LimitedTransport(limit) for limit in limits] + [print],
+    )
+
+    assert fan_out.get_max_payload_bytes() == max_payload_bytes
+
+
+def test_fan_out_transport_thread_pool():
+    release = threading.Event()
+    threads = []
+
+    def slow_sink(payload):
+        threads.append(threading.current_thread().name)
+        release.wait(5)
+
+    fan_out = transport.FanOutTransport([slow_sink, slow_sink], max_workers=2)
+
+    fan_out('[]')
+    # Both sinks are running concurrently, and the caller didn't wait.
+    assert not fan_out.flush(timeout=0.01)
+    release.set()
+    assert fan_out.flush(timeout=5)
+
+    assert len(threads) == 2
+    assert all(name.startswith('pyramid_zipkin-fan-out') for name in threads)
+    assert fan_out._pending == [{}, {}, {}]
+
+
+def test_fan_out_transport_drops_payloads_past_max_pending():
+    release = threading.Event()
+    sink = mock.Mock(side_effect=lambda payload: release.wait(5))
+    fan_out = transport.FanOutTransport(
+        [sink, sink],
+        max_workers=1,
+        max_pending=3,
+    )
+
+    fan_out('[1]')
+    fan_out('[2]')
+    release.set()
+    assert fan_out.flush(timeout=5)
+
+    assert fan_out.dropped_payloads == 1
+    assert sink.call_count == 3
+
+
+def test_fan_out_transport_drops_lower_priority_payloads_first():
+    started = threading.Event()
+    release = threading.Event()
+    sent = []
+
+    def sink(payload):
+        sent.append(payload)
+        started.set()
+        release.wait(5)
+
+    fan_out = transport.FanOutTransport([sink], max_workers=1, max_pending=2)
+
+    def batch(name, priority):
+        return transport.SpanBatch([_span()], name, priority)
+
+    fan_out(batch('sending', transport.SPAN_PRIORITY_LOW))
+    assert started.wait(5)
+    fan_out(batch('low', transport.SPAN_PRIORITY_LOW))
+    # The low priority payload that's waiting makes room for this one, the
+    # one being sent can't.
+    fan_out(batch('high', transport.SPAN_PRIORITY_HIGH))
+    # Nothing waiting has a lower priority.
+    fan_out(batch('normal', transport.SPAN_PRIORITY_NORMAL))
+    release.set()
+    assert fan_out.flush(timeout=5)
+
+    assert [payload.encoder for payload in sent] == ['sending', 'high']
+    assert fan_out.dropped_payloads == 2
+    assert fan_out.dropped_payloads_by_priority == [1, 1, 0]
+
+
+@pytest.mark.parametrize('max_span_batch_sizes,encode_count', [
+    ((None, None), 1),
+    # Batched differently, so encoded once per batch size.
+    ((None, 1), 3),
+])
+def test_fan_out_transport_encodes_span_batches_once(
+    encoder,
+    max_span_batch_sizes,
+    encode_count,
+):
+    sinks = [MockTransport(), MockTransport()]
+    backgrounds = [
+        transport.BackgroundEncodingTransport(
+            sink,
+            max_span_batch_size=max_span_batch_size,
+        )
+        for sink, max_span_batch_size in zip(sinks, max_span_batch_sizes)
+    ]
+    fan_out = transport.FanOutTransport(backgrounds)
+    counting_encoder = mock.Mock(wraps=encoder)
+    spans = [_span('17133d482ba4f605'), _span('27133d482ba4f605')]
+
+    fan_out(transport.SpanBatch(spans, counting_encoder))
+    for background in backgrounds:
+        assert background.flush(timeout=5)
+
+    assert counting_encoder.encode_queue.call_count == encode_count
+    first, second = sinks
+    assert len(json.loads(first.output[0])) == 2
+    if encode_count == 1:
+        assert second.output[0] is first.output[0]
+    else:
+        assert [len(json.loads(payload)) for payload in second.output] == \
+            [1, 1]
+
+
+def test_shared_encoding_with_a_plain_transport_handler(
+    encoder,
+):
+    payloads = []
+    background = transport.BackgroundEncodingTransport(payloads.append)
+    fan_out = transport.FanOutTransport([background, background])
+
+    fan_out(transport.SpanBatch([_span()], encoder))
+    assert background.flush(timeout=5)
+
+    first, second = payloads
+    assert second is first
+
+
+def test_fan_out_transport_restarts_thread_pool_after_fork():
+    fan_out = transport.FanOutTransport([MockTransport()], max_workers=1)
+    fan_out('[]')
+    fan_out('[]')
+    parent_executor = fan_out._executor
+    release = _hold(fan_out._lock)
+
+    fan_out._after_fork()
+    fan_out('[]')
+
+    assert fan_out._executor is not parent_executor
+    assert fan_out.flush(timeout=5)
+    release.set()
+
+
+def test_tween_encodes_spans_once_for_transport_and_firehose():
+    app_main, normal_transport, firehose_transport = generate_app_main(
+        {'zipkin.tracing_percent': 100},
+        firehose=True,
+    )
+
+    with mock.patch(
+        'py_zipkin.encoding._encoders._V2JSONEncoder.encode_queue',
+        autospec=True,
+        side_effect=lambda self, queue: '[' + ','.join(queue) + ']',
+    ) as mock_encode_queue:
+        WebTestApp(app_main).get('/decorator_context', status=200)
+
+    assert mock_encode_queue.call_count == 1
+    [payload] = normal_transport.output
+    assert firehose_transport.output[0] is payload
+    assert len(json.loads(payload)) == 2
+
+
+def test_tween_defers_encoding_only_if_the_firehose_does():
+    background = transport.BackgroundEncodingTransport(MockTransport())
+    app_main, _, firehose_transport = generate_app_main(
+        {'zipkin.tracing_percent': 100},
+        firehose=True,
+    )
+    app_main.registry.settings['zipkin.transport_handler'] = background
+
+    with mock.patch.object(background, 'send') as mock_send:
+        WebTestApp(app_main).get('/sample', status=200)
+
+    [payload], _ = mock_send.call_args
+    assert firehose_transport.output == [payload]
+    assert isinstance(payload, str)
+
+
+def test_tween_shares_span_batches_between_background_transports():
+    background = transport.BackgroundEncodingTransport(MockTransport())
+    firehose = transport.BackgroundEncodingTransport(MockTransport())
+    app_main, _, _ = generate_app_main({'zipkin.tracing_percent': 100})
+    app_main.registry.settings['zipkin.transport_handler'] = background
+    app_main.registry.settings['zipkin.firehose_handler'] = firehose
+
+    with mock.patch.object(background, 'send') as mock_send, \
+            mock.patch.object(firehose, 'send') as mock_firehose_send:
+        WebTestApp(app_main).get('/sample', status=200)
+
+    [payload], _ = mock_send.call_args
+    assert isinstance(payload, transport.SpanBatch)
+    mock_firehose_send.assert_called_once_with(payload)
@@ -3,6 +3,8 @@ import json
 from unittest import mock
 
 import pytest
+from py_zipkin import Encoding
+from py_zipkin.exception import ZipkinError
 from py_zipkin.storage import get_default_tracer
 from py_zipkin.storage import Stack
 
@@ -183,18 +185,6 @@ def test_zipkin_tween_context_stack(
     assert context_stack.pop.call_count == 1
 
 
-def test_getattr_path():
-    request_context = DummyRequestContext(zipkin_context=object())
-    assert tween._getattr_path(request_context, 'zipkin_context.__class__')
-
-    # missing attribute
-    tween._getattr_path(request_context, 'zipkin_context.missing') is None
-
-    # attribute is None
-    mock_object = mock.Mock(nil=None)
-    assert tween._getattr_path(mock_object, 'nil') is None
-
-
 def test_logs_warning_if_using_function_as_transport(
     dummy_request,
     dummy_response,
@@ -208,3 +198,85 @@ def test_logs_warning_if_using_function_as_transport(
     handler = mock.Mock(return_value=dummy_response)
     with pytest.deprecated_call():
         tween.zipkin_tween(handler, None)(dummy_request)
+
+
+def test_traced_app_iter_without_close():
+    zipkin_context = mock.Mock()
+    exit_stack = mock.MagicMock()
+    app_iter = tween._TracedAppIter(
+        iter([b'a', b'bc']),
+        zipkin_context,
+        exit_stack,
+    )
+
+    assert list(app_iter) == [b'a', b'bc']
+    app_iter.close()
+
+    zipkin_context.add_annotation.assert_called_once_with('wsgi.first_byte')
+    zipkin_context.update_binary_annotations.assert_called_once_with(
+        {'http.response.body.size': '3'},
+    )
+    exit_stack.__exit__.assert_called_once_with(None, None, None)
+
+
+def test_defers_encoding_without_the_transport_module():
+    with mock.patch.dict('sys.modules', {'pyramid_zipkin.transport': None}):
+        assert not tween._defers_encoding(MockTransport(), None)
+
+
+def test_compile_settings_coerces_strings():
+    compiled_settings = tween._compile_settings({
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.tracing_percent': '12.5',
+        'zipkin.encoding': 'V2_PROTO3',
+        'zipkin.port': '8080',
+        'zipkin.max_child_spans': '10',
+        'zipkin.use_pattern_as_span_name': 'true',
+        'zipkin.report_root_timestamp': 'false',
+        'zipkin.trace_streaming_responses': 'false',
+    })
+
+    assert compiled_settings.sampling.tracing_percent == 12.5
+    assert compiled_settings.encoding is Encoding.V2_PROTO3
+    assert compiled_settings.port_setting == 8080
+    assert compiled_settings.max_child_spans == 10
+    assert compiled_settings.use_pattern_as_span_name is True
+    assert compiled_settings.report_root_timestamp_setting is False
+    assert compiled_settings.trace_streaming_responses is False
+
+
+@pytest.mark.parametrize('settings', [
+    {'zipkin.tracing_percent': 'abc'},
+    {'zipkin.tracing_percent': 101},
+    {'zipkin.encoding': 'V3_JSON'},
+    {'zipkin.max_span_batch_size': 'many'},
+    {'zipkin.create_zipkin_attr': 'a.b.c'},
+    {'zipkin.post_handler_hook': 42},
+    {'zipkin.transport_handler': 'transport'},
+    {'zipkin.request_start_header': ''},
+    {'zipkin.aggregate_spans_min_count': 1},
+])
+def test_compile_settings_invalid(settings):
+    settings = {'zipkin.transport_handler': MockTransport(), **settings}
+
+    with pytest.raises(ZipkinError):
+        tween._compile_settings(settings)
+
+
+def test_get_settings_from_request_uses_compiled_settings(get_request):
+    compiled_settings = tween._compile_settings({
+        'zipkin.transport_handler': MockTransport(),
+        'zipkin.port': 8080,
+        'zipkin.report_root_timestamp': True,
+    })
+    get_request.headers['X-B3-TraceId'] = '17133d482ba4f605'
+
+    zipkin_settings = tween._get_settings_from_request(
+        get_request,
+        compiled_settings,
+    )
+
+    assert zipkin_settings.port == 8080
+    assert zipkin_settings.report_root_timestamp is True
+    assert zipkin_settings.compiled_settings.transport_handler is \
+        compiled_settings.transport_handler